@@ -0,0 +1,25 @@
+from rest_framework import serializers
+
+from common.constants import LogTypes, LogLevels
+
+
+class LogRecordSerializer(serializers.Serializer):
+
+    t = serializers.IntegerField(source="time")
+    log = serializers.SerializerMethodField()
+    level = serializers.SerializerMethodField()
+    status = serializers.SerializerMethodField()
+    instanceId = serializers.CharField(source="instance")
+    msg = serializers.CharField()
+
+    def get_log(self, instance):
+        return LogTypes(instance.log_type).name
+
+    def get_level(self, instance):
+        return LogLevels(instance.level).name
+
+    def get_status(self, instance):
+        return "OUT" if instance.is_out else "IN"
+
+    class Meta:
+        fields = ["t", "log", "level", "status", "instanceId", "msg"]
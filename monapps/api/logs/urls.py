@@ -0,0 +1,6 @@
+from django.urls import path
+from .views import ListLogRecords
+
+urlpatterns = [
+    path("", ListLogRecords.as_view()),
+]
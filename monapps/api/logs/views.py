@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.views import APIView
+from rest_framework.response import Response
+
+from .serializers import LogRecordSerializer
+from apps.logs.models import LogRecord
+from common.constants import LogTypes
+
+
+class ListLogRecords(APIView):
+    """
+    Log records, the newest first. Query parameters:
+    'instanceId' - e.g. "datastream 125", 'log' - "DEVICE", "APP" or "ALARM",
+    'gte'/'lte' - the time range, 'limit' - the page size,
+    'cursor' - 'nextCursor' of the previous page to get the next (older) one.
+    """
+
+    def get(self, request, **kwargs):
+        params = self.request.query_params
+        qs = LogRecord.objects.all()
+        try:
+            if "instanceId" in params:
+                qs = qs.filter(instance=params.get("instanceId"))
+            if "log" in params:
+                qs = qs.filter(log_type=LogTypes[params.get("log").upper()])
+            if "gte" in params:
+                qs = qs.filter(time__gte=int(params.get("gte")))
+            if "lte" in params:
+                qs = qs.filter(time__lte=int(params.get("lte")))
+            if "cursor" in params:
+                # the records are paginated by (time, id) instead of an offset, so the pages stay consistent
+                # while new records are added and the db does not go through the skipped records
+                cursor_ts, cursor_id = (int(part) for part in params.get("cursor").split("_"))
+                qs = qs.filter(Q(time__lt=cursor_ts) | Q(time=cursor_ts, id__lt=cursor_id))
+            limit = min(max(int(params.get("limit", settings.LOG_API_MAX_LIMIT)), 1), settings.LOG_API_MAX_LIMIT)
+        except (KeyError, ValueError):
+            raise ValidationError("Incorrect query parameters")
+
+        records = list(qs.order_by("-time", "-id")[: limit + 1])
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = f"{records[-1].time}_{records[-1].id}"
+        return Response({"logRecords": LogRecordSerializer(records, many=True).data, "nextCursor": next_cursor})
@@ -10,5 +10,6 @@ urlpatterns = [
     path("dfreadings/", include("api.dfreadings.urls")),
     path("dsreadings/", include("api.dsreadings.urls")),
     path("nodes/", include("api.nodes.urls")),
+    path("logs/", include("api.logs.urls")),
     path("health/", include("api.health_check.urls")),
 ]
@@ -0,0 +1,80 @@
+import copy
+import random
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from utils.alarm_utils import AlarmMapEngine, update_alarm_map
+
+
+def create_alarm_payload(num_rows: int, num_alarms: int, seed: int) -> list[tuple[int, dict | None]]:
+    """Rows like in a device payload: most of them have no alarms, some alarms come and go."""
+    rnd = random.Random(seed)
+    alarm_names = [f"Alarm {i}" for i in range(num_alarms)]
+    rows = []
+    ts = 1700000000000
+    for _ in range(num_rows):
+        ts += 60000
+        if rnd.random() < 0.8:
+            rows.append((ts, None))
+            continue
+        alarm_dict = {}
+        for alarm_name in rnd.sample(alarm_names, rnd.randint(1, 3)):
+            alarm_dict[alarm_name] = rnd.choice([{}, {"st": "in"}, {"st": "out"}])
+        rows.append((ts, alarm_dict))
+    return rows
+
+
+def create_instance(num_alarms: int):
+    errors = {
+        f"Alarm {i}": {"persist": i % 2 == 0, "st": "out", "lastInPayloadTs": 0, "lastTransTs": 0}
+        for i in range(num_alarms)
+    }
+    return SimpleNamespace(errors=errors, warnings={}, update_fields=set())
+
+
+class Command(BaseCommand):
+    help = "Compares per-timestamp 'update_alarm_map' calls with one 'AlarmMapEngine' per payload."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000)
+        parser.add_argument("--alarms", type=int, nargs="+", default=[5, 20, 100], help="alarms in the map")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'alarms':>7} {'per ts, ms':>11} {'engine, ms':>11} {'speed-up':>9}")
+        for num_alarms in options["alarms"]:
+            rows = create_alarm_payload(options["rows"], num_alarms, options["seed"])
+            per_ts_ms, per_ts_result = self.measure(self.run_per_ts, num_alarms, rows, options["repeat"])
+            engine_ms, engine_result = self.measure(self.run_engine, num_alarms, rows, options["repeat"])
+            if per_ts_result != engine_result:
+                raise RuntimeError(f"Results differ for {num_alarms} alarms")
+            self.stdout.write(
+                f"{num_alarms:>7} {per_ts_ms:>11.1f} {engine_ms:>11.1f} {per_ts_ms / engine_ms:>8.1f}x"
+            )
+
+    def measure(self, func, num_alarms, rows, repeat):
+        best_ms = None
+        for _ in range(repeat):
+            instance = create_instance(num_alarms)
+            log = []
+            started_at = time.perf_counter()
+            func(instance, rows, lambda *args: log.append(args[:3] + args[4:]))
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            best_ms = elapsed_ms if best_ms is None else min(best_ms, elapsed_ms)
+        return best_ms, (copy.deepcopy(instance.errors), log)
+
+    def run_per_ts(self, instance, rows, add_to_log):
+        for ts, alarm_dict in rows:
+            upd_error_map, _ = update_alarm_map(instance, alarm_dict, ts, "errors", True, add_to_log=add_to_log)
+            if upd_error_map != instance.errors:
+                instance.errors = upd_error_map
+                instance.update_fields.add("errors")
+
+    def run_engine(self, instance, rows, add_to_log):
+        engine = AlarmMapEngine(instance, "errors", add_to_log=add_to_log)
+        for ts, alarm_dict in rows:
+            engine.apply(alarm_dict, ts, True)
+        engine.save_to_instance()
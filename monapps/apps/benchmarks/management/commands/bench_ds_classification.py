@@ -0,0 +1,103 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.datastreams.models import Datastream
+from apps.datatypes.models import DataType
+from apps.dsreadings.models import DsReading, UnusedDsReading, InvalidDsReading, NonRocDsReading
+from common.constants import DataAggrTypes, VariableTypes
+from utils.dsr_utils import create_ds_values
+
+
+def run_previous_path(pairs_ts_value: dict[int, float], ds: Datastream, now: int) -> list[int]:
+    """What 'create_ds_readings' did before the columnar path (the ROC base point is the first reading)."""
+    ds_readings = []
+    unused_ds_readings = []
+    for ts, val in pairs_ts_value.items():
+        if ts > ds.ts_to_start_with and ts < now:
+            ds_readings.append(DsReading(time=ts, value=val, datastream=ds))
+        else:
+            unused_ds_readings.append(UnusedDsReading(time=ts, value=val, datastream=ds))
+
+    valid_ds_readings = []
+    invalid_ds_readings = []
+    for r in ds_readings:
+        if r.value <= ds.max_plausible_value and r.value >= ds.min_plausible_value:
+            valid_ds_readings.append(r)
+        else:
+            invalid_ds_readings.append(InvalidDsReading(time=r.time, value=r.value, datastream=r.datastream))
+
+    sorted_ds_readings = sorted(valid_ds_readings, key=lambda r: r.time)
+    non_roc_ds_readings = []
+    if len(sorted_ds_readings) > 0:
+        prev_filt_val = sorted_ds_readings[0].value
+        prev_filt_ts = sorted_ds_readings[0].time
+        for r in sorted_ds_readings:
+            sign = 1
+            if r.value - prev_filt_val < 0:
+                sign = -1
+            limit_value = prev_filt_val + sign * ds.max_rate_of_change * (r.time - prev_filt_ts) / 1000
+            if (sign > 0 and limit_value < r.value) or (sign < 0 and limit_value > r.value):
+                non_roc_ds_readings.append(NonRocDsReading(time=r.time, value=r.value, datastream=r.datastream))
+                r.value = limit_value
+            prev_filt_val = r.value
+            prev_filt_ts = r.time
+
+    return [len(sorted_ds_readings), len(unused_ds_readings), len(invalid_ds_readings), len(non_roc_ds_readings)]
+
+
+def run_columnar_path(pairs_ts_value: dict[int, float], ds: Datastream, now: int) -> list[int]:
+    all_ds_values = create_ds_values(pairs_ts_value, ds, now)
+    for ds_values in all_ds_values:
+        list(ds_values.rows(ds.pk))  # what is done at write time
+    return [len(ds_values) for ds_values in all_ds_values]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the classification of datastream values (unused, invalid, non-ROC) by the columnar path "
+        "with the previous path that created a model instance per value. Nothing is written into the db."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000, 10000])
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        data_type = DataType(name="Temperature", agg_type=DataAggrTypes.AVG, var_type=VariableTypes.CONTINUOUS)
+        ds = Datastream(pk=1, name="temp", data_type=data_type, max_rate_of_change=0.5, max_plausible_value=80)
+        rnd = random.Random(options["seed"])
+        now = 1700000000000
+
+        self.stdout.write(f"{'rows':>7} {'previous, ms':>13} {'columnar, ms':>13} {'speedup':>8}")
+        for num_rows in options["rows"]:
+            start_ts = now - num_rows * 1000
+            ds.ts_to_start_with = start_ts + num_rows * 100  # ~10% unused
+            ds.last_reading_ts = ds.last_reading_value = None
+            value = 20.0
+            pairs_ts_value = {}
+            for idx in range(num_rows):
+                value += rnd.gauss(0, 0.5)
+                pairs_ts_value[start_ts + idx * 1000] = value if rnd.random() > 0.02 else 1000.0  # ~2% invalid
+
+            # the base point is the first reading in both paths
+            first_used_ts = next(ts for ts in pairs_ts_value if ts > ds.ts_to_start_with)
+            ds.last_reading_ts = first_used_ts - 1
+            ds.last_reading_value = pairs_ts_value[first_used_ts]
+
+            best = {}
+            counts = {}
+            for name, func in (("previous", run_previous_path), ("columnar", run_columnar_path)):
+                for _ in range(options["repeat"]):
+                    started_at = time.perf_counter()
+                    counts[name] = func(pairs_ts_value, ds, now)
+                    elapsed_s = time.perf_counter() - started_at
+                    best[name] = min(best.get(name, elapsed_s), elapsed_s)
+            if counts["previous"] != counts["columnar"]:
+                raise RuntimeError(f"Different results: {counts['previous']} and {counts['columnar']}")
+            self.stdout.write(
+                f"{num_rows:>7} {best['previous'] * 1000:>13.2f} {best['columnar'] * 1000:>13.2f} "
+                f"{best['previous'] / best['columnar']:>8.1f}"
+            )
@@ -0,0 +1,138 @@
+import base64
+import json
+import math
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from services.frame_decoders import frame_decoders
+from services.payload_decoding import decode_chirpstack_message, decode_dev_payload, json_loads
+
+# the tables of 'chirpstack_codecs/Enless_diagn_kit.js'
+RX_UNITS = {
+    "temp1": {"scale": 0.1, "signed": True},
+    "temp2": {"scale": 0.1, "signed": True},
+    "humidity": {"scale": 0.1},
+    "voc": {},
+    "co2": {},
+    "pulse_ch1": {"length": 4},
+    "pulse_ch2": {"length": 4},
+    "pulse_oc": {"length": 4},
+    "current": {"scale": 0.001},
+}
+PULSES = ["pulse_ch1", "pulse_ch2", "pulse_oc"]
+RX = [[], [], [], [], ["temp1", "humidity"], ["temp1", "humidity", "voc"], ["temp1", "humidity", "voc", "co2"]]
+RX += [["temp1"], PULSES, PULSES, PULSES, PULSES, ["temp1", "temp2"], ["current"], ["temp1", "humidity"]]
+RX += [["temp1"], ["temp1"], ["temp1", "temp2"]]
+VALID_RANGES = {12: (-100, 400), 13: (3.6, 20.4)}
+
+
+def read_bytes(offset: int, size: int, frame: bytes) -> int:
+    value = 0
+    for i in range(size):
+        value <<= 8
+        value += frame[offset + i]
+    return value
+
+
+def decode_as_js_codec(frame: bytes) -> dict:
+    """A line-by-line port of the JS codec (the values are filled for all sensor types)."""
+    sensor_type = read_bytes(3, 1, frame)
+    row = {}
+    offset = 6
+    for ds_name in RX[sensor_type]:
+        unit = RX_UNITS[ds_name]
+        length = unit.get("length", 2)
+        value = read_bytes(offset, length, frame)
+        if unit.get("signed"):
+            complement = 1 << (length * 8 - 1)
+            if value > complement:
+                value -= complement * 2
+        scal_value = math.floor(value * unit.get("scale", 1) * 10 + 0.5) / 10  # 'Math.round'
+        valid_range = VALID_RANGES.get(sensor_type)
+        if valid_range is not None and (scal_value > valid_range[1] or scal_value < valid_range[0]):
+            row[ds_name] = {"e": {"Sensor broken": {}}}
+        else:
+            row[ds_name] = {"v": scal_value}
+        offset += length
+    return row
+
+
+def create_frames(num_frames: int, seed: int) -> list[bytes]:
+    rnd = random.Random(seed)
+    frames = []
+    for _ in range(num_frames):
+        sensor_type = rnd.randint(4, 17)
+        frame = bytearray(b"\x01\x02\x03" + bytes((sensor_type,)) + b"\x00\x00")
+        for ds_name in RX[sensor_type]:
+            length = RX_UNITS[ds_name].get("length", 2)
+            frame += rnd.getrandbits(length * 8).to_bytes(length, "big")
+        frames.append(bytes(frame))
+    return frames
+
+
+def create_events(frames: list[bytes], with_object: bool) -> list[bytes]:
+    events = []
+    for idx, frame in enumerate(frames):
+        event = {
+            "deviceInfo": {"deviceProfileName": "Enless diagnostic kit", "devEui": "0123456789ABCDEF"},
+            "time": f"2024-01-01T00:{idx // 60 % 60:02d}:{idx % 60:02d}.123456+00:00",
+            "fPort": 1,
+            "data": base64.b64encode(frame).decode("ascii"),
+        }
+        if with_object:  # what the JS codec adds in Chirpstack
+            event["object"] = {str(1704067200000 + idx): decode_as_js_codec(frame)}
+        events.append(json.dumps(event).encode("utf-8"))
+    return events
+
+
+def decode_events(events: list[bytes]) -> int:
+    num_values = 0
+    for event in events:
+        for _, dev_payload in decode_chirpstack_message(json_loads(event)):
+            num_values += sum(len(values) for values in decode_dev_payload(dev_payload).values.values())
+    return num_values
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the decoding of LoRaWAN frames (Enless diagnostic kit) by the table-driven frame decoder "
+        "and by a port of the JS codec loop, and of whole Chirpstack uplink events with the values taken "
+        "from 'object' (codec mode) or decoded from 'data' (raw mode). Nothing is written into the db."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--frames", type=int, default=100000)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        frames = create_frames(options["frames"], options["seed"])
+        decoder = frame_decoders["enless_diagn_kit"]
+        for frame in frames:
+            if decoder.decode(frame) != decode_as_js_codec(frame):
+                raise RuntimeError(f"Different results for the frame {frame.hex()}")
+
+        self.stdout.write(f"{len(frames)} frames, {sum(len(frame) for frame in frames)} bytes")
+        self.stdout.write(f"{'path':<22} {'best, ms':>10} {'frames/s':>12}")
+        self.report("JS codec port", lambda: [decode_as_js_codec(frame) for frame in frames], len(frames), options)
+        self.report("table decoder", lambda: [decoder.decode(frame) for frame in frames], len(frames), options)
+
+        codec_events = create_events(frames, with_object=True)
+        raw_events = create_events(frames, with_object=False)
+        with override_settings(MQTT_SUB_CHIRPSTACK_DECODING="codec"):
+            self.report("events, codec mode", lambda: decode_events(codec_events), len(frames), options)
+        with override_settings(MQTT_SUB_CHIRPSTACK_DECODING="raw"):
+            self.report("events, raw mode", lambda: decode_events(raw_events), len(frames), options)
+
+    def report(self, name: str, func, num_frames: int, options: dict):
+        best = None
+        for _ in range(options["repeat"]):
+            started_at = time.perf_counter()
+            func()
+            elapsed_s = time.perf_counter() - started_at
+            best = elapsed_s if best is None else min(best, elapsed_s)
+        self.stdout.write(f"{name:<22} {best * 1000:>10.1f} {num_frames / best:>12.0f}")
+
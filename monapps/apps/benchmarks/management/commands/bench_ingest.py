@@ -0,0 +1,279 @@
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import setup_databases, teardown_databases
+
+from apps.datastreams.models import Datastream
+from apps.datatypes.models import DataType
+from apps.devices.models import Device
+from apps.dsreadings.models import DsReading, UnusedDsReading, InvalidDsReading, NonRocDsReading, NoDataMarker
+from apps.mqtt_sub.management.commands.run_mqtt_sub import on_message
+from common.constants import DataAggrTypes, VariableTypes
+from services.device_config_cache import device_config_cache
+from services.duplicate_filter import duplicate_filter
+from services.ingest_router import IngestRouter
+from services.ingest_worker_pool import IngestWorkerPool, process_dev_payload
+from services.log_store import log_store
+from utils.ts_utils import create_now_ts_ms
+
+TOPIC = "rawdata/bench"
+PERIOD_MS = 10000  # between two rows of a device
+READING_MODELS = (DsReading, UnusedDsReading, InvalidDsReading, NonRocDsReading, NoDataMarker)
+
+
+class QueryCounter:
+    """Counts the queries of all the connections (every worker thread has its own one)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.num_queries += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, **kwargs):
+        conn = kwargs.get("connection", connection)  # is sent with 'connection_created'
+        if self not in conn.execute_wrappers:
+            conn.execute_wrappers.append(self)
+
+    def uninstall(self):
+        if self in connection.execute_wrappers:
+            connection.execute_wrappers.remove(self)
+
+
+class SyntheticFleet:
+    """
+    N devices with M datastreams each, a share of the datastreams is RBE (values only when they change),
+    the rest are periodic (a value in every row). Rows get datastream errors and device warnings
+    with 'alarm_density', every 'backlog_every'-th message of a device is a burst of 'backlog_rows' rows
+    (a device that was offline).
+    """
+
+    def __init__(self, prefix: str, num_devices: int, num_dss: int, rbe_share: float, alarm_density: float, seed: int):
+        self.rnd = random.Random(seed)
+        self.dev_uis = [f"{prefix}{idx:012x}" for idx in range(num_devices)]
+        self.ds_names = [f"ds{idx}" for idx in range(num_dss)]
+        self.rbe_ds_names = set(self.ds_names[: round(num_dss * rbe_share)])
+        self.alarm_density = alarm_density
+        self.next_tss = {}
+        self.values = {}
+
+    def create_in_db(self):
+        periodic_type, _ = DataType.objects.get_or_create(
+            name="Bench temperature", defaults={"agg_type": DataAggrTypes.AVG, "var_type": VariableTypes.CONTINUOUS}
+        )
+        rbe_type, _ = DataType.objects.get_or_create(
+            name="Bench state", defaults={"agg_type": DataAggrTypes.LAST, "var_type": VariableTypes.DISCRETE}
+        )
+        for dev_ui in self.dev_uis:
+            dev = Device(name=f"Bench {dev_ui}", dev_ui=dev_ui)
+            dev.save()
+            for ds_name in self.ds_names:
+                is_rbe = ds_name in self.rbe_ds_names
+                Datastream(
+                    name=ds_name,
+                    parent=dev,
+                    data_type=rbe_type if is_rbe else periodic_type,
+                    is_rbe=is_rbe,
+                    time_update=None if is_rbe else PERIOD_MS,
+                    max_rate_of_change=10.0,
+                ).save()
+
+    def create_rows(self, dev_ui: str, num_rows: int) -> dict:
+        rnd = self.rnd
+        ts = self.next_tss.get(dev_ui, create_now_ts_ms() - 30 * 24 * 3600 * 1000)
+        values = self.values.setdefault(dev_ui, {ds_name: 20.0 for ds_name in self.ds_names})
+        rows = {}
+        for _ in range(num_rows):
+            ts += PERIOD_MS
+            row = {}
+            for ds_name in self.ds_names:
+                if ds_name in self.rbe_ds_names:
+                    if rnd.random() < 0.3:
+                        values[ds_name] = float(rnd.randint(0, 3))
+                        row[ds_name] = {"v": values[ds_name]}
+                else:
+                    values[ds_name] += rnd.gauss(0, 0.5)
+                    row[ds_name] = {"v": round(values[ds_name], 2)}
+                if rnd.random() < self.alarm_density:
+                    row.setdefault(ds_name, {})["e"] = {"Sensor error": {"st": rnd.choice(("in", "out"))}}
+            if rnd.random() < self.alarm_density:
+                row["w"] = {"Low battery": {}}
+            rows[str(ts)] = row
+        self.next_tss[dev_ui] = ts
+        return rows
+
+    def create_messages(
+        self, num_messages: int, devs_per_message: int, backlog_every: int, backlog_rows: int
+    ) -> list[bytes]:
+        messages = []
+        num_sent = {}
+        for _ in range(num_messages):
+            payload = {}
+            for dev_ui in self.rnd.sample(self.dev_uis, devs_per_message):
+                num_sent[dev_ui] = num_sent.get(dev_ui, 0) + 1
+                is_backlog = backlog_every > 0 and num_sent[dev_ui] % backlog_every == 0
+                payload[dev_ui] = self.create_rows(dev_ui, backlog_rows if is_backlog else 1)
+            messages.append(json.dumps(payload).encode("utf-8"))
+        return messages
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark of the ingestion: a synthetic fleet sends messages that are processed by 'RawDataProcessor' "
+        "directly ('direct') or through 'on_message' and the worker pool ('mqtt', a stand-in for the broker). "
+        "Reports throughput, latencies, db queries and rows/s. A throwaway test db of the configured "
+        "engine (SQLite or PostgreSQL) is created and destroyed, the main db is not touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", choices=["direct", "mqtt"], nargs="+", default=["direct", "mqtt"])
+        parser.add_argument("--devices", type=int, default=100)
+        parser.add_argument("--datastreams", type=int, default=4, help="per device")
+        parser.add_argument("--rbe-share", type=float, default=0.25, help="share of RBE datastreams")
+        parser.add_argument("--alarm-density", type=float, default=0.02, help="probability of an alarm in a row")
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--devs-per-message", type=int, default=1)
+        parser.add_argument("--backlog-every", type=int, default=0, help="every N-th payload of a device is a burst")
+        parser.add_argument("--backlog-rows", type=int, default=100)
+        parser.add_argument("--workers", type=int, default=4, help="worker threads in the 'mqtt' mode")
+        parser.add_argument("--batch-window-ms", type=int, default=0)
+        parser.add_argument(
+            "--rate", type=float, default=0, help="messages/s offered in the 'mqtt' mode, 0 - as fast as possible"
+        )
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        db_dir = None
+        if connection.vendor == "sqlite":
+            # a file instead of the in-memory db, so the worker threads can share it,
+            # the transactions take the write lock right away instead of failing on the upgrade
+            db_dir = tempfile.TemporaryDirectory()
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(db_dir.name, "bench_ingest.sqlite3")
+            connection.settings_dict["OPTIONS"]["transaction_mode"] = "IMMEDIATE"
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        query_counter = QueryCounter()
+        connection_created.connect(query_counter.install)
+        try:
+            self.stdout.write(f"db: {connection.vendor}")
+            self.stdout.write(
+                f"{'mode':<7} {'time, s':>8} {'msgs/s':>8} {'payloads/s':>11} {'txns':>8} {'rows/s':>8} "
+                f"{'p50, ms':>8} {'p99, ms':>8} {'queries':>8} {'q/payload':>9}"
+            )
+            for idx, mode in enumerate(options["mode"]):
+                self.run_mode(mode, f"{idx:04x}", query_counter, options)
+        finally:
+            connection_created.disconnect(query_counter.install)
+            query_counter.uninstall()
+            teardown_databases(old_config, verbosity=0)
+            if db_dir is not None:
+                db_dir.cleanup()
+
+    def run_mode(self, mode: str, prefix: str, query_counter: QueryCounter, options: dict):
+        fleet = SyntheticFleet(
+            prefix,
+            options["devices"],
+            options["datastreams"],
+            options["rbe_share"],
+            options["alarm_density"],
+            options["seed"],
+        )
+        fleet.create_in_db()
+        messages = fleet.create_messages(
+            options["messages"], options["devs_per_message"], options["backlog_every"], options["backlog_rows"]
+        )
+        device_config_cache.invalidate()
+        duplicate_filter.clear()
+        num_readings_before = sum(model.objects.count() for model in READING_MODELS)
+
+        query_counter.install()
+        num_queries_before = query_counter.num_queries
+        log_store.start_flusher()  # as in the subscriber
+        if mode == "direct":
+            elapsed_s, latencies_ms, num_payloads, num_txns = self.run_direct(messages)
+        else:
+            elapsed_s, latencies_ms, num_payloads, num_txns = self.run_mqtt(messages, options)
+        log_store.stop_flusher()
+        num_queries = query_counter.num_queries - num_queries_before
+        query_counter.uninstall()
+
+        num_readings = sum(model.objects.count() for model in READING_MODELS) - num_readings_before
+        p50, p99 = self.get_percentiles(latencies_ms)
+        self.stdout.write(
+            f"{mode:<7} {elapsed_s:>8.2f} {len(messages) / elapsed_s:>8.0f} {num_payloads / elapsed_s:>11.0f} "
+            f"{num_txns:>8} {num_readings / elapsed_s:>8.0f} {p50:>8.1f} {p99:>8.1f} {num_queries:>8} "
+            f"{num_queries / max(num_payloads, 1):>9.1f}"
+        )
+
+    def run_direct(self, messages: list[bytes]) -> tuple[float, list[float], int, int]:
+        latencies_ms = []
+        started_at = time.perf_counter()
+        for message in messages:
+            for dev_ui, dev_payload in json.loads(message).items():
+                payload_started_at = time.perf_counter()
+                process_dev_payload(dev_ui, dev_payload)
+                latencies_ms.append((time.perf_counter() - payload_started_at) * 1000)
+        return time.perf_counter() - started_at, latencies_ms, len(latencies_ms), len(latencies_ms)
+
+    def run_mqtt(self, messages: list[bytes], options: dict) -> tuple[float, list[float], int, int]:
+        """
+        The payloads are counted as received (as in the 'direct' mode), the queued payloads of a device
+        can be merged and written in one transaction ('txns').
+        The latency is from 'on_message' till the payload is processed (the oldest one of a batch).
+        Without '--rate' the queues are full most of the time, so the latencies are mostly the waiting in them.
+        """
+        sent_at = {}  # {(dev_ui, first ts key): time}
+        latencies_ms = []
+        message_keys = [
+            [(dev_ui, next(iter(dev_payload))) for dev_ui, dev_payload in json.loads(message).items()]
+            for message in messages
+        ]
+        lock = threading.Lock()
+
+        def process(dev_ui: str, dev_payload: dict):
+            outcome = process_dev_payload(dev_ui, dev_payload)
+            with lock:
+                if (started_at := sent_at.get((dev_ui, next(iter(dev_payload), None)))) is not None:
+                    latencies_ms.append((time.perf_counter() - started_at) * 1000)
+            return outcome
+
+        pool = IngestWorkerPool(
+            process,
+            num_workers=options["workers"],
+            policy="block",
+            stats_interval_s=0,
+            batch_window_ms=options["batch_window_ms"],
+        )
+        router = IngestRouter(pool, 0, 1)
+        pool.start()
+        started_at = time.perf_counter()
+        for idx, (message, keys) in enumerate(zip(messages, message_keys)):
+            if options["rate"] > 0 and (delay_s := started_at + idx / options["rate"] - time.perf_counter()) > 0:
+                time.sleep(delay_s)
+            now = time.perf_counter()
+            with lock:
+                for key in keys:
+                    sent_at[key] = now
+            on_message(None, router, SimpleNamespace(topic=TOPIC, payload=message))
+        pool.wait_until_processed()
+        elapsed_s = time.perf_counter() - started_at
+        pool.stop()
+        counters = pool.counters.snapshot()
+        return elapsed_s, latencies_ms, counters["received"], counters["batches"]
+
+    def get_percentiles(self, latencies_ms: list[float]) -> tuple[float, float]:
+        if len(latencies_ms) < 2:
+            return (latencies_ms[0], latencies_ms[0]) if len(latencies_ms) == 1 else (0.0, 0.0)
+        quantiles = statistics.quantiles(latencies_ms, n=100)
+        return quantiles[49], quantiles[98]
@@ -0,0 +1,129 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from services import payload_decoding
+from services.payload_decoding import decode_dev_payload, get_json_loads, orjson
+
+TOPIC = "rawdata/site/building"
+
+
+def create_messages(num_messages: int, num_devs: int, num_rows: int, num_dss: int, seed: int) -> list[bytes]:
+    rnd = random.Random(seed)
+    messages = []
+    ts = 1700000000000
+    for _ in range(num_messages):
+        payload = {}
+        for dev_idx in range(num_devs):
+            dev_payload = {}
+            for row_idx in range(num_rows):
+                row = {f"ds{ds_idx}": {"v": round(rnd.uniform(0, 100), 2)} for ds_idx in range(num_dss)}
+                if rnd.random() < 0.1:
+                    row["ds0"]["e"] = {"Sensor error": {"st": "in"}}
+                if rnd.random() < 0.05:
+                    row["w"] = {"Low battery": {}}
+                dev_payload[str(ts + row_idx * 1000)] = row
+            payload[f"{dev_idx:016X}"] = dev_payload
+        ts += num_rows * 1000
+        messages.append(json.dumps(payload).encode("utf-8"))
+    return messages
+
+
+def run_previous_path(messages: list[bytes], ds_names: list[str]) -> int:
+    """What 'on_message' and 'RawDataProcessor' did before the decoders."""
+    num_values = 0
+    for msg_payload in messages:
+        payload = json.loads(str(msg_payload.decode("utf-8")))
+        for dev_ui, dev_payload in payload.items():
+            if type(dev_payload) is not dict:
+                continue
+            dev_ui = dev_ui.lower()
+            int_key_payload = {}
+            for k, v in dev_payload.items():
+                try:
+                    int_key_payload[int(k)] = v
+                except ValueError:
+                    pass
+            int_key_payload = dict(sorted(int_key_payload.items()))
+            for ts, row in int_key_payload.items():
+                for ds_name in ds_names:
+                    if (ds_row := row.get(ds_name)) is None:
+                        ds_row = {}
+                    new_value = ds_row.get("v")
+                    if new_value is not None and isinstance(new_value, (int, float)):
+                        num_values += 1
+                    ds_row.get("e")
+                    ds_row.get("w")
+                    ds_row.get("i")
+                row.get("e")
+                row.get("w")
+                row.get("i")
+    return num_values
+
+
+def run_decoders(messages: list[bytes], ds_names: list[str]) -> int:
+    num_values = 0
+    no_alarms = {}
+    for msg_payload in messages:
+        for dev_ui, dev_payload in payload_decoding.message_decoder_registry.decode(TOPIC, msg_payload):
+            decoded = decode_dev_payload(dev_payload)
+            ds_columns = [
+                (decoded.values.get(ds_name), decoded.ds_alarm_rows.get(ds_name, no_alarms)) for ds_name in ds_names
+            ]
+            for idx, ts in enumerate(decoded.tss):
+                for ds_values, ds_alarm_rows in ds_columns:
+                    if ds_values is not None and ds_values[idx] is not None:
+                        num_values += 1
+                    ds_alarm_rows.get(ts, no_alarms)
+                decoded.dev_alarm_rows.get(ts, no_alarms)
+    return num_values
+
+
+class Command(BaseCommand):
+    help = "Compares decoding of rawdata messages by the decoders with the previous 'json.loads' + dict walking path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=200)
+        parser.add_argument("--devices", type=int, default=5, help="devices per message")
+        parser.add_argument("--rows", type=int, default=60, help="timestamps per device")
+        parser.add_argument("--datastreams", type=int, default=8)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        messages = create_messages(
+            options["messages"], options["devices"], options["rows"], options["datastreams"], options["seed"]
+        )
+        ds_names = [f"ds{ds_idx}" for ds_idx in range(options["datastreams"])]
+        num_mbytes = sum(len(msg_payload) for msg_payload in messages) / 1e6
+
+        runs = [("previous path", "json", run_previous_path), ("decoders", "json", run_decoders)]
+        if orjson is not None:
+            runs.append(("decoders", "orjson", run_decoders))
+        else:
+            self.stdout.write("'orjson' is not installed, only the 'json' backend is measured")
+
+        self.stdout.write(f"{'path':>14} {'backend':>8} {'time, ms':>9} {'MB/s':>7} {'us/message':>11}")
+        initial_json_loads = payload_decoding.json_loads
+        expected_num_values = None
+        try:
+            for name, backend, func in runs:
+                payload_decoding.json_loads = get_json_loads(backend)
+                best_s = None
+                for _ in range(options["repeat"]):
+                    started_at = time.perf_counter()
+                    num_values = func(messages, ds_names)
+                    elapsed_s = time.perf_counter() - started_at
+                    best_s = elapsed_s if best_s is None else min(best_s, elapsed_s)
+                if expected_num_values is None:
+                    expected_num_values = num_values
+                elif num_values != expected_num_values:
+                    raise RuntimeError(f"'{name}' with '{backend}' found {num_values} values, not {expected_num_values}")
+                self.stdout.write(
+                    f"{name:>14} {backend:>8} {best_s * 1000:>9.1f} {num_mbytes / best_s:>7.1f} "
+                    f"{best_s * 1e6 / len(messages):>11.0f}"
+                )
+        finally:
+            payload_decoding.json_loads = initial_json_loads
@@ -0,0 +1,159 @@
+import json
+import random
+import threading
+import time
+import multiprocessing as mp
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from apps.mqtt_sub.management.commands.run_mqtt_sub import on_message
+from services.ingest_worker_pool import IngestWorkerPool
+from services.ingest_router import IngestRouter
+
+FWD_TOPIC_PREFIX = "monapps/fwd"
+SHARED_TOPIC = "rawdata/loadtest"
+
+
+class StandInBroker:
+    """
+    A minimal broker that runs in a thread of the main process. Messages on the shared topic
+    are delivered to the members of the group in turn (as for '$share/<group>/rawdata/#'),
+    messages on '<fwd prefix>/<idx>' are delivered to the member 'idx' only.
+    """
+
+    def __init__(self, ctx, num_members: int):
+        self.inbox = ctx.Queue()
+        self.member_queues = [ctx.Queue() for _ in range(num_members)]
+        self.next_member_idx = 0
+
+    def run(self):
+        while (msg := self.inbox.get()) is not None:
+            topic, payload = msg
+            if topic.startswith(FWD_TOPIC_PREFIX):
+                self.member_queues[int(topic.rsplit("/", 1)[1])].put(msg)
+            else:
+                self.member_queues[self.next_member_idx].put(msg)
+                self.next_member_idx = (self.next_member_idx + 1) % len(self.member_queues)
+        for q in self.member_queues:
+            q.put(None)
+
+
+class StandInClient:
+    def __init__(self, inbox):
+        self.inbox = inbox
+
+    def publish(self, topic, payload, qos=0):
+        self.inbox.put((topic, payload.encode("utf-8") if isinstance(payload, str) else payload))
+
+
+def run_member(idx, num_members, broker, num_workers, proc_ms, cpu_ms, num_processed, results):
+    dev_uis_processed = set()
+    lock = threading.Lock()
+
+    def process(dev_ui, dev_payload):
+        # 'proc_ms' imitates waiting for the db, 'cpu_ms' imitates the ORM work that holds the GIL
+        time.sleep(proc_ms / 1000)
+        deadline = time.perf_counter() + cpu_ms / 1000
+        while time.perf_counter() < deadline:
+            pass
+        with lock:
+            dev_uis_processed.add(dev_ui)
+        with num_processed.get_lock():
+            num_processed.value += 1
+
+    pool = IngestWorkerPool(process, num_workers=num_workers, queue_size=1000, policy="block", stats_interval_s=0)
+    router = IngestRouter(pool, idx, num_members, FWD_TOPIC_PREFIX)
+    client = StandInClient(broker.inbox)
+    pool.start()
+    q = broker.member_queues[idx]
+    while (msg := q.get()) is not None:
+        topic, payload = msg
+        on_message(client, router, SimpleNamespace(topic=topic, payload=payload))
+    pool.stop()
+    results.put((idx, sorted(dev_uis_processed), pool.counters.snapshot()))
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test of the MQTT subscriber routing with K subscriber processes sharing one subscription. "
+        "A stand-in broker is used, the db processing is imitated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--instances", type=int, nargs="+", default=[1, 2, 4], help="values of K to test")
+        parser.add_argument("--devices", type=int, default=200)
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--devs-per-message", type=int, default=5)
+        parser.add_argument("--workers", type=int, default=4, help="worker threads per process")
+        parser.add_argument("--proc-ms", type=float, default=2.0, help="imitated db time per device payload")
+        parser.add_argument("--cpu-ms", type=float, default=1.0, help="imitated cpu time per device payload")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        dev_uis = [f"{i:016x}" for i in range(options["devices"])]
+        ts = 1700000000000
+        messages = []
+        for _ in range(options["messages"]):
+            ts += 1000
+            msg_dev_uis = random.sample(dev_uis, options["devs_per_message"])
+            payload = {dev_ui: {str(ts): {"temp1": {"v": 20.0}}} for dev_ui in msg_dev_uis}
+            messages.append(json.dumps(payload).encode("utf-8"))
+        num_expected = options["messages"] * options["devs_per_message"]
+
+        self.stdout.write(f"{'K':>3} {'time, s':>9} {'payloads/s':>11} {'forwarded':>10} {'shared devices':>15}")
+        for num_members in options["instances"]:
+            elapsed, num_forwarded, num_shared_devs = self.run_once(num_members, messages, num_expected, options)
+            self.stdout.write(
+                f"{num_members:>3} {elapsed:>9.2f} {num_expected / elapsed:>11.0f} "
+                f"{num_forwarded:>10} {num_shared_devs:>15}"
+            )
+
+    def run_once(self, num_members, messages, num_expected, options):
+        ctx = mp.get_context("fork")
+        broker = StandInBroker(ctx, num_members)
+        num_processed = ctx.Value("i", 0)
+        results = ctx.Queue()
+        members = [
+            ctx.Process(
+                target=run_member,
+                args=(
+                    idx,
+                    num_members,
+                    broker,
+                    options["workers"],
+                    options["proc_ms"],
+                    options["cpu_ms"],
+                    num_processed,
+                    results,
+                ),
+            )
+            for idx in range(num_members)
+        ]
+        for member in members:
+            member.start()
+        broker_thread = threading.Thread(target=broker.run, daemon=True)
+        broker_thread.start()
+
+        started_at = time.perf_counter()
+        for payload in messages:
+            broker.inbox.put((SHARED_TOPIC, payload))
+        while num_processed.value < num_expected:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started_at
+
+        broker.inbox.put(None)
+        member_results = [results.get() for _ in members]
+        for member in members:
+            member.join()
+        broker_thread.join()
+
+        num_forwarded = sum(counters["forwarded"] for _, _, counters in member_results)
+        # a device processed by more than one process means that its rows would be locked by several processes
+        owners = {}
+        for idx, dev_uis, _ in member_results:
+            for dev_ui in dev_uis:
+                owners.setdefault(dev_ui, set()).add(idx)
+        num_shared_devs = sum(1 for idxs in owners.values() if len(idxs) > 1)
+        return elapsed, num_forwarded, num_shared_devs
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datafeeds', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafeed',
+            name='resampling_state',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datafeeds', '0002_datafeed_resampling_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafeed',
+            name='resampled_version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -52,6 +52,10 @@ class Datafeed(PublishingOnSaveModel):
 
     ts_to_start_with = models.BigIntegerField(default=0)
     last_reading_ts = models.BigIntegerField(default=None, null=True, blank=True)
+    # what the previous resampling run has read already, see 'NewDfrCreator'
+    resampling_state = models.JSONField(default=dict, blank=True)
+    # 'data_version' of the datastream at the last resampling run
+    resampled_version = models.BigIntegerField(default=0)
 
     @property
     def is_value_interger(self) -> bool:
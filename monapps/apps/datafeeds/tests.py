@@ -1,3 +1,309 @@
-from django.test import TestCase
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, TransactionTestCase, override_settings
+from django_celery_beat.models import IntervalSchedule
+
+from apps.applications.models import Application, AppType
+from apps.datafeeds.models import Datafeed
+from apps.datastreams.models import Datastream
+from apps.datatypes.models import DataType
+from apps.devices.models import Device
+from apps.dfreadings.models import DfReading
+from services.device_config_cache import device_config_cache
+from services.dfr_dispatch import DfrDispatchNotifier, dfr_dispatch_notifier, get_dirty_app_qs
+from services.new_dfr_creator import NewDfrCreator
+from services.resampling_plan import resampling_counters
+from services.raw_data_processor import RawDataProcessor
+from tasks.create_dirty_dfrs import create_dirty_dfrs
+
+TIME_RESAMPLE = 60000
+
+
+@override_settings(DFR_SHARED_RESAMPLING=False)
+class ResamplingStateTest(TestCase):
+    """Two apps resample the same datastream, one with the resampling state, the other one without it."""
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        data_type = DataType.objects.create(name="Temperature")
+        self.dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        ds = Datastream.objects.create(
+            name="temp1", data_type=data_type, parent=self.dev, time_change=5 * TIME_RESAMPLE, max_rate_of_change=1000
+        )
+        interval = IntervalSchedule.objects.create(every=60, period=IntervalSchedule.SECONDS)
+        app_type = AppType.objects.create(name="Test", func_name="test")
+        self.dfs = []
+        for name in ("with state", "without state"):
+            app = Application.objects.create(
+                type=app_type,
+                time_resample=TIME_RESAMPLE,
+                cursor_ts=0,
+                invoc_interval=interval,
+                catch_up_interval=interval,
+                is_enabled=True,
+            )
+            self.dfs.append(Datafeed.objects.create(name=name, parent=app, datastream=ds, data_type=data_type))
+        self.ts = 1700000000000 - 1700000000000 % TIME_RESAMPLE
+
+    def process_and_resample(self, tss: list[int]):
+        RawDataProcessor(self.dev.dev_ui, {str(ts): {"temp1": {"v": 20 + ts % 7}} for ts in tss}).execute()
+        Datafeed.objects.filter(pk=self.dfs[1].pk).update(resampling_state={})
+        for df in self.dfs:
+            NewDfrCreator(Application.objects.get(pk=df.parent_id)).execute()
+
+    def get_df_readings(self, df: Datafeed) -> list[tuple]:
+        return list(DfReading.objects.filter(datafeed=df).order_by("time").values_list("time", "db_value", "restored"))
+
+    def test_same_df_readings_with_state(self):
+        for step in range(12):
+            self.process_and_resample([self.ts + step * 100000 + offset for offset in (10000, 30000, 50000)])
+        state = Datafeed.objects.get(pk=self.dfs[0].pk).resampling_state
+        self.assertGreater(len(state["tss"]), 0)
+        self.assertEqual(len(state["prev_dfrs"]), 3)
+        self.assertGreater(len(self.get_df_readings(self.dfs[0])), 12)
+        self.assertEqual(self.get_df_readings(self.dfs[0]), self.get_df_readings(self.dfs[1]))
+
+    def test_first_readings_are_not_backfills(self):
+        self.process_and_resample([self.ts + 10000, self.ts + 50000])
+        self.process_and_resample([self.ts + 110000])
+        self.assertEqual(Datastream.objects.get(name="temp1").num_backfills, 0)
+        self.assertEqual(self.get_df_readings(self.dfs[0]), self.get_df_readings(self.dfs[1]))
+
+    def test_late_readings_invalidate_state(self):
+        for step in range(6):
+            self.process_and_resample([self.ts + step * 100000 + 10000, self.ts + step * 100000 + 50000])
+        num_backfills = Datastream.objects.get(name="temp1").num_backfills
+        state = Datafeed.objects.get(pk=self.dfs[0].pk).resampling_state
+
+        # a reading among the ones kept in the state
+        Datastream.objects.filter(name="temp1").update(ts_to_start_with=state["start_rts"])
+        self.process_and_resample([state["tss"][-1] - 1000])
+        self.assertEqual(Datastream.objects.get(name="temp1").num_backfills, num_backfills + 1)
+        for step in range(6, 9):
+            self.process_and_resample([self.ts + step * 100000 + 10000])
+        self.assertEqual(self.get_df_readings(self.dfs[0]), self.get_df_readings(self.dfs[1]))
+
+
+class DirtyDatafeedTest(TestCase):
+    def setUp(self):
+        device_config_cache.invalidate()
+        data_type = DataType.objects.create(name="Temperature")
+        self.dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        self.ds = Datastream.objects.create(
+            name="temp1", data_type=data_type, parent=self.dev, time_change=5 * TIME_RESAMPLE, max_rate_of_change=1000
+        )
+        interval = IntervalSchedule.objects.create(every=60, period=IntervalSchedule.SECONDS)
+        self.app = Application.objects.create(
+            type=AppType.objects.create(name="Test", func_name="test"),
+            time_resample=TIME_RESAMPLE,
+            cursor_ts=0,
+            invoc_interval=interval,
+            catch_up_interval=interval,
+            is_enabled=True,
+        )
+        self.df = Datafeed.objects.create(name="temp", parent=self.app, datastream=self.ds, data_type=data_type)
+        self.ts = 1700000000000 - 1700000000000 % TIME_RESAMPLE
+
+    def process(self, tss: list[int]):
+        RawDataProcessor(self.dev.dev_ui, {str(ts): {"temp1": {"v": 20}} for ts in tss}).execute()
+
+    def test_ingestion_marks_datafeeds_dirty(self):
+        create_dirty_dfrs()
+        self.assertEqual(list(get_dirty_app_qs()), [])
+
+        with mock.patch.object(dfr_dispatch_notifier, "notify") as notify:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.process([self.ts + offset * 20000 for offset in range(1, 40)])
+        notify.assert_called_once()
+        self.assertEqual(list(get_dirty_app_qs()), [self.app])
+
+        create_dirty_dfrs()
+        self.assertEqual(list(get_dirty_app_qs()), [])
+        self.assertGreater(DfReading.objects.filter(datafeed=self.df).count(), 0)
+
+        # nothing new, the datafeed is not resampled by the periodic run
+        with mock.patch.object(NewDfrCreator, "create_df_readings_for_ind_df") as create:
+            NewDfrCreator(self.app).execute()
+        create.assert_not_called()
+
+        # re-pointed to a datastream with a lower 'data_version', reset
+        other_ds = Datastream.objects.create(
+            name="temp2", data_type=self.ds.data_type, parent=self.dev, time_change=5 * TIME_RESAMPLE
+        )
+        for update in ({"datastream": other_ds}, {"datastream": self.ds, "ts_to_start_with": 0}):
+            Datafeed.objects.filter(pk=self.df.pk).update(**update)
+            with mock.patch.object(NewDfrCreator, "create_df_readings_for_ind_df", autospec=True) as create:
+                create.return_value = 1
+                NewDfrCreator(self.app).execute()
+            create.assert_called_once()
+        num_df_readings = DfReading.objects.filter(datafeed=self.df).count()
+        DfReading.objects.filter(datafeed=self.df).delete()  # as the reset is done
+        NewDfrCreator(self.app).execute()
+        self.assertEqual(DfReading.objects.filter(datafeed=self.df).count(), num_df_readings)
+        with mock.patch.object(NewDfrCreator, "create_df_readings_for_ind_df") as create:
+            NewDfrCreator(self.app).execute()
+        create.assert_not_called()
+
+        # the same rows again, nothing is saved
+        with mock.patch.object(dfr_dispatch_notifier, "notify") as notify:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.process([self.ts + offset * 20000 for offset in range(1, 40)])
+        notify.assert_not_called()
+        self.assertEqual(list(get_dirty_app_qs()), [])
+
+    def test_notifications_are_coalesced(self):
+        notifier = DfrDispatchNotifier(interval_ms=1000)
+        now = [100.0]
+        notifier.clock = lambda: now[0]
+        with mock.patch.object(notifier, "send") as send:
+            for offset in (0, 0.2, 0.9):
+                now[0] = 100 + offset
+                notifier.notify()
+            self.assertEqual(send.call_count, 1)
+            now[0] = 101.1
+            notifier.notify()
+            notifier.notify()
+            self.assertEqual(send.call_count, 2)
+            # a failed send does not block the next notification
+            send.side_effect = ConnectionError("no broker")
+            now[0] = 102.2
+            with self.assertLogs("#dfr_dispatch", "ERROR"):
+                notifier.notify()
+            send.side_effect = None
+            notifier.notify()
+            self.assertEqual(send.call_count, 4)
+        self.assertEqual(notifier.num_sent, 3)
+
+        with mock.patch.object(notifier, "send") as send:
+            DfrDispatchNotifier(interval_ms=0).notify()
+            send.assert_not_called()
+
+
+class SharedResamplingTest(TestCase):
+    """Three apps read the same datastream, two of them with the same settings."""
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        data_type = DataType.objects.create(name="Temperature")
+        self.dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        ds = Datastream.objects.create(
+            name="temp1", data_type=data_type, parent=self.dev, time_change=5 * TIME_RESAMPLE, max_rate_of_change=1000
+        )
+        interval = IntervalSchedule.objects.create(every=60, period=IntervalSchedule.SECONDS)
+        app_type = AppType.objects.create(name="Test", func_name="test")
+        self.apps = []
+        self.dfs = []
+        for time_resample in (TIME_RESAMPLE, TIME_RESAMPLE, 2 * TIME_RESAMPLE):
+            app = Application.objects.create(
+                type=app_type,
+                time_resample=time_resample,
+                cursor_ts=0,
+                invoc_interval=interval,
+                catch_up_interval=interval,
+                is_enabled=True,
+            )
+            self.apps.append(app)
+            self.dfs.append(Datafeed.objects.create(name="temp", parent=app, datastream=ds, data_type=data_type))
+        self.ts = 1700000000000 - 1700000000000 % TIME_RESAMPLE
+
+    def get_df_readings(self, df: Datafeed) -> list[tuple]:
+        return list(DfReading.objects.filter(datafeed=df).order_by("time").values_list("time", "db_value", "restored"))
+
+    def test_series_is_shared(self):
+        totals_before = resampling_counters.snapshot()
+        for step in range(4):
+            tss = [self.ts + step * 600000 + offset * 20000 for offset in range(1, 30, 3)]
+            RawDataProcessor(self.dev.dev_ui, {str(ts): {"temp1": {"v": 20 + ts % 7}} for ts in tss}).execute()
+            for app in self.apps:
+                NewDfrCreator(app).execute()
+        totals = resampling_counters.snapshot()
+        # the first app resamples the datafeed of the second one, the third one has another 'time_resample'
+        self.assertEqual(totals["datafeeds"] - totals_before["datafeeds"], 12)
+        self.assertEqual(totals["series"] - totals_before["series"], 8)
+        self.assertGreater(totals["dedup_ratio"], 1)
+        shared_df_readings = self.get_df_readings(self.dfs[1])
+        self.assertGreater(len(shared_df_readings), 0)
+        self.assertEqual(self.get_df_readings(self.dfs[0]), shared_df_readings)
+        self.assertNotEqual(self.get_df_readings(self.dfs[2]), shared_df_readings)
+        states = [Datafeed.objects.get(pk=df.pk).resampling_state for df in self.dfs[:2]]
+        self.assertEqual(states[0], states[1])
+
+        # the same series without sharing
+        df = Datafeed.objects.create(
+            name="temp copy", parent=self.apps[1], datastream=self.dfs[1].datastream, data_type=self.dfs[1].data_type
+        )
+        with override_settings(DFR_SHARED_RESAMPLING=False):
+            NewDfrCreator(self.apps[1]).execute()
+        self.assertEqual(self.get_df_readings(df), shared_df_readings)
+
+
+@override_settings(DFR_SHARED_RESAMPLING=False)
+class ParallelResamplingTest(TransactionTestCase):
+    """The threads have their own db connections, so the data is committed (not a 'TestCase')."""
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        data_type = DataType.objects.create(name="Temperature")
+        self.dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        self.ds_names = [f"temp{idx}" for idx in range(4)]
+        dss = [
+            Datastream.objects.create(
+                name=name, data_type=data_type, parent=self.dev, time_change=5 * TIME_RESAMPLE, max_rate_of_change=1000
+            )
+            for name in self.ds_names
+        ]
+        interval = IntervalSchedule.objects.create(every=60, period=IntervalSchedule.SECONDS)
+        app_type = AppType.objects.create(name="Test", func_name="test")
+        self.apps = []
+        for _ in range(2):
+            app = Application.objects.create(
+                type=app_type,
+                time_resample=TIME_RESAMPLE,
+                cursor_ts=0,
+                invoc_interval=interval,
+                catch_up_interval=interval,
+                is_enabled=True,
+            )
+            self.apps.append(app)
+            for ds in dss:
+                Datafeed.objects.create(name=ds.name, parent=app, datastream=ds, data_type=data_type)
+        self.ts = 1700000000000 - 1700000000000 % TIME_RESAMPLE
+
+    def test_same_df_readings_with_pool(self):
+        create_df_readings_for_ind_df = NewDfrCreator.create_df_readings_for_ind_df
+        lock = threading.Lock()
+        thread_names = set()
+
+        def create_one_at_a_time(creator, *args):
+            thread_names.add(threading.current_thread().name)
+            with lock:  # SQLite takes one writer at a time, PostgreSQL locks the rows only
+                return create_df_readings_for_ind_df(creator, *args)
+
+        for step in range(3):
+            tss = [self.ts + step * 600000 + offset * 20000 for offset in range(1, 30, 3)]
+            row_values = {name: idx for idx, name in enumerate(self.ds_names)}
+            payload = {str(ts): {name: {"v": 20 + ts % 7 + idx} for name, idx in row_values.items()} for ts in tss}
+            RawDataProcessor(self.dev.dev_ui, payload).execute()
+            parallel_creator = NewDfrCreator(self.apps[0], num_workers=4)
+            with mock.patch.object(
+                NewDfrCreator, "create_df_readings_for_ind_df", autospec=True, side_effect=create_one_at_a_time
+            ):
+                parallel_creator.execute()
+            NewDfrCreator(self.apps[1], num_workers=0).execute()
+
+        self.assertGreater(len(thread_names), 0)
+        self.assertTrue(all(name.startswith("dfr_creator") for name in thread_names))
+        df_pks = set(self.apps[0].get_native_df_qs().values_list("pk", flat=True))
+        self.assertEqual(set(parallel_creator.timings), df_pks)
+        for name in self.ds_names:
+            df_readings = [
+                list(
+                    DfReading.objects.filter(datafeed__parent=app, datafeed__name=name)
+                    .order_by("time")
+                    .values_list("time", "db_value")
+                )
+                for app in self.apps
+            ]
+            self.assertGreater(len(df_readings[0]), 0)
+            self.assertEqual(df_readings[0], df_readings[1])
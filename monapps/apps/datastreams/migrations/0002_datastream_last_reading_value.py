@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastreams', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datastream',
+            name='last_reading_value',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastreams', '0002_datastream_last_reading_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datastream',
+            name='reorder_window',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
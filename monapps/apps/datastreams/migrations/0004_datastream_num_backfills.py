@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastreams', '0003_datastream_reorder_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datastream',
+            name='num_backfills',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datastreams', '0004_datastream_num_backfills'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datastream',
+            name='data_version',
+            field=models.BigIntegerField(default=1),
+        ),
+    ]
@@ -65,9 +65,22 @@ class Datastream(PublishingOnSaveModel):
     min_plausible_value = models.FloatField(default=-1000000.0)  # TODO: should be < max_plausible_value
 
     ts_to_start_with = models.BigIntegerField(default=0)  # can be even bigger than 'last_reading_ts'
+    # readings can come late and out of order (e.g. via several LoRa gateways), the readings not older than
+    # 'reorder_window' (ms, from now) are still accepted, 'ts_to_start_with' and resampling do not go past
+    # 'now - reorder_window' (the watermark), 0 - no late readings are accepted
+    reorder_window = models.BigIntegerField(default=0)
 
     # the timestamp of the last valid reading
     last_reading_ts = models.BigIntegerField(default=None, null=True, blank=True)  # only valid reading
+    # the value of the reading at 'last_reading_ts' (after the ROC filter), the base point for the ROC filter
+    # of the next readings, None if unknown (then the base point is taken from the db)
+    last_reading_value = models.FloatField(default=None, null=True, blank=True)
+    # incremented when readings older than 'last_reading_ts' are saved,
+    # the resampling states of the datafeeds (they keep the readings already read) are not valid then
+    num_backfills = models.BigIntegerField(default=0)
+    # incremented when readings or nodata markers are saved, the datafeeds with a smaller 'resampled_version'
+    # have new data to resample (starts with 1, so the datafeeds of the existing datastreams are resampled once)
+    data_version = models.BigIntegerField(default=1)
 
     created_ts = models.BigIntegerField(editable=False)
 
@@ -1,6 +1,7 @@
 from django.db import models
 
 from common.constants import VariableTypes, DataAggrTypes
+from services.device_config_cache import device_config_cache
 
 
 class DataType(models.Model):
@@ -18,6 +19,15 @@ class DataType(models.Model):
     def __str__(self):
         return f"Datatype {self.name}"
 
+    def save(self, **kwargs):
+        super().save(**kwargs)
+        device_config_cache.on_instance_changed(self)
+
+    def delete(self, using=None, keep_parents=False):
+        del_result = super().delete(using, keep_parents)
+        device_config_cache.on_instance_changed(self)
+        return del_result
+
 
 class MeasUnit(models.Model):
     class Meta:
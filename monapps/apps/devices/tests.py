@@ -1,3 +1,238 @@
+import copy
+import random
+from unittest import mock
+
+from django.db import connection
 from django.test import TestCase
 
-# Create your tests here.
+from apps.datatypes.models import DataType
+from apps.datastreams.models import Datastream
+from apps.devices.models import Device
+from apps.dsreadings.models import DsReading, NonRocDsReading, UnusedDsReading
+from common.constants import ProcessingOutcomes
+from services.device_config_cache import device_config_cache
+from services.duplicate_filter import duplicate_filter
+from services.raw_data_processor import RawDataProcessor
+from utils.alarm_utils import AlarmMapEngine
+from utils.ts_utils import create_now_ts_ms
+
+
+# the per-timestamp 'update_alarm_map' that was replaced by 'AlarmMapEngine', kept as the reference
+def update_alarm_map_ref(instance, alarm_dict, ts, alarm_map_type, has_value, add_to_log):
+    log_level = alarm_map_type[:-1].upper()
+    is_nd_marker_needed = False
+    upd_alarm_map = copy.deepcopy(getattr(instance, alarm_map_type))
+    if alarm_dict is not None:
+        for alarm_name, ind_alarm_obj in alarm_dict.items():
+            is_persistent = isinstance(ind_alarm_obj, dict) and (
+                (new_status := str(ind_alarm_obj.get("st")).lower()) == "in" or new_status == "out"
+            )
+            if not is_persistent:
+                new_status = "in"
+            if alarm_name in upd_alarm_map:
+                upd_alarm_map[alarm_name]["persist"] = is_persistent
+                upd_alarm_map[alarm_name]["lastInPayloadTs"] = ts
+                if alarm_map_type == "errors" and new_status == "in" and has_value:
+                    is_nd_marker_needed = True
+                if upd_alarm_map[alarm_name]["st"] != new_status:
+                    upd_alarm_map[alarm_name]["st"] = new_status
+                    upd_alarm_map[alarm_name]["lastTransTs"] = ts
+                    add_to_log(log_level, alarm_name, ts, instance, new_status)
+                    if alarm_map_type == "errors" and new_status == "in":
+                        is_nd_marker_needed = True
+            else:
+                upd_alarm_map[alarm_name] = {
+                    "persist": is_persistent,
+                    "st": new_status,
+                    "lastInPayloadTs": ts,
+                    "lastTransTs": ts,
+                }
+                if new_status == "in":
+                    add_to_log(log_level, alarm_name, ts, instance, "in")
+                    if alarm_map_type == "errors":
+                        is_nd_marker_needed = True
+
+    for alarm_name, ind_alarm_obj in upd_alarm_map.items():
+        if ind_alarm_obj["persist"]:
+            is_out = alarm_map_type == "errors" and ind_alarm_obj["lastInPayloadTs"] < ts and has_value
+        else:
+            is_out = alarm_dict is None or alarm_dict.get(alarm_name) is None
+        if ind_alarm_obj["st"] == "in" and is_out:
+            ind_alarm_obj["st"] = "out"
+            ind_alarm_obj["lastTransTs"] = ts
+            add_to_log(log_level, alarm_name, ts, instance, "out")
+    return upd_alarm_map, is_nd_marker_needed
+
+
+class RawDataProcessorQueryCountTest(TestCase):
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        data_type = DataType.objects.create(name="Temperature")
+        self.dev = Device(name="Diagn kit", dev_ui="0123456789abcdef")
+        self.dev.save()
+        for name in ("temp1", "temp2"):
+            Datastream(name=name, data_type=data_type, parent=self.dev).save()
+        self.ts = 1700000000000
+
+    def process_next_payload(self):
+        self.ts += 1000
+        RawDataProcessor(self.dev.dev_ui, {str(self.ts): {"temp1": {"v": 20.5}, "temp2": {"v": 21.0}}}).execute()
+
+    def test_typical_payload(self):
+        self.process_next_payload()  # warms up the cache
+        self.process_next_payload()  # creates base points for the ROC filter
+        # savepoint, lock the device, lock the datastreams,
+        # for every datastream: save the readings (on SQLite the existing readings are counted before saving),
+        # update the datastream, release the savepoint;
+        # the ROC base points are taken from the datastreams, not from the db
+        with self.assertNumQueries(8 if connection.vendor == "postgresql" else 10):
+            self.process_next_payload()
+
+    def test_out_of_order_payload_gets_roc_base_point_from_db(self):
+        self.process_next_payload()
+        self.process_next_payload()
+        # the readings older than the last one are accepted only if 'ts_to_start_with' is moved back
+        Datastream.objects.filter(parent=self.dev).update(ts_to_start_with=self.ts - 1500)
+        # two more queries for the ROC base points and one more reading (non-ROC) is saved
+        with self.assertNumQueries(11 if connection.vendor == "postgresql" else 14):
+            payload = {str(self.ts - 500): {"temp1": {"v": 30.5}, "temp2": {"v": 21.0}}}
+            RawDataProcessor(self.dev.dev_ui, payload).execute()
+
+        # the base point of 'temp1' is the reading at 'ts - 1000', it is limited by the ROC (1 unit per second)
+        self.assertEqual(
+            DsReading.objects.get(datastream__name="temp1", time=self.ts - 500).db_value, 20.5 + 1.0 * 500 / 1000
+        )
+        self.assertEqual(NonRocDsReading.objects.get(datastream__name="temp1").db_value, 30.5)
+
+    def test_roc_base_point_is_kept_on_datastream(self):
+        self.process_next_payload()
+        RawDataProcessor(self.dev.dev_ui, {str(self.ts + 1000): {"temp1": {"v": 25.0}}}).execute()
+        ds = Datastream.objects.get(parent=self.dev, name="temp1")
+        # the value is limited by the ROC filter
+        self.assertEqual((ds.last_reading_ts, ds.last_reading_value), (self.ts + 1000, 21.5))
+
+    def test_late_readings_are_accepted_within_reorder_window(self):
+        self.process_next_payload()
+        self.process_next_payload()
+        late_payload = {str(self.ts - 500): {"temp1": {"v": 20.5}}}
+        RawDataProcessor(self.dev.dev_ui, late_payload).execute()
+        self.assertEqual(UnusedDsReading.objects.filter(datastream__name="temp1").count(), 1)
+
+        # the watermark is 10 s before the first reading
+        Datastream.objects.filter(parent=self.dev).update(
+            reorder_window=create_now_ts_ms() - self.ts + 10000, ts_to_start_with=0
+        )
+        device_config_cache.invalidate()
+        self.process_next_payload()
+        RawDataProcessor(self.dev.dev_ui, {str(self.ts - 500): {"temp1": {"v": 20.5}}}).execute()
+        self.assertTrue(DsReading.objects.filter(datastream__name="temp1", time=self.ts - 500).exists())
+        self.assertLess(Datastream.objects.get(parent=self.dev, name="temp1").ts_to_start_with, self.ts - 1000)
+
+    def test_config_change_invalidates_cache(self):
+        self.process_next_payload()
+        self.assertEqual(device_config_cache.get_dev_pk(self.dev.dev_ui), (True, self.dev.pk))
+
+        old_dev_ui = self.dev.dev_ui
+        self.dev.dev_ui = "fedcba9876543210"
+        self.dev.save(update_fields={"dev_ui"})
+        self.assertEqual(device_config_cache.get_dev_pk(old_dev_ui), (False, None))
+
+        # the payload for the old 'dev_ui' doesn't reach the device anymore
+        RawDataProcessor(old_dev_ui, {str(self.ts + 1000): {"temp1": {"v": 20.5}}}).execute()
+        self.assertEqual(device_config_cache.get_dev_pk(old_dev_ui), (True, None))
+
+    def test_unknown_devices_are_cached_shortly(self):
+        now_ts = create_now_ts_ms()
+        with mock.patch("services.device_config_cache.create_now_ts_ms", return_value=now_ts) as now:
+            payload = {str(self.ts + 1000): {"temp1": {"v": 20.5}}}
+            self.assertEqual(RawDataProcessor("fedcba9876543210", payload).execute(), ProcessingOutcomes.UNKNOWN_DEVICE)
+            # provisioned in another process (no 'save' here)
+            Device.objects.bulk_create([Device(name="Another kit", dev_ui="fedcba9876543210")])
+            self.assertEqual(device_config_cache.get_dev_pk("fedcba9876543210"), (True, None))
+            now.return_value = now_ts + 2001
+            self.assertEqual(RawDataProcessor("fedcba9876543210", payload).execute(), ProcessingOutcomes.PROCESSED)
+            # the known devices are cached for the full ttl
+            self.assertEqual(device_config_cache.get_dev_pk(self.dev.dev_ui)[0], False)
+            RawDataProcessor(self.dev.dev_ui, payload).execute()
+            now.return_value = now_ts + 60000
+            self.assertEqual(device_config_cache.get_dev_pk(self.dev.dev_ui), (True, self.dev.pk))
+
+
+class DuplicateFilterTest(TestCase):
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        duplicate_filter.clear()
+        data_type = DataType.objects.create(name="Temperature")
+        self.dev = Device(name="Diagn kit", dev_ui="0123456789abcdef")
+        self.dev.save()
+        Datastream(name="temp1", data_type=data_type, parent=self.dev).save()
+
+    def process(self, payload: dict) -> ProcessingOutcomes:
+        with self.captureOnCommitCallbacks(execute=True):  # the rows are recorded on commit
+            return RawDataProcessor(self.dev.dev_ui, payload).execute()
+
+    def test_resent_rows_are_dropped(self):
+        payload = {"1700000001000": {"temp1": {"v": 20.5}}, "1700000002000": {"temp1": {"v": 20.7}}}
+        self.assertEqual(self.process(payload), ProcessingOutcomes.PROCESSED)
+        num_dups = duplicate_filter.stats()["dup_rows"]
+
+        self.assertEqual(self.process(payload), ProcessingOutcomes.DUPLICATE)
+        # a changed value or an alarm is not a re-send
+        payload["1700000001000"]["temp1"]["v"] = 20.6
+        payload["1700000002000"]["w"] = {"Low battery": {}}
+        self.assertEqual(self.process(payload), ProcessingOutcomes.PROCESSED)
+
+        self.assertEqual(UnusedDsReading.objects.count(), 2)
+        stats = duplicate_filter.stats()
+        self.assertEqual(stats["dup_rows"] - num_dups, 2)
+        self.assertEqual(stats["dup_top_devices"], {self.dev.dev_ui: 0.5})
+
+
+class AlarmMapEngineTest(TestCase):
+
+    def create_alarm_dict(self, rnd: random.Random) -> dict | None:
+        if rnd.random() < 0.3:
+            return None
+        alarm_objs = [{}, {"st": "in"}, {"st": "out"}, {"st": "IN"}, "unknown"]
+        return {name: rnd.choice(alarm_objs) for name in rnd.sample(["A", "B", "C", "D"], rnd.randint(0, 3))}
+
+    def test_transitions_match_reference(self):
+        rnd = random.Random(7)
+        for alarm_map_type in ("errors", "warnings"):
+            for _ in range(20):
+                initial_map = {"C": {"persist": True, "st": "in", "lastInPayloadTs": 0, "lastTransTs": 0}}
+                ref_dev = Device(name="Reference", **{alarm_map_type: copy.deepcopy(initial_map)})
+                dev = Device(name="Engine", **{alarm_map_type: copy.deepcopy(initial_map)})
+                ref_log = []
+                log = []
+                engine = AlarmMapEngine(dev, alarm_map_type, add_to_log=lambda *args: log.append(args[:3] + args[4:]))
+
+                for ts in range(1000, 41000, 1000):
+                    alarm_dict = self.create_alarm_dict(rnd)
+                    has_value = rnd.random() < 0.5
+                    ref_map, ref_nd = update_alarm_map_ref(
+                        ref_dev,
+                        alarm_dict,
+                        ts,
+                        alarm_map_type,
+                        has_value,
+                        lambda *args: ref_log.append(args[:3] + args[4:]),
+                    )
+                    setattr(ref_dev, alarm_map_type, ref_map)
+                    self.assertEqual(engine.apply(alarm_dict, ts, has_value), ref_nd)
+                    self.assertEqual(log, ref_log)
+
+                self.assertEqual(getattr(dev, alarm_map_type), initial_map)  # applied to the copy
+                self.assertTrue(engine.save_to_instance())
+                self.assertEqual(getattr(dev, alarm_map_type), getattr(ref_dev, alarm_map_type))
+                self.assertEqual(dev.update_fields, {alarm_map_type})
+
+    def test_unchanged_map_is_not_saved(self):
+        warnings = {"A": {"persist": True, "st": "out", "lastInPayloadTs": 0, "lastTransTs": 0}}
+        dev = Device(name="Engine", warnings=warnings)
+        engine = AlarmMapEngine(dev, "warnings", add_to_log=mock.Mock())
+        engine.apply(None, 1000, has_value=True)
+        self.assertFalse(engine.save_to_instance())
+        self.assertEqual(dev.update_fields, set())
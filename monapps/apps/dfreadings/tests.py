@@ -1,3 +1,260 @@
+import random
+from unittest import mock
+
+import numpy as np
 from django.test import TestCase
+from django_celery_beat.models import IntervalSchedule
+
+from apps.applications.models import Application, AppType
+from apps.datafeeds.models import Datafeed
+from apps.datastreams.models import Datastream
+from apps.datatypes.models import DataType
+from apps.devices.models import Device
+from apps.dfreadings.models import DfReading
+from apps.dsreadings.models import DsReading, NoDataMarker
+from common.constants import AugmentationPolicy, DataAggrTypes, NotToUseDfrTypes, VariableTypes
+from utils.dfr_utils import get_values_to_resample, resample_and_augment_ds_readings, resample_ds_readings
+from utils.dsr_utils import DsValues, fetch_nodata_marker_tss
+from utils.ts_utils import ceil_timestamp, create_grid, floor_timestamp
+
+TIME_RESAMPLE = 60000
+
+
+# the model-based resampling that was replaced by the array-based one, kept as the reference
+def find_average(ds_readings):
+    if len(ds_readings) == 0:
+        return None
+    sum = 0
+    for r in ds_readings:
+        sum += r.value
+    return sum / len(ds_readings)
+
+
+def find_sum(ds_readings):
+    if len(ds_readings) == 0:
+        return None
+    sum = 0
+    for r in ds_readings:
+        sum += r.value
+    return sum
+
+
+def find_last_value(ds_readings):
+    if len(ds_readings) == 0:
+        return None
+    ds_readings.sort(key=lambda r: r.time)
+    return ds_readings[-1].value
+
+
+AGG_FUNCS = {DataAggrTypes.AVG: find_average, DataAggrTypes.SUM: find_sum, DataAggrTypes.LAST: find_last_value}
+
+
+def resample_ds_readings_ref(ds_readings, df, time_resample, agg_func):
+    df_reading_map = {}
+    last_df_reading_rts = 0
+    for r in sorted(ds_readings, key=lambda x: x.time):
+        rts = ceil_timestamp(r.time, time_resample)
+        df_reading_map.setdefault(rts, []).append(r)
+        last_df_reading_rts = rts
+
+    for rts in df_reading_map:
+        agg_value = agg_func(df_reading_map[rts])
+        if agg_value is not None:
+            dfr = DfReading(time=rts, value=agg_value, datafeed=df, restored=False)
+            df_reading_map[rts] = dfr
+            if rts == last_df_reading_rts:
+                dfr.not_to_use = NotToUseDfrTypes.UNCLOSED
+    return df_reading_map
+
+
+def resample_and_augment_ds_readings_ref(ds_readings, df, ds, time_resample, start_rts, agg_func, now_ts):
+    if len(ds_readings) == 0 and df.aug_policy != AugmentationPolicy.TILL_NOW:
+        return {}
+
+    df_reading_map = {}
+    nodata_markers = list(NoDataMarker.objects.filter(datastream__id=ds.pk, time__gt=start_rts).order_by("time"))
+    last_df_reading_rts = None
+    for r in sorted(ds_readings + nodata_markers, key=lambda x: x.time):
+        rts = ceil_timestamp(r.time, time_resample)
+        df_reading_map.setdefault(rts, []).append(r)
+        if isinstance(r, DsReading):
+            last_df_reading_rts = rts
+
+    last_dfr_from_prev_period = DfReading.objects.filter(datafeed__id=df.pk, time=start_rts).order_by("time").first()
+    if last_dfr_from_prev_period is not None:
+        df_reading_map[start_rts] = last_dfr_from_prev_period
+    elif ds.data_type.agg_type == DataAggrTypes.SUM and df.aug_policy == AugmentationPolicy.TILL_NOW:
+        last_dsr = DsReading.objects.filter(datastream__id=ds.pk, time__lte=start_rts).order_by("time").last()
+        last_ndm = NoDataMarker.objects.filter(datastream__id=ds.pk, time__lte=start_rts).order_by("time").last()
+        if last_ndm is None or (last_dsr is not None and last_dsr.time > last_ndm.time):
+            df_reading_map[start_rts] = DfReading(time=start_rts, value=0, datafeed=df, restored=True)
+
+    if df.aug_policy == AugmentationPolicy.TILL_LAST_DF_READING:
+        end_rts = last_df_reading_rts
+    else:
+        end_rts = ceil_timestamp(now_ts - max(ds.till_now_margin, ds.reorder_window), time_resample)
+    grid = create_grid(start_rts + time_resample, end_rts, time_resample)
+
+    last_df_reading_rts = None
+    is_nodata_period = df_reading_map.get(start_rts, None) is None
+    for rts in grid:
+        arr = df_reading_map.get(rts, None)
+        if arr is not None:
+            agg_value = agg_func([r for r in arr if isinstance(r, DsReading)])
+            if agg_value is not None:
+                is_nodata_period = False
+                df_reading_map[rts] = DfReading(time=rts, value=agg_value, datafeed=df, restored=False)
+                last_df_reading_rts = rts
+            else:
+                del df_reading_map[rts]
+            if isinstance(arr[-1], NoDataMarker):
+                is_nodata_period = True
+        elif not is_nodata_period:
+            prev_dfr = df_reading_map.get(rts - time_resample, None)
+            if prev_dfr is not None:
+                if ds.data_type.agg_type == DataAggrTypes.SUM:
+                    dfr = DfReading(time=rts, value=0, datafeed=df, restored=True)
+                else:
+                    dfr = DfReading(time=rts, value=prev_dfr.value, datafeed=df, restored=True)
+                df_reading_map[rts] = dfr
+                last_df_reading_rts = rts
+
+    if df_reading_map.get(start_rts, None) is not None:
+        del df_reading_map[start_rts]
+    if last_df_reading_rts is not None:
+        df_reading_map[last_df_reading_rts].not_to_use = NotToUseDfrTypes.UNCLOSED
+    return df_reading_map
+
+
+class ResamplingTest(TestCase):
+    """
+    The array-based resampling gives the same df readings as the reference on random readings,
+    the sums of the float values should be equal exactly, not only approximately.
+    """
+
+    def setUp(self):
+        self.data_types = {
+            (var_type, agg_type): DataType.objects.create(
+                name=f"Type {var_type} {agg_type}", var_type=var_type, agg_type=agg_type
+            )
+            for var_type in (VariableTypes.CONTINUOUS, VariableTypes.DISCRETE)
+            for agg_type in (DataAggrTypes.AVG, DataAggrTypes.SUM, DataAggrTypes.LAST)
+        }
+        data_type = self.data_types[(VariableTypes.CONTINUOUS, DataAggrTypes.AVG)]
+        dev = Device.objects.create(name="Meter", dev_ui="0123456789abcdef")
+        self.ds = Datastream.objects.create(name="energy", data_type=data_type, parent=dev, is_rbe=True)
+        interval = IntervalSchedule.objects.create(every=60, period=IntervalSchedule.SECONDS)
+        app = Application.objects.create(
+            type=AppType.objects.create(name="Test", func_name="test"),
+            time_resample=TIME_RESAMPLE,
+            cursor_ts=0,
+            invoc_interval=interval,
+            catch_up_interval=interval,
+        )
+        self.df = Datafeed.objects.create(name="energy", parent=app, datastream=self.ds, data_type=data_type)
+
+    def set_data_type(self, var_type: VariableTypes, agg_type: DataAggrTypes):
+        self.ds.data_type = self.df.data_type = self.data_types[(var_type, agg_type)]
+        # the df readings taken from the db get their datafeed from there
+        Datafeed.objects.filter(pk=self.df.pk).update(data_type=self.df.data_type)
+
+    def create_ds_readings(self, rnd: random.Random, start_rts: int, num_points: int) -> list[DsReading]:
+        tss = rnd.sample(range(start_rts + 1, start_rts + num_points * TIME_RESAMPLE), rnd.randint(1, 40))
+        # a few readings share the buckets
+        tss += [ts + rnd.randint(1, 1000) for ts in rnd.sample(tss, len(tss) // 3)]
+        return [DsReading(datastream=self.ds, time=ts, db_value=rnd.uniform(-100, 100)) for ts in set(tss)]
+
+    def to_arrays(self, ds_readings: list[DsReading]):
+        tss = np.array([r.time for r in ds_readings], dtype=np.int64)
+        ds_values = DsValues(tss, np.array([r.db_value for r in ds_readings], dtype=np.float64))
+        return ds_values.tss, get_values_to_resample(ds_values, self.ds)
+
+    def assert_same_df_readings(self, df_reading_map: dict, ref_map: dict):
+        ref_dfrs = {rts: dfr for rts, dfr in ref_map.items() if isinstance(dfr, DfReading)}
+        self.assertEqual(list(df_reading_map), sorted(ref_dfrs))
+        for rts, dfr in df_reading_map.items():
+            ref_dfr = ref_dfrs[rts]
+            self.assertEqual(
+                (dfr.time, dfr.db_value, dfr.restored, dfr.not_to_use),
+                (ref_dfr.time, ref_dfr.db_value, ref_dfr.restored, ref_dfr.not_to_use),
+            )
+
+    def test_resampling_matches_reference(self):
+        for seed in range(300):
+            rnd = random.Random(seed)
+            var_type = rnd.choice((VariableTypes.CONTINUOUS, VariableTypes.DISCRETE))
+            agg_type = rnd.choice((DataAggrTypes.AVG, DataAggrTypes.SUM, DataAggrTypes.LAST))
+            self.set_data_type(var_type, agg_type)
+            ds_readings = self.create_ds_readings(rnd, 1700000040000, 30)
+
+            tss, values = self.to_arrays(ds_readings)
+            df_reading_map = resample_ds_readings(tss, values, self.df, TIME_RESAMPLE, agg_type)
+            ref_map = resample_ds_readings_ref(ds_readings, self.df, TIME_RESAMPLE, AGG_FUNCS[agg_type])
+            with self.subTest(seed=seed):
+                self.assert_same_df_readings(df_reading_map, ref_map)
+
+    def test_sums_of_full_buckets_match_reference(self):
+        # a reading every second, 60 float values per bucket
+        rnd = random.Random(1)
+        ds_readings = [
+            DsReading(datastream=self.ds, time=ts, db_value=rnd.uniform(-100, 100))
+            for ts in range(1700000040001, 1700000040001 + 20 * TIME_RESAMPLE, 1000)
+        ]
+        for agg_type in (DataAggrTypes.AVG, DataAggrTypes.SUM):
+            self.set_data_type(VariableTypes.CONTINUOUS, agg_type)
+            tss, values = self.to_arrays(ds_readings)
+            df_reading_map = resample_ds_readings(tss, values, self.df, TIME_RESAMPLE, agg_type)
+            ref_map = resample_ds_readings_ref(ds_readings, self.df, TIME_RESAMPLE, AGG_FUNCS[agg_type])
+            with self.subTest(agg_type=agg_type):
+                self.assert_same_df_readings(df_reading_map, ref_map)
+
+    def test_augmentation_matches_reference(self):
+        now_ts = 1700000000000
+        for seed in range(300):
+            rnd = random.Random(seed)
+            DsReading.objects.all().delete()
+            NoDataMarker.objects.all().delete()
+            DfReading.objects.all().delete()
+
+            var_type = rnd.choice((VariableTypes.CONTINUOUS, VariableTypes.DISCRETE))
+            ds_agg_type = rnd.choice((DataAggrTypes.SUM, DataAggrTypes.LAST))
+            self.set_data_type(var_type, ds_agg_type)
+            # totalizers are augmented as SUM, but resampled by the last values
+            agg_type = ds_agg_type
+            if ds_agg_type == DataAggrTypes.SUM:
+                agg_type = rnd.choice((DataAggrTypes.SUM, DataAggrTypes.LAST))
+            self.df.aug_policy = rnd.choice((AugmentationPolicy.TILL_LAST_DF_READING, AugmentationPolicy.TILL_NOW))
+            self.ds.till_now_margin = rnd.choice((0, 5 * TIME_RESAMPLE))
+
+            start_rts = floor_timestamp(now_ts, TIME_RESAMPLE) - 30 * TIME_RESAMPLE
+            ds_readings = self.create_ds_readings(rnd, start_rts, 36)[: rnd.randint(0, 40)]
+            marker_tss = rnd.sample(range(start_rts + 1, start_rts + 36 * TIME_RESAMPLE), rnd.randint(0, 6))
+            # markers at the same time as readings are after them
+            marker_tss += [r.time for r in rnd.sample(ds_readings, min(len(ds_readings), rnd.randint(0, 2)))]
+            NoDataMarker.objects.bulk_create([NoDataMarker(datastream=self.ds, time=ts) for ts in set(marker_tss)])
+            if rnd.random() < 0.4:
+                DfReading.objects.create(datafeed=self.df, time=start_rts, db_value=rnd.randint(0, 40) / 4)
+            if rnd.random() < 0.5:
+                DsReading.objects.create(datastream=self.ds, time=start_rts - rnd.randint(0, 5000), db_value=1.0)
+            if rnd.random() < 0.5:
+                NoDataMarker.objects.create(datastream=self.ds, time=start_rts - rnd.randint(0, 5000))
 
-# Create your tests here.
+            tss, values = self.to_arrays(ds_readings)
+            nd_tss = fetch_nodata_marker_tss(self.ds.pk, start_rts)
+            with self.subTest(seed=seed), mock.patch("utils.dfr_utils.create_now_ts_ms", return_value=now_ts):
+                try:
+                    ref_map = resample_and_augment_ds_readings_ref(
+                        ds_readings, self.df, self.ds, TIME_RESAMPLE, start_rts, AGG_FUNCS[agg_type], now_ts
+                    )
+                except ValueError:  # the grid is not valid
+                    with self.assertRaises(ValueError):
+                        resample_and_augment_ds_readings(
+                            tss, values, nd_tss, self.df, self.ds, TIME_RESAMPLE, start_rts, agg_type
+                        )
+                    continue
+                df_reading_map, last_bucket_rts = resample_and_augment_ds_readings(
+                    tss, values, nd_tss, self.df, self.ds, TIME_RESAMPLE, start_rts, agg_type
+                )
+                self.assert_same_df_readings(df_reading_map, ref_map)
+                # the buckets beyond the grid stay in the reference map
+                self.assertEqual(last_bucket_rts, max(ref_map, default=None))
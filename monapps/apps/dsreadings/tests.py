@@ -1,3 +1,86 @@
+import unittest
+
+from django.conf import settings
+from django.db import IntegrityError, connection
 from django.test import TestCase
 
-# Create your tests here.
+from apps.datatypes.models import DataType
+from apps.datastreams.models import Datastream
+from apps.devices.models import Device
+from apps.dsreadings.models import DsReading
+from services.bulk_writer import PgBulkWriter, write_objects, write_rows
+from utils.dsr_utils import DS_READING_FIELDS, fetch_ds_values
+
+
+class BulkWriterTest(TestCase):
+
+    def setUp(self):
+        data_type = DataType.objects.create(name="Temperature")
+        dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        self.ds = Datastream.objects.create(name="temp1", data_type=data_type, parent=dev)
+
+    def create_readings(self, tss):
+        return [DsReading(datastream=self.ds, time=ts, db_value=20.0) for ts in tss]
+
+    def test_skipped_readings_are_counted(self):
+        self.assertEqual(tuple(write_objects(DsReading, self.create_readings([1000, 2000]))), (2, 0))
+        # one reading exists already, one is repeated in the batch
+        self.assertEqual(tuple(write_objects(DsReading, self.create_readings([2000, 3000, 3000]))), (1, 2))
+        self.assertEqual(DsReading.objects.filter(datastream=self.ds).count(), 3)
+
+    def test_conflict_raises_without_ignoring(self):
+        write_objects(DsReading, self.create_readings([1000]))
+        with self.assertRaises(IntegrityError):
+            write_objects(DsReading, self.create_readings([1000]), ignore_conflicts=False)
+
+    def test_rows_are_written_as_readings(self):
+        write_objects(DsReading, self.create_readings([1000]))
+        rows = [(1000, self.ds.pk, 21.0), (2000, self.ds.pk, 22.0)]
+        self.assertEqual(tuple(write_rows(DsReading, DS_READING_FIELDS, rows)), (1, 1))
+        self.assertEqual(
+            list(DsReading.objects.filter(datastream=self.ds).order_by("time").values_list("time", "db_value")),
+            [(1000, 20.0), (2000, 22.0)],
+        )
+
+    def test_ds_values_are_fetched_in_columns(self):
+        write_objects(DsReading, self.create_readings([3000, 1000, 2000]))
+        ds_values = fetch_ds_values(DsReading.objects.filter(datastream=self.ds, time__gt=1000), 5, chunk_size=1)
+        self.assertEqual((ds_values.tss.tolist(), ds_values.values.tolist()), ([2000, 3000], [20.0, 20.0]))
+        self.assertEqual(len(fetch_ds_values(DsReading.objects.filter(datastream=self.ds), 2)), 2)
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "the PostgreSQL writer needs PostgreSQL")
+class PgBulkWriterTest(TestCase):
+
+    def setUp(self):
+        data_type = DataType.objects.create(name="Temperature")
+        dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        self.ds = Datastream.objects.create(name="temp1", data_type=data_type, parent=dev)
+        self.writer = PgBulkWriter()
+
+    def create_readings(self, tss):
+        return [DsReading(datastream=self.ds, time=ts, db_value=20.0) for ts in tss]
+
+    def test_skipped_readings_are_counted_with_insert(self):
+        self.assertEqual(tuple(self.writer.write(DsReading, self.create_readings([1000, 2000]))), (2, 0))
+        # one reading exists already, one is repeated in the batch
+        self.assertEqual(tuple(self.writer.write(DsReading, self.create_readings([2000, 3000, 3000]))), (1, 2))
+        rows = [(3000, self.ds.pk, 21.0), (4000, self.ds.pk, 22.0)]
+        self.assertEqual(tuple(self.writer.write_rows(DsReading, DS_READING_FIELDS, rows)), (1, 1))
+        self.assertEqual(DsReading.objects.filter(datastream=self.ds).count(), 4)
+
+    def test_skipped_readings_are_counted_with_copy(self):
+        num_rows = settings.BULK_WRITER_COPY_MIN_ROWS
+        self.writer.write(DsReading, self.create_readings([0, 1000]))
+        tss = [ts * 1000 for ts in range(num_rows - 1)] + [1000]  # two exist already, one is repeated
+        self.assertEqual(tuple(self.writer.write(DsReading, self.create_readings(tss))), (num_rows - 3, 3))
+
+        # the temporary table is dropped, so the model can be copied again in the same transaction
+        rows = [(ts * 1000, self.ds.pk, 21.0) for ts in range(num_rows - 10, 2 * num_rows - 10)]
+        self.assertEqual(tuple(self.writer.write_rows(DsReading, DS_READING_FIELDS, rows)), (num_rows - 9, 9))
+        self.assertEqual(DsReading.objects.filter(datastream=self.ds).count(), 2 * num_rows - 10)
+
+    def test_conflict_raises_without_ignoring(self):
+        self.writer.write(DsReading, self.create_readings([1000]))
+        with self.assertRaises(IntegrityError):
+            self.writer.write(DsReading, self.create_readings([1000]), ignore_conflicts=False)
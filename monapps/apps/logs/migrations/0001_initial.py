@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('log_type', models.SmallIntegerField(choices=[(1, 'Device'), (2, 'App'), (3, 'Alarm')])),
+                ('level', models.SmallIntegerField(choices=[(1, 'Info'), (2, 'Warning'), (3, 'Error')])),
+                ('is_out', models.BooleanField(default=False)),
+                ('time', models.BigIntegerField()),
+                ('instance', models.CharField(max_length=200)),
+                ('msg', models.TextField()),
+            ],
+            options={
+                'db_table': 'log_records',
+                'indexes': [models.Index(fields=['instance', 'time'], name='log_records_instance_time'), models.Index(fields=['time'], name='log_records_time')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import models
+
+from common.constants import LogTypes, LogLevels
+
+
+class LogRecord(models.Model):
+    """
+    A record of the device, app or alarm log.
+    'instance' is the full id of the instance ("datastream 125") or a name of a process ("MQTT Sub").
+    """
+
+    class Meta:
+        db_table = "log_records"
+        indexes = [
+            models.Index(fields=["instance", "time"], name="log_records_instance_time"),
+            models.Index(fields=["time"], name="log_records_time"),
+        ]
+
+    log_type = models.SmallIntegerField(choices=LogTypes.choices)
+    level = models.SmallIntegerField(choices=LogLevels.choices)
+    is_out = models.BooleanField(default=False)  # the status of the alarm, "IN" or "OUT"
+    time = models.BigIntegerField()
+    instance = models.CharField(max_length=200)
+    msg = models.TextField()
+
+    def __str__(self):
+        return f"{LogTypes(self.log_type).name} {LogLevels(self.level).name} {self.instance} {self.time}: {self.msg}"
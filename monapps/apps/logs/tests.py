@@ -0,0 +1,83 @@
+import threading
+from unittest import mock
+
+from django.db import transaction
+from django.test import TestCase
+
+from apps.datatypes.models import DataType
+from apps.logs.models import LogRecord
+from services.device_log import add_to_device_log
+from services.log_store import LogStore, log_store
+
+
+class LogStoreTest(TestCase):
+
+    def setUp(self):
+        log_store.flush()
+        LogRecord.objects.all().delete()
+
+    def test_records_are_written_after_commit(self):
+        data_type = DataType.objects.create(name="Temperature")
+        with self.captureOnCommitCallbacks(execute=True):
+            add_to_device_log("ERROR", "Sensor error", 1700000001000, data_type, "in")
+            add_to_device_log("ERROR", "Sensor error", 1700000002000, data_type, "out")
+            try:
+                with transaction.atomic():
+                    add_to_device_log("INFO", "Rolled back", 1700000003000, data_type)
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(LogRecord.objects.count(), 0)  # not committed yet
+        log_store.flush()
+
+        records = list(LogRecord.objects.order_by("time").values_list("instance", "time", "is_out", "msg"))
+        self.assertEqual(
+            records,
+            [
+                (f"datatype {data_type.pk}", 1700000001000, False, "Sensor error"),
+                (f"datatype {data_type.pk}", 1700000002000, True, "Sensor error"),
+            ],
+        )
+
+    def test_due_records_are_flushed_by_flusher(self):
+        store = LogStore(max_records=2, flush_interval_ms=60000, is_echo_on=False)
+        flushed_by = []
+        is_flushed = threading.Event()
+
+        def flush():
+            flushed_by.append(threading.current_thread().name)
+            is_flushed.set()
+
+        with mock.patch.object(store, "flush", side_effect=flush):
+            # without the flusher nothing would write a lone record later, so it is written inline
+            store.collect((0, 0, False, 1000, "device 1", "first"))
+            self.assertEqual(flushed_by, [threading.current_thread().name])
+
+            flushed_by.clear()
+            is_flushed.clear()
+            store.start_flusher()
+            try:
+                store.collect((0, 0, False, 2000, "device 1", "second"))  # due
+                self.assertTrue(is_flushed.wait(5))
+                self.assertEqual(flushed_by[0], "log-store-flusher")
+            finally:
+                store.stop_flusher()
+
+    def test_api_pages_by_time(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for ts in (1000, 2000, 2000, 3000, 4000):
+                add_to_device_log("INFO", f"at {ts}", ts, "device 1")
+            add_to_device_log("INFO", "another device", 2500, "device 2")
+        log_store.flush()
+
+        tss = []
+        cursor = None
+        while True:
+            params = {"instanceId": "device 1", "lte": 3000, "limit": 2}
+            if cursor is not None:
+                params["cursor"] = cursor
+            response = self.client.get("/api/logs/", params).json()
+            tss.extend(record["t"] for record in response["logRecords"])
+            if (cursor := response["nextCursor"]) is None:
+                break
+        self.assertEqual(tss, [3000, 2000, 2000, 1000])
@@ -0,0 +1,148 @@
+import csv
+import gzip
+import io
+import sys
+import time
+import logging
+from collections.abc import Iterator
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from common.constants import BackpressurePolicies
+from services.ingest_worker_pool import IngestWorkerPool
+from services.duplicate_filter import duplicate_filter
+from services.log_store import log_store
+from services.payload_decoding import json_loads, decode_rawdata_message, decode_chirpstack_message
+
+logger = logging.getLogger("#raw_data_import")
+
+
+def open_text(path: str) -> io.TextIOBase:
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports historical raw data through the same processing as the MQTT subscriber. "
+        "JSONL files have one message per line, either a 'rawdata/...' payload ({dev_ui: {ts: {...}}}) "
+        "or a Chirpstack uplink event, spool segments of the subscriber can be imported as is. "
+        "CSV files have the columns 'dev_ui', 'ts' and one column per datastream with values. "
+        "Files are read line by line, so the memory usage does not depend on the file size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="*", default=["-"], help="files to import, '-' or nothing for stdin")
+        parser.add_argument("--format", choices=["auto", "jsonl", "csv"], default="auto", help="'auto' - by extension")
+        parser.add_argument("--workers", type=int, default=max(settings.MQTT_SUB_NUM_WORKERS, 1))
+        parser.add_argument("--queue-size", type=int, default=settings.MQTT_SUB_QUEUE_SIZE, help="per worker")
+        parser.add_argument("--batch-window-ms", type=int, default=500)
+        parser.add_argument("--batch-max-rows", type=int, default=5000)
+        parser.add_argument("--progress-s", type=float, default=5.0, help="progress reporting interval")
+
+    def handle(self, *args, **options):
+        pool = IngestWorkerPool(
+            num_workers=options["workers"],
+            queue_size=options["queue_size"],
+            policy=BackpressurePolicies.BLOCK,  # nothing can be dropped here, the reading waits for the workers
+            stats_interval_s=0,
+            batch_window_ms=options["batch_window_ms"],
+            batch_max_rows=options["batch_max_rows"],
+            # there is nothing to deliver the payloads failed because of the db again,
+            # so they are retried until they are written
+            retry_db_errors=True,
+        )
+        self.num_lines = 0
+        self.num_bad_lines = 0
+        self.num_rows = 0
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+
+        log_store.start_flusher()  # the log records are written in bulk
+        pool.start()
+        try:
+            for path in options["files"]:
+                file_format = options["format"]
+                if file_format == "auto":
+                    file_format = "csv" if path.removesuffix(".gz").endswith(".csv") else "jsonl"
+                try:
+                    f = open_text(path)
+                except OSError as e:
+                    raise CommandError(f"Cannot open '{path}': {e}")
+                with f:
+                    dev_payloads = self.read_csv(f) if file_format == "csv" else self.read_jsonl(f)
+                    for dev_ui, dev_payload in dev_payloads:
+                        self.num_rows += len(dev_payload)
+                        pool.submit(dev_ui, dev_payload)
+                        self.report_progress(pool, options["progress_s"])
+        finally:
+            pool.stop()  # waits until everything read is processed
+            log_store.stop_flusher()
+
+        elapsed = time.monotonic() - self.started_at
+        counters = pool.counters.snapshot()
+        dup_stats = duplicate_filter.stats()
+        self.stdout.write(
+            f"Imported in {elapsed:.1f} s: lines {self.num_lines} (bad {self.num_bad_lines}), "
+            f"device payloads {counters['received']}, rows {self.num_rows} ({self.num_rows / elapsed:.0f} rows/s), "
+            f"duplicate rows {dup_stats['dup_rows']}, transactions {counters['batches']}, failed {counters['failed']}"
+        )
+
+    def report_progress(self, pool: IngestWorkerPool, interval_s: float):
+        now = time.monotonic()
+        if now - self.reported_at < interval_s:
+            return
+        self.reported_at = now
+        elapsed = now - self.started_at
+        self.stdout.write(
+            f"{elapsed:.0f} s: lines {self.num_lines}, rows {self.num_rows} ({self.num_rows / elapsed:.0f} rows/s), "
+            f"queued {pool.get_queue_depth()}"
+        )
+
+    def read_jsonl(self, f) -> Iterator[tuple[str, dict]]:
+        for line in f:
+            self.num_lines += 1
+            if not (line := line.strip()):
+                continue
+            try:
+                payload = json_loads(line)
+                # the shape of the line tells which message it was
+                if type(payload) is dict and "deviceInfo" in payload:
+                    dev_payloads = decode_chirpstack_message(payload)
+                else:
+                    dev_payloads = decode_rawdata_message(payload)
+            except ValueError as e:
+                self.num_bad_lines += 1
+                logger.error(f"Line {self.num_lines}: {e}")
+                continue
+            yield from dev_payloads
+
+    def read_csv(self, f) -> Iterator[tuple[str, dict]]:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        self.num_lines += 1
+        if header is None or header[:2] != ["dev_ui", "ts"]:
+            raise CommandError("The first two columns of a CSV file should be 'dev_ui' and 'ts'")
+        ds_names = header[2:]
+        for cells in reader:
+            self.num_lines += 1
+            if len(cells) < 2:
+                continue
+            ds_row = {}
+            is_bad_line = False
+            for ds_name, cell in zip(ds_names, cells[2:]):
+                if cell == "":
+                    continue
+                try:
+                    ds_row[ds_name] = {"v": float(cell)}
+                except ValueError:
+                    is_bad_line = True
+                    logger.warning(f"Line {self.num_lines}: incorrect value '{cell}' for '{ds_name}'")
+            self.num_bad_lines += is_bad_line  # the correct values of the line are still imported
+            if len(ds_row) == 0:
+                continue
+            yield cells[0].lower(), {cells[1]: ds_row}
@@ -0,0 +1,95 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db.models import Count
+
+from apps.mqtt_sub.models import DeadLetter
+from common.constants import BackpressurePolicies
+from services.dead_letters import DEAD_LETTER_OUTCOMES
+from services.ingest_worker_pool import IngestWorkerPool
+from services.log_store import log_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Processes the dead letters again through the same batched processing as the MQTT subscriber, "
+        "e.g. after the unknown devices are created. The processed dead letters are deleted, the payloads "
+        "that fail again are kept as new dead letters. With '--stats' only the numbers per reason are shown."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reason", choices=sorted(outcome.value for outcome in DEAD_LETTER_OUTCOMES), action="append"
+        )
+        parser.add_argument("--dev-ui", action="append", help="only these devices")
+        parser.add_argument("--stats", action="store_true", help="show the numbers of dead letters and exit")
+        parser.add_argument("--workers", type=int, default=max(settings.MQTT_SUB_NUM_WORKERS, 1))
+        parser.add_argument("--batch-window-ms", type=int, default=500)
+        parser.add_argument("--batch-max-rows", type=int, default=5000)
+        parser.add_argument("--chunk-size", type=int, default=1000, help="dead letters read and deleted at once")
+
+    def handle(self, *args, **options):
+        qs = DeadLetter.objects.all()
+        if options["reason"]:
+            qs = qs.filter(reason__in=options["reason"])
+        if options["dev_ui"]:
+            qs = qs.filter(dev_ui__in=[dev_ui.lower() for dev_ui in options["dev_ui"]])
+
+        if options["stats"]:
+            self.show_stats(qs)
+            return
+
+        pool = IngestWorkerPool(
+            num_workers=options["workers"],
+            policy=BackpressurePolicies.BLOCK,
+            stats_interval_s=0,
+            batch_window_ms=options["batch_window_ms"],
+            batch_max_rows=options["batch_max_rows"],
+            # a chunk is deleted when all its payloads are processed, the ones failed because of the db
+            # are not dead letters again, so they are retried until they are written
+            retry_db_errors=True,
+        )
+        started_at = time.monotonic()
+        num_letters = 0
+        max_pk = qs.order_by("-pk").values_list("pk", flat=True).first()  # new dead letters are not taken
+        last_pk = 0
+        log_store.start_flusher()  # the log records are written in bulk
+        pool.start()
+        try:
+            while max_pk is not None and last_pk < max_pk:
+                chunk = list(
+                    qs.filter(pk__gt=last_pk, pk__lte=max_pk)
+                    .order_by("pk")
+                    .values_list("pk", "dev_ui", "payload")[: options["chunk_size"]]
+                )
+                if len(chunk) == 0:
+                    break
+                for _, dev_ui, payload in chunk:
+                    pool.submit(dev_ui, payload)
+                pool.wait_until_processed()
+                # the payloads that failed again are new dead letters already
+                DeadLetter.objects.filter(pk__in=[pk for pk, _, _ in chunk]).delete()
+                last_pk = chunk[-1][0]
+                num_letters += len(chunk)
+                self.stdout.write(f"{time.monotonic() - started_at:.0f} s: reprocessed {num_letters} dead letters")
+        finally:
+            pool.stop()
+            log_store.stop_flusher()
+
+        counters = pool.counters.snapshot()
+        self.stdout.write(
+            f"Reprocessed {num_letters} dead letters in {time.monotonic() - started_at:.1f} s, "
+            f"processed {counters['processed']}, failed {counters['failed']}"
+        )
+        self.show_stats(DeadLetter.objects.all())
+
+    def show_stats(self, qs):
+        self.stdout.write("Dead letters per reason:")
+        for row in qs.values("reason").annotate(num=Count("pk"), num_devs=Count("dev_ui", distinct=True)):
+            self.stdout.write(f"  {row['reason']}: {row['num']} (devices: {row['num_devs']})")
+        top_devs = qs.values("dev_ui").annotate(num=Count("pk")).order_by("-num")[:10]
+        if len(top_devs) > 0:
+            self.stdout.write("Devices with the most dead letters:")
+            for row in top_devs:
+                self.stdout.write(f"  {row['dev_ui']}: {row['num']}")
@@ -1,27 +1,42 @@
 import signal
 import os
-import json
 import logging
 import traceback
 
 from django.core.management.base import BaseCommand
+from django.conf import settings
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 
-from services.raw_data_processor import RawDataProcessor
+from apps.datastreams.models import Datastream
+from common.constants import BackpressurePolicies
+from services.ingest_worker_pool import IngestWorkerPool
+from services.ingest_spool import IngestSpool
+from services.ingest_router import IngestRouter
+from services.message_acks import MessageAckTracker
+from services.payload_decoding import message_decoder_registry
 
 from services.alarm_log import add_to_alarm_log
+from services.log_store import log_store
 
 logger = logging.getLogger("#mqtt_sub")
 
 
-def on_connect(client: mqtt.Client, userdata, flags, reason_code, properties=None):
+def on_connect(client: mqtt.Client, userdata: IngestRouter, flags, reason_code, properties=None):
     if reason_code == 0:
         add_to_alarm_log("INFO", "Connected to the broker", instance="MQTT Sub")
         logger.info("MQTT subscriber connected")
         sub_topic = os.getenv("MQTT_SUB_TOPIC", "rawdata/#")
+        if settings.MQTT_SUB_SHARE_GROUP:
+            # the broker will distribute messages between all the subscribers of the group
+            sub_topic = f"$share/{settings.MQTT_SUB_SHARE_GROUP}/{sub_topic}"
         logger.info(f"MQTT subscriber is trying to subscribe to the topic: {sub_topic}")
-        client.subscribe(sub_topic, qos=0)
+        client.subscribe(sub_topic, qos=settings.MQTT_SUB_QOS)
+        if userdata.is_sharded:
+            logger.info(f"MQTT subscriber is trying to subscribe to the topic: {userdata.fwd_topic}")
+            client.subscribe(userdata.fwd_topic, qos=1)
     else:
         add_to_alarm_log(
             "ERROR",
@@ -36,7 +51,12 @@ def on_subscribe(client, userdata, mid, reason_code_list, properties):
     logger.info("MQTT subscriber subscribed")
 
 
-def on_message(client, userdata, msg):
+def on_publish(client, userdata: IngestRouter, mid, reason_code, properties):
+    # the forwarded payloads are the only publications of the subscriber
+    userdata.on_published(mid, reason_code.is_failure)
+
+
+def on_message(client, userdata: IngestRouter, msg):
     # a message topic should look like:
     # 1. "rawdata/<location>/<sublocation>/..." - then the payload can have data from several devices and look like
     # {
@@ -46,46 +66,39 @@ def on_message(client, userdata, msg):
     #     ...
     #    }
 
-    msg_str = str(msg.payload.decode("utf-8"))
-    if len(msg_str) > 20:
-        msg_str_cropped = msg_str[0:20] + "..."
-    else:
-        msg_str_cropped = msg_str
+    # 2. a topic containing "chirpstack" - then the payload is a Chirpstack uplink event
+    #    (see 'services.payload_decoding' for the decoders of the topics), with MQTT_SUB_CHIRPSTACK_DECODING="raw"
+    #    the frame in "data" is decoded by 'services.frame_decoders' instead of the JS codec in Chirpstack
+
+    # the payload is parsed from bytes, only the beginning of it is converted to 'str' for logging
+    msg_str_cropped = msg.payload[0:20].decode("utf-8", errors="replace")
+    if len(msg.payload) > 20:
+        msg_str_cropped += "..."
     # add_to_alarm_log(
     #     "INFO",
     #     f"A message on the topic '{msg.topic}' received: '{msg_str_cropped}'",
     #     instance="MQTT Sub",
     # )
     logger.info(f"A message on the topic '{msg.topic}' received: '{msg_str_cropped}'")
+    # with manual acknowledgements the message is acknowledged when all its device payloads are written
+    # (incorrect messages are acknowledged right away, there is no sense in getting them again)
+    ack = userdata.ack_tracker.create(client, msg) if userdata.ack_tracker is not None else None
     try:
-        payload = json.loads(msg_str)
-    except Exception:
-        # add_to_alarm_log("ERROR", "Error while converting JSON", instance="MQTT Sub")
-        logger.error(f"Error while converting JSON: {traceback.format_exc()}")
-        return
-
-    # special case - Chirpstack payload
-    if "chirpstack" in msg.topic:
-        if "deviceInfo" in payload and "object" in payload:
-            RawDataProcessor(payload["deviceInfo"]["devEui"].lower(), payload["object"]).execute()
-            return
-        else:
-            # add_to_alarm_log(
-            #     "ERROR", "Incorrect Chirpstack payload", instance="MQTT Sub"
-            # )
-            logger.error("Incorrect Chirpstack payload")
-            return
+        dev_payloads = message_decoder_registry.decode(msg.topic, msg.payload)
+    except ValueError:  # incorrect JSON or a payload that does not fit the topic
+        # add_to_alarm_log("ERROR", "Error while decoding a message", instance="MQTT Sub")
+        logger.error(f"Error while decoding a message on the topic '{msg.topic}': {traceback.format_exc(-1)}")
+        dev_payloads = []
 
-    # common case - usually payload from ESF
-    for dev_ui, dev_payload in payload.items():
-        if type(dev_payload) is not dict:
-            # add_to_alarm_log(
-            #     "WARNING", f"Incorrect payload for device '{dev_ui}'", instance="MQTT Sub"
-            # )
-            logger.warning(f"Incorrect payload for device '{dev_ui}'")
-            continue
-        dev_ui = dev_ui.lower()  # unify all 'dev_ui's stored in the db
-        RawDataProcessor(dev_ui, dev_payload).execute()
+    try:
+        # a payload can also be forwarded by another subscriber process
+        is_forwarded = userdata.is_fwd_topic(msg.topic)
+        for dev_ui, dev_payload in dev_payloads:
+            # the payload is processed in one of the worker threads, so the network loop is not blocked
+            userdata.route(client, dev_ui, dev_payload, is_forwarded, ack, msg.topic)
+    finally:
+        if ack is not None:
+            ack.part_done()  # the part of the message itself
 
 
 def on_disconnect(client: mqtt.Client, userdata, flags, reason_code, properties):
@@ -96,17 +109,49 @@ def on_disconnect(client: mqtt.Client, userdata, flags, reason_code, properties)
 class Command(BaseCommand):
 
     mqtt_subscriber = None
+    worker_pool = None
 
     def handle(self, *args, **kwargs):
         self.inner_run(**kwargs)
 
     def inner_run(self, **kwarg):
-        Command.mqtt_subscriber = mqtt.Client(
-            mqtt.CallbackAPIVersion.VERSION2, client_id="monappsV3", clean_session=True
-        )
+        is_manual_ack = settings.MQTT_SUB_QOS > 0
+        if is_manual_ack and settings.MQTT_SUB_BACKPRESSURE == BackpressurePolicies.DROP_OLDEST:
+            # dropped payloads are not acknowledged, their messages would take the in-flight slots till a reconnect
+            s = "The 'drop_oldest' backpressure policy cannot be used with QoS 1, use 'block' or 'spill'"
+            add_to_alarm_log("ERROR", s, instance="MQTT Sub")
+            logger.error(s)
+            return
+        # with manual acknowledgements the payloads are not lost on db errors, they are retried
+        Command.worker_pool = IngestWorkerPool(retry_db_errors=is_manual_ack, spool=IngestSpool())
+        ack_tracker = MessageAckTracker(Command.worker_pool.counters) if is_manual_ack else None
+        router = IngestRouter(Command.worker_pool, ack_tracker=ack_tracker)
+        # the client id should be stable, the broker keeps the session (and not acknowledged messages) by it
+        client_id = settings.MQTT_SUB_CLIENT_ID
+        if router.is_sharded:
+            client_id = f"{client_id}-{router.instance_idx}"  # every process of the group needs a unique id
+            if (num_dss := Datastream.objects.filter(reorder_window=0, is_enabled=True).count()) > 0:
+                # the forwarded payloads can come after newer ones of the same device
+                logger.warning(
+                    f"{num_dss} datastreams have no reorder window, "
+                    "their forwarded readings are unused if newer ones came directly"
+                )
+        if is_manual_ack:
+            Command.mqtt_subscriber = mqtt.Client(
+                mqtt.CallbackAPIVersion.VERSION2,
+                client_id=client_id,
+                userdata=router,
+                protocol=mqtt.MQTTv5,
+                manual_ack=True,
+            )
+        else:
+            Command.mqtt_subscriber = mqtt.Client(
+                mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, clean_session=True, userdata=router
+            )
         Command.mqtt_subscriber.on_connect = on_connect
         Command.mqtt_subscriber.on_subscribe = on_subscribe
         Command.mqtt_subscriber.on_message = on_message
+        Command.mqtt_subscriber.on_publish = on_publish
         Command.mqtt_subscriber.on_disconnect = on_disconnect
         try:
             mqtt_broker_host = os.getenv("MQTT_BROKER_HOST")
@@ -115,7 +160,17 @@ class Command(BaseCommand):
                 add_to_alarm_log("ERROR", s, instance="MQTT Sub")
                 logger.error(s)
                 return
-            Command.mqtt_subscriber.connect(mqtt_broker_host, 1883, 60)
+            if is_manual_ack:
+                # the broker sends no more than 'MQTT_SUB_MAX_INFLIGHT' not acknowledged messages,
+                # the rest waits in the session on the broker side
+                properties = Properties(PacketTypes.CONNECT)
+                properties.ReceiveMaximum = settings.MQTT_SUB_MAX_INFLIGHT
+                properties.SessionExpiryInterval = settings.MQTT_SUB_SESSION_EXPIRY_S
+                Command.mqtt_subscriber.connect(
+                    mqtt_broker_host, 1883, 60, clean_start=False, properties=properties
+                )
+            else:
+                Command.mqtt_subscriber.connect(mqtt_broker_host, 1883, 60)
         except Exception as e:
             add_to_alarm_log("ERROR", "Failed to connect", instance="MQTT Sub")
             logger.error(f"MQTT subscriber failed to connect, reason: {e}")
@@ -123,7 +178,12 @@ class Command(BaseCommand):
         else:
             add_to_alarm_log("INFO", "Created", instance="MQTT Sub")
             logger.info("MQTT subscriber created")
+            log_store.start_flusher()
+            Command.worker_pool.start()
             Command.mqtt_subscriber.loop_forever()
+            # the loop exits after 'disconnect', process what is left in the queues
+            Command.worker_pool.stop()
+            log_store.stop_flusher()
 
 
 def handler(signum, frame):
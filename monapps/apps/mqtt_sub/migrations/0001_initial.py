@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-18 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadLetter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dev_ui', models.CharField(max_length=50)),
+                ('reason', models.CharField(choices=[('processed', 'Processed'), ('unknown_device', 'Unknown Device'), ('no_valid_tss', 'No Valid Tss'), ('duplicate', 'Duplicate'), ('db_error', 'Db Error'), ('error', 'Error')], max_length=20)),
+                ('payload', models.JSONField()),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_ts', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'dead_letters',
+                'indexes': [models.Index(fields=['reason', 'dev_ui'], name='dead_letters_reason_dev_ui')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import models
+
+from common.constants import ProcessingOutcomes
+
+
+class DeadLetter(models.Model):
+    """
+    A device payload that could not be processed, 'reason' is the outcome of the processing
+    ("unknown_device", "no_valid_tss" or "error"). Can be processed again with 'reprocess_dead_letters'.
+    """
+
+    class Meta:
+        db_table = "dead_letters"
+        indexes = [
+            models.Index(fields=["reason", "dev_ui"], name="dead_letters_reason_dev_ui"),
+        ]
+
+    dev_ui = models.CharField(max_length=50)
+    reason = models.CharField(max_length=20, choices=ProcessingOutcomes.choices)
+    payload = models.JSONField()
+    error = models.TextField(blank=True, default="")  # the last line of the traceback for "error"
+    created_ts = models.BigIntegerField()
+
+    def __str__(self):
+        return f"Dead letter {self.pk} {self.reason} {self.dev_ui}"
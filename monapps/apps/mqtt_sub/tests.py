@@ -0,0 +1,729 @@
+import base64
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from apps.datatypes.models import DataType
+from apps.datastreams.models import Datastream
+from apps.devices.models import Device
+from apps.dsreadings.models import DsReading, UnusedDsReading
+from apps.logs.models import LogRecord
+from apps.mqtt_sub.models import DeadLetter
+from common.constants import BackpressurePolicies, LogTypes, ProcessingOutcomes
+from services.device_config_cache import device_config_cache
+from services.frame_decoders import frame_decoders
+from services.ingest_router import IngestRouter, get_owner_idx
+from services.ingest_spool import IngestSpool
+from services.ingest_throttle import IngestThrottle
+from services.ingest_worker_pool import IngestWorkerPool, process_dev_payload
+from services.log_store import log_store
+from services.message_acks import MessageAckTracker
+from services.payload_decoding import (
+    PayloadValidationError,
+    decode_chirpstack_message,
+    decode_dev_payload,
+    message_decoder_registry,
+)
+from services.raw_data_processor import RawDataProcessor
+from utils.raw_payload_utils import merge_dev_payloads
+from utils.ts_utils import create_now_ts_ms
+
+
+class DeadLetterTest(TestCase):
+
+    def setUp(self):
+        device_config_cache.invalidate()
+
+    def test_dead_letters_are_reprocessed(self):
+        Device(name="Another kit", dev_ui="fedcba9876543210").save()
+        payload = {"1700000001000": {"temp1": {"v": 20.5}}}
+        self.assertEqual(RawDataProcessor("0123456789abcdef", payload).execute(), ProcessingOutcomes.UNKNOWN_DEVICE)
+        self.assertEqual(RawDataProcessor("fedcba9876543210", {"x": {}}).execute(), ProcessingOutcomes.NO_VALID_TSS)
+        self.assertEqual(
+            list(DeadLetter.objects.order_by("pk").values_list("dev_ui", "reason", "payload")),
+            [
+                ("0123456789abcdef", ProcessingOutcomes.UNKNOWN_DEVICE, payload),
+                ("fedcba9876543210", ProcessingOutcomes.NO_VALID_TSS, {"x": {}}),
+            ],
+        )
+
+        # the device is provisioned
+        dev = Device(name="Diagn kit", dev_ui="0123456789abcdef")
+        dev.save()
+        Datastream(name="temp1", data_type=DataType.objects.create(name="Temperature"), parent=dev).save()
+        call_command("reprocess_dead_letters", reason=["unknown_device"], workers=0, stdout=io.StringIO())
+
+        self.assertEqual(DsReading.objects.filter(datastream__parent=dev).count(), 1)
+        self.assertEqual(list(DeadLetter.objects.values_list("reason", flat=True)), [ProcessingOutcomes.NO_VALID_TSS])
+
+    def test_db_errors_are_retried_before_dead_letters_are_deleted(self):
+        outcome = RawDataProcessor("0123456789abcdef", {"1700000001000": {}}).execute()
+        self.assertEqual(outcome, ProcessingOutcomes.UNKNOWN_DEVICE)
+        dev = Device(name="Diagn kit", dev_ui="0123456789abcdef")
+        dev.save()
+        Datastream(name="temp1", data_type=DataType.objects.create(name="Temperature"), parent=dev).save()
+        DeadLetter.objects.update(payload={"1700000001000": {"temp1": {"v": 20.5}}})
+
+        process = RawDataProcessor.process
+        outcomes = []
+
+        def fail_once(processor):
+            outcomes.append(process(processor) if len(outcomes) > 0 else ProcessingOutcomes.DB_ERROR)
+            return outcomes[-1]
+
+        with mock.patch.object(RawDataProcessor, "process", autospec=True, side_effect=fail_once):
+            with mock.patch("services.ingest_worker_pool.time.sleep"):
+                call_command("reprocess_dead_letters", workers=0, stdout=io.StringIO())
+
+        self.assertEqual(outcomes, [ProcessingOutcomes.DB_ERROR, ProcessingOutcomes.PROCESSED])
+        self.assertEqual(DsReading.objects.filter(datastream__parent=dev).count(), 1)
+        self.assertEqual(DeadLetter.objects.count(), 0)
+
+
+class ImportRawDataTest(TestCase):
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        self.dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        Datastream.objects.create(name="temp1", data_type=DataType.objects.create(name="Temperature"), parent=self.dev)
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+
+    def test_jsonl_and_csv_files_are_imported(self):
+        jsonl_path = os.path.join(self.data_dir.name, "rawdata.jsonl")
+        with open(jsonl_path, "w") as f:
+            f.write(json.dumps({self.dev.dev_ui: {"1700000001000": {"temp1": {"v": 20.5}}}}) + "\n")
+            f.write("{not json\n")
+            f.write(json.dumps({self.dev.dev_ui: {"1700000002000": {"temp1": {"v": 20.6}}}}) + "\n")
+        csv_path = os.path.join(self.data_dir.name, "rawdata.csv.gz")
+        with gzip.open(csv_path, "wt") as f:
+            f.write("dev_ui,ts,temp1\n")
+            f.write("0123456789ABCDEF,1700000003000,20.7\n")
+            f.write("0123456789abcdef,1700000004000,warm\n")
+            f.write("0123456789abcdef,1700000005000,20.9\n")
+
+        out = io.StringIO()
+        call_command("import_raw_data", jsonl_path, csv_path, workers=0, stdout=out)
+
+        self.assertIn("lines 7 (bad 2)", out.getvalue())
+        self.assertEqual(
+            list(DsReading.objects.order_by("time").values_list("time", "db_value")),
+            [(1700000001000, 20.5), (1700000002000, 20.6), (1700000003000, 20.7), (1700000005000, 20.9)],
+        )
+
+
+class FrameDecodingTest(TestCase):
+
+    def test_enless_diagn_kit_frames_are_decoded(self):
+        decoder = frame_decoders["enless_diagn_kit"]
+        # twin-temp kit: temp1 = -12.5, temp2 = 500 (out of range)
+        self.assertEqual(
+            decoder.decode(bytes.fromhex("0102030c0000ff831388")),
+            {"temp1": {"v": -12.5}, "temp2": {"e": {"Sensor broken": {}}}},
+        )
+        # pulse kit, 4-byte counters
+        self.assertEqual(
+            decoder.decode(bytes.fromhex("010203080000" "00000007" "fffffffe" "00010000")),
+            {"pulse_ch1": {"v": 7.0}, "pulse_ch2": {"v": 4294967294.0}, "pulse_oc": {"v": 65536.0}},
+        )
+        with self.assertRaises(ValueError):
+            decoder.decode(bytes.fromhex("0102030c0000ff83"))
+
+    def test_raw_mode_decodes_chirpstack_data(self):
+        event = {
+            "deviceInfo": {"deviceProfileName": "Enless diagnostic kit", "devEui": "0123456789ABCDEF"},
+            "time": "2024-01-01T00:00:01.5+00:00",
+            "data": base64.b64encode(bytes.fromhex("010203040000" "00d7" "01f4")).decode("ascii"),
+            "object": {"1704067201000": {"temp1": {"v": 0.0}}},
+        }
+        with override_settings(MQTT_SUB_CHIRPSTACK_DECODING="raw"):
+            self.assertEqual(
+                decode_chirpstack_message(event),
+                [("0123456789abcdef", {"1704067201500": {"temp1": {"v": 21.5}, "humidity": {"v": 50.0}}})],
+            )
+            # no decoder for the profile - the payload of the JS codec is used
+            event["deviceInfo"]["deviceProfileName"] = "Another profile"
+            self.assertEqual(decode_chirpstack_message(event)[0][1], event["object"])
+        self.assertEqual(decode_chirpstack_message(event)[0][1], event["object"])
+
+
+class PayloadDecodingTest(TestCase):
+
+    def test_dev_payload_is_validated(self):
+        decoded = decode_dev_payload(
+            {
+                "3000": {"temp1": {"v": 21}, "temp2": {"v": "21.5"}, "e": {"Low battery": {}}},
+                "1000": {"temp1": {"v": 20.5, "w": {"Drift": {"st": "in"}}}, "temp2": 7},
+                "not a ts": {"temp1": {"v": 1}},
+                "2000": [1, 2],
+                "4000": {"temp2": {"v": True, "e": ["Sensor broken"]}, "w": "Low battery", "i": ["Rebooted"]},
+                "03000": {"temp1": {"v": 22}},  # the same timestamp as "3000", the last row is used
+            }
+        )
+        self.assertEqual(decoded.tss, [1000, 3000, 4000])
+        self.assertEqual(decoded.values, {"temp1": [20.5, 22, None], "temp2": [None, None, True]})
+        self.assertEqual(decoded.ds_alarm_rows, {"temp1": {1000: {"w": {"Drift": {"st": "in"}}}}})
+        self.assertEqual(decoded.dev_alarm_rows, {4000: {"i": ["Rebooted"]}})
+        # the key, the row of "2000", the item of "temp2", the alarm dicts of "4000"
+        self.assertEqual(decoded.num_invalid, 5)
+
+        decoded.take_rows([0, 2])
+        self.assertEqual(decoded.tss, [1000, 4000])
+        self.assertEqual(decoded.values, {"temp1": [20.5, None], "temp2": [None, True]})
+        self.assertEqual(decoded.dev_alarm_rows, {4000: {"i": ["Rebooted"]}})
+
+    def test_rawdata_messages_are_validated(self):
+        self.assertEqual(
+            message_decoder_registry.decode("rawdata", b'{"0123456789ABCDEF": {"1000": {}}, "fedcba9876543210": []}'),
+            [("0123456789abcdef", {"1000": {}})],
+        )
+        for msg_payload in (b"[]", b'"0123456789abcdef"', b"{", b"\xff"):
+            with self.assertRaises(ValueError):
+                message_decoder_registry.decode("rawdata", msg_payload)
+        with self.assertRaises(PayloadValidationError):
+            message_decoder_registry.decode("chirpstack/event/up", b'{"deviceInfo": {"devEui": 1}, "object": {}}')
+
+
+class IngestThrottleTest(TestCase):
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        log_store.flush()
+
+    def create_payload(self, num_rows: int, first_ts: int = 1700000001000) -> dict:
+        return {str(first_ts + idx * 1000): {"temp1": {"v": 20.5}} for idx in range(num_rows)}
+
+    def test_rows_over_limits_are_sampled(self):
+        throttle = IngestThrottle(dev_rate=1, dev_burst=10, topic_rate=2, topic_burst=15, policy="sample")
+        throttle.clock = lambda: 100.0
+        with self.captureOnCommitCallbacks(execute=True):
+            payload, num_throttled = throttle.apply("rawdata/site/a", "0123456789abcdef", self.create_payload(40))
+            # evenly spaced rows within the device limit
+            self.assertEqual((len(payload), num_throttled), (10, 30))
+            self.assertEqual(list(payload)[:2], ["1700000001000", "1700000005000"])
+            # the topic bucket has 5 tokens left for other devices
+            payload, num_throttled = throttle.apply("rawdata/site/b", "fedcba9876543210", self.create_payload(8))
+            self.assertEqual((len(payload), num_throttled), (5, 3))
+            # the buckets are refilled with time
+            throttle.clock = lambda: 103.0
+            payload, _ = throttle.apply("rawdata/site/a", "0123456789abcdef", self.create_payload(3))
+            self.assertEqual(len(payload), 3)
+        log_store.flush()
+
+        self.assertEqual(throttle.stats()["throttled_rows"], 33)
+        self.assertEqual(
+            list(LogRecord.objects.filter(log_type=LogTypes.DEVICE).order_by("pk").values_list("instance", "msg")),
+            [
+                ("0123456789abcdef", "Ingest rate limit exceeded, 30 rows throttled (policy 'sample')"),
+                ("fedcba9876543210", "Ingest rate limit exceeded, 3 rows throttled (policy 'sample')"),
+            ],
+        )
+
+    def test_throttled_payloads_are_not_split(self):
+        throttle = IngestThrottle(dev_rate=1, dev_burst=10, policy="drop")
+        throttle.clock = lambda: 100.0
+        payload = self.create_payload(8)
+        self.assertEqual(throttle.apply("rawdata", "0123456789abcdef", payload), (payload, 0))
+        self.assertEqual(throttle.apply("rawdata", "0123456789abcdef", self.create_payload(3)), (None, 3))
+        payload = self.create_payload(2)
+        self.assertEqual(throttle.apply("rawdata", "0123456789abcdef", payload), (payload, 0))
+
+    def test_backlog_bigger_than_burst_is_accepted_by_full_buckets(self):
+        throttle = IngestThrottle(dev_rate=1, dev_burst=10, policy="spill")
+        throttle.clock = lambda: 100.0
+        payload = self.create_payload(25)  # a device that was offline
+        self.assertEqual(throttle.apply("rawdata", "0123456789abcdef", payload), (payload, 0))
+        # the tokens were taken in advance
+        throttle.clock = lambda: 110.0
+        self.assertEqual(throttle.apply("rawdata", "0123456789abcdef", self.create_payload(1)), (None, 1))
+        throttle.clock = lambda: 126.0
+        payload = self.create_payload(1)
+        self.assertEqual(throttle.apply("rawdata", "0123456789abcdef", payload), (payload, 0))
+
+    def test_sampled_rows_are_evenly_spaced_in_time(self):
+        throttle = IngestThrottle(dev_rate=1, dev_burst=2, policy="sample")
+        throttle.clock = lambda: 100.0
+        payload = {str(1700000001000 + idx * 1000): {"temp1": {"v": 20.5}} for idx in (3, 1, 2, 0)}
+        sampled_payload, num_throttled = throttle.apply("rawdata", "0123456789abcdef", payload)
+        self.assertEqual((list(sampled_payload), num_throttled), (["1700000001000", "1700000003000"], 2))
+
+
+class IngestSpoolTest(TestCase):
+
+    def setUp(self):
+        device_config_cache.invalidate()
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.spool_dir.cleanup)
+        self.dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        Datastream.objects.create(name="temp1", data_type=DataType.objects.create(name="Temperature"), parent=self.dev)
+
+    def create_payload(self, *tss: int) -> dict:
+        return {str(ts): {"temp1": {"v": 20.5}} for ts in tss}
+
+    def test_live_payloads_wait_for_spooled_ones(self):
+        spool = IngestSpool(spool_dir=self.spool_dir.name)
+        pool = IngestWorkerPool(num_workers=0, stats_interval_s=0, spool=spool)
+        dev_ui = self.dev.dev_ui
+
+        # spilled (e.g. the db was not available), then a newer live payload
+        pool.spill(dev_ui, self.create_payload(1700000001000, 1700000002000))
+        pool.submit(dev_ui, self.create_payload(1700000003000))
+        self.assertTrue(spool.has_pending(dev_ui))
+        self.assertEqual(DsReading.objects.count(), 0)
+
+        spool.drain(process_dev_payload)
+        self.assertFalse(spool.has_pending(dev_ui))
+        self.assertEqual(DsReading.objects.count(), 3)
+        self.assertEqual(UnusedDsReading.objects.count(), 0)
+
+        # the live payloads are processed directly again
+        pool.submit(dev_ui, self.create_payload(1700000004000))
+        self.assertEqual(DsReading.objects.count(), 4)
+        self.assertEqual(pool.counters.snapshot()["spilled"], 2)
+
+    def test_pending_devices_are_loaded_from_segments(self):
+        spool = IngestSpool(spool_dir=self.spool_dir.name)
+        spool.append(self.dev.dev_ui, self.create_payload(1700000001000))
+        with spool.lock:
+            spool.close_segment()
+        # a new process finds the segment
+        spool = IngestSpool(spool_dir=self.spool_dir.name)
+        self.assertTrue(spool.has_pending(self.dev.dev_ui))
+        self.assertFalse(spool.has_pending("fedcba9876543210"))
+
+    def test_segments_over_limits_are_dropped(self):
+        line_size = len(json.dumps({"0123456789abcdef": self.create_payload(1000)})) + 1
+        spool = IngestSpool(spool_dir=self.spool_dir.name, segment_max_bytes=3 * line_size, max_bytes=7 * line_size)
+        for ts in (1000, 2000, 3000):
+            spool.append("0123456789abcdef", self.create_payload(ts))
+        for ts in range(1000, 7000, 1000):
+            spool.append("fedcba9876543210", self.create_payload(ts))
+        # three segments of three payloads, the oldest one is dropped when the third one is closed
+        self.assertEqual(spool.stats()["spool_segments"], 2)
+        self.assertEqual(spool.stats()["spool_dropped_segments"], 1)
+        self.assertFalse(spool.has_pending("0123456789abcdef"))
+        self.assertTrue(spool.has_pending("fedcba9876543210"))
+
+        spool = IngestSpool(spool_dir=self.spool_dir.name, max_age_s=3600)
+        for path in spool.get_segment_paths():
+            os.utime(path, (0, 0))
+        spool.enforce_limits()
+        self.assertEqual(spool.stats()["spool_segments"], 0)
+        self.assertFalse(spool.has_pending("fedcba9876543210"))
+
+    def test_segments_are_replayed_in_order(self):
+        spool = IngestSpool(spool_dir=self.spool_dir.name, batch_max_rows=2)
+        spool.append("0123456789abcdef", self.create_payload(3000))
+        spool.append("fedcba9876543210", self.create_payload(1000))
+        spool.append("0123456789abcdef", self.create_payload(1000, 2000))
+        with spool.lock:
+            spool.close_segment()
+        spool.append("0123456789abcdef", self.create_payload(4000))
+        calls = []
+        outcomes = [ProcessingOutcomes.PROCESSED, ProcessingOutcomes.DB_ERROR]  # the db fails in the first segment
+
+        def process(dev_ui: str, payload: dict):
+            calls.append((dev_ui, list(payload)))
+            return outcomes.pop(0) if len(outcomes) > 0 else ProcessingOutcomes.PROCESSED
+
+        spool.drain(process)
+        self.assertEqual(spool.stats()["spool_segments"], 2)
+        self.assertTrue(spool.has_pending("fedcba9876543210"))
+
+        calls.clear()
+        spool.drain(process)  # the first segment is replayed from the beginning
+        self.assertEqual(
+            calls,
+            [
+                ("0123456789abcdef", ["1000", "2000"]),
+                ("0123456789abcdef", ["3000"]),
+                ("fedcba9876543210", ["1000"]),
+                ("0123456789abcdef", ["4000"]),
+            ],
+        )
+        stats = spool.stats()
+        # the rows of the batch written before the db error are replayed twice
+        self.assertEqual((stats["spool_segments"], stats["spool_replayed_rows"]), (0, 7))
+        self.assertFalse(spool.has_pending("0123456789abcdef"))
+
+    def test_resent_rows_are_replayed_after_earlier_ones(self):
+        spool = IngestSpool(spool_dir=self.spool_dir.name)
+        dev_ui = self.dev.dev_ui
+        spool.append(dev_ui, {"1000": {"e": {"Low battery": {"st": "in"}}}, "3000": {"temp1": {"v": 20.5}}})
+        spool.append(dev_ui, {"1000": {"e": {"Low battery": {"st": "out"}}}, "2000": {"temp1": {"v": 20.6}}})
+        with spool.lock:
+            spool.close_segment()
+        calls = []
+        spool.drain(lambda dev_ui, payload: calls.append((dev_ui, payload)) or ProcessingOutcomes.PROCESSED)
+        self.assertEqual(
+            calls,
+            [
+                (dev_ui, {"1000": {"e": {"Low battery": {"st": "in"}}}}),
+                (
+                    dev_ui,
+                    {
+                        "1000": {"e": {"Low battery": {"st": "out"}}},
+                        "2000": {"temp1": {"v": 20.6}},
+                        "3000": {"temp1": {"v": 20.5}},
+                    },
+                ),
+            ],
+        )
+
+
+class RecordingProcessor:
+    """A 'process_func' without the db, it can hold the worker until released."""
+
+    def __init__(self, is_held: bool = False):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+        if not is_held:
+            self.released.set()
+
+    def __call__(self, dev_ui: str, payload: dict):
+        self.started.set()
+        self.released.wait(5)
+        with self.lock:
+            self.calls.append((dev_ui, list(payload)))
+        return ProcessingOutcomes.PROCESSED
+
+
+class IngestWorkerPoolTest(TestCase):
+
+    def create_pool(self, processor: RecordingProcessor, **kwargs) -> IngestWorkerPool:
+        kwargs = {"num_workers": 1, "queue_size": 100, "policy": "block", "batch_window_ms": 0} | kwargs
+        pool = IngestWorkerPool(processor, stats_interval_s=0, spool_drain_interval_s=3600, **kwargs)
+        pool.start()
+        return pool
+
+    def hold_worker(self, pool: IngestWorkerPool, processor: RecordingProcessor):
+        """The worker takes the first payload and waits, so the next ones stay in the queue."""
+        pool.submit("0123456789abcdef", {"1000": {}})
+        self.assertTrue(processor.started.wait(5))
+
+    def test_payloads_of_device_are_processed_in_order(self):
+        processor = RecordingProcessor()
+        pool = self.create_pool(processor, num_workers=3)
+        dev_uis = [f"{idx:016x}" for idx in range(6)]
+        for ts in range(1000, 21000, 1000):
+            for dev_ui in dev_uis:
+                pool.submit(dev_ui, {str(ts): {}})
+        pool.stop()
+
+        for dev_ui in dev_uis:
+            tss = [payload_tss[0] for call_dev_ui, payload_tss in processor.calls if call_dev_ui == dev_ui]
+            self.assertEqual(tss, [str(ts) for ts in range(1000, 21000, 1000)])
+        self.assertEqual(pool.counters.snapshot()["processed"], 120)
+
+    def test_block_policy_waits_for_free_slot(self):
+        processor = RecordingProcessor(is_held=True)
+        pool = self.create_pool(processor, queue_size=1)
+        self.hold_worker(pool, processor)
+        pool.submit("0123456789abcdef", {"2000": {}})  # fills the queue
+        submitter = threading.Thread(target=pool.submit, args=("0123456789abcdef", {"3000": {}}))
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive())
+
+        processor.released.set()
+        submitter.join(5)
+        pool.stop()
+        self.assertEqual([tss for _, tss in processor.calls], [["1000"], ["2000"], ["3000"]])
+
+    def test_drop_oldest_policy_drops_queued_payload(self):
+        processor = RecordingProcessor(is_held=True)
+        pool = self.create_pool(processor, queue_size=2, policy=BackpressurePolicies.DROP_OLDEST)
+        self.hold_worker(pool, processor)
+        acks = [mock.Mock() for _ in range(3)]
+        for ts, ack in zip((2000, 3000, 4000), acks):
+            self.assertTrue(pool.submit("0123456789abcdef", {str(ts): {}}, ack))
+        processor.released.set()
+        pool.stop()
+        self.assertEqual([tss for _, tss in processor.calls], [["1000"], ["3000"], ["4000"]])
+        self.assertEqual(pool.counters.snapshot()["dropped"], 1)
+        # the message of the dropped payload is not acknowledged, as it is not written
+        self.assertEqual([ack.part_done.call_count for ack in acks], [0, 1, 1])
+
+    def test_spill_policy_spills_payload_that_does_not_fit(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        spool = IngestSpool(spool_dir=spool_dir.name)
+        processor = RecordingProcessor(is_held=True)
+        pool = self.create_pool(processor, queue_size=1, policy=BackpressurePolicies.SPILL, spool=spool)
+        self.hold_worker(pool, processor)
+        self.assertTrue(pool.submit("fedcba9876543210", {"2000": {}}))
+        ack = mock.Mock()
+        self.assertFalse(pool.submit("fedcba9876543210", {"3000": {}}, ack))
+        ack.part_done.assert_called_once()
+        self.assertTrue(spool.has_pending("fedcba9876543210"))
+
+        processor.released.set()
+        pool.stop()
+        # the queued payload of the device follows the spilled one into the spool, the replay sorts them
+        self.assertEqual([tss for _, tss in processor.calls], [["1000"]])
+        spool.drain(processor)
+        self.assertEqual(processor.calls[-1], ("fedcba9876543210", ["2000", "3000"]))
+        self.assertEqual(pool.counters.snapshot()["spilled"], 2)
+
+    def test_spilled_payloads_are_replayed_after_queued_ones_of_device(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        spool = IngestSpool(spool_dir=spool_dir.name)
+        processor = RecordingProcessor(is_held=True)
+        pool = self.create_pool(processor, queue_size=1, policy=BackpressurePolicies.SPILL, spool=spool)
+        dev_ui = "0123456789abcdef"
+        self.hold_worker(pool, processor)  # "1000" is being written
+        self.assertTrue(pool.submit(dev_ui, {"2000": {}}))
+        self.assertFalse(pool.submit(dev_ui, {"3000": {}}))
+        self.assertFalse(pool.submit(dev_ui, {"4000": {}}))
+        # the drainer does not replay the spilled payloads before the queued one
+        spool.drain(processor)
+        self.assertEqual(spool.stats()["spool_replayed"], 0)
+
+        processor.released.set()
+        pool.wait_until_processed()
+        self.assertEqual(spool.held_dev_uis, set())
+        spool.drain(processor)
+        pool.stop()
+        self.assertEqual(processor.calls, [(dev_ui, ["1000"]), (dev_ui, ["2000", "3000", "4000"])])
+
+    def test_queued_payloads_of_device_are_merged(self):
+        processor = RecordingProcessor(is_held=True)
+        pool = self.create_pool(processor, batch_window_ms=200)
+        self.hold_worker(pool, processor)
+        for dev_ui, ts in (("0123456789abcdef", 2000), ("fedcba9876543210", 2000), ("0123456789abcdef", 3000)):
+            pool.submit(dev_ui, {str(ts): {}})
+        processor.released.set()
+        pool.stop()
+        self.assertEqual(
+            processor.calls,
+            [
+                ("0123456789abcdef", ["1000"]),
+                ("0123456789abcdef", ["2000", "3000"]),
+                ("fedcba9876543210", ["2000"]),
+            ],
+        )
+        self.assertEqual(pool.counters.snapshot()["batches"], 3)
+
+    def test_queued_payloads_are_processed_on_stop(self):
+        processor = RecordingProcessor(is_held=True)
+        pool = self.create_pool(processor, num_workers=2)
+        self.hold_worker(pool, processor)
+        for ts in range(2000, 12000, 1000):
+            pool.submit("fedcba9876543210", {str(ts): {}})
+        stopper = threading.Thread(target=pool.stop)
+        stopper.start()
+        processor.released.set()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+        self.assertEqual(len(processor.calls), 11)
+        self.assertEqual(pool.get_queue_depth(), 0)
+
+
+class MergeDevPayloadsTest(TestCase):
+
+    def test_payloads_are_merged_per_device(self):
+        first_payload = {"1000": {"temp1": {"v": 1}}, "2000": {"temp1": {"v": 2}}}
+        merged_payload = first_payload | {"3000": {"temp1": {"v": 4}}}
+        items = [
+            ("0123456789abcdef", first_payload),
+            ("fedcba9876543210", {"1000": {"temp1": {"v": 3}}}),
+            ("0123456789abcdef", {"3000": {"temp1": {"v": 4}}}),
+        ]
+        self.assertEqual(
+            merge_dev_payloads(items),
+            [
+                ("0123456789abcdef", merged_payload),
+                ("fedcba9876543210", {"1000": {"temp1": {"v": 3}}}),
+            ],
+        )
+        self.assertEqual(list(first_payload), ["1000", "2000"])  # the submitted payloads are not changed
+
+    def test_payloads_are_not_merged_out_of_order(self):
+        items = [
+            ("0123456789abcdef", {"2000": {}, "3000": {}}),
+            ("0123456789abcdef", {"3000": {}}),  # a re-sent row
+            ("0123456789abcdef", {"1000": {}}),  # a late row
+            ("0123456789abcdef", {"4000": {}}),
+            ("0123456789abcdef", {"x": {}}),  # no timestamps, processed as it is
+            ("0123456789abcdef", {"5000": {}}),
+        ]
+        self.assertEqual(
+            [list(payload) for _, payload in merge_dev_payloads(items)],
+            [["2000", "3000"], ["3000"], ["1000", "4000"], ["x"], ["5000"]],
+        )
+
+
+class IngestRouterTest(TestCase):
+
+    def setUp(self):
+        self.processor = RecordingProcessor()
+        self.pool = IngestWorkerPool(self.processor, num_workers=0, stats_interval_s=0)
+        self.client = mock.Mock()
+        self.no_throttle = IngestThrottle(dev_rate=0, topic_rate=0)
+        self.dev_uis = [f"{idx:016x}" for idx in range(30)]
+
+    def test_every_device_has_one_owner(self):
+        owner_idxs = [get_owner_idx(dev_ui, 3) for dev_ui in self.dev_uis]
+        self.assertEqual(owner_idxs, [get_owner_idx(dev_ui, 3) for dev_ui in self.dev_uis])
+        self.assertEqual(set(owner_idxs), {0, 1, 2})
+        with self.assertRaises(ValueError):
+            IngestRouter(self.pool, instance_idx=3, num_instances=3)
+
+    def test_payloads_of_not_owned_devices_are_forwarded(self):
+        router = IngestRouter(self.pool, 1, 3, fwd_topic_prefix="monapps/fwd", throttle=self.no_throttle)
+        for dev_ui in self.dev_uis:
+            ack = mock.Mock()
+            router.route(self.client, dev_ui, {"1000": {}}, ack=ack)
+            # the own payloads wait for the worker, the forwarded ones for the broker
+            self.assertEqual(ack.add_part.call_count, 1)
+
+        owned_dev_uis = [dev_ui for dev_ui in self.dev_uis if get_owner_idx(dev_ui, 3) == 1]
+        self.assertEqual([dev_ui for dev_ui, _ in self.processor.calls], owned_dev_uis)
+        published = [
+            (call.args[0], json.loads(call.args[1]), call.kwargs) for call in self.client.publish.call_args_list
+        ]
+        self.assertEqual(
+            published,
+            [
+                (f"monapps/fwd/{get_owner_idx(dev_ui, 3)}", {dev_ui: {"1000": {}}}, {"qos": 1})
+                for dev_ui in self.dev_uis
+                if dev_ui not in owned_dev_uis
+            ],
+        )
+        self.assertEqual(self.pool.counters.snapshot()["forwarded"], len(self.dev_uis) - len(owned_dev_uis))
+
+    def test_forwarded_payloads_are_processed_locally(self):
+        router = IngestRouter(self.pool, 1, 3, fwd_topic_prefix="monapps/fwd", throttle=self.no_throttle)
+        self.assertTrue(router.is_fwd_topic("monapps/fwd/1"))
+        for dev_ui in self.dev_uis:
+            router.route(self.client, dev_ui, {"1000": {}}, is_forwarded=True)
+        self.assertEqual(len(self.processor.calls), len(self.dev_uis))
+        self.client.publish.assert_not_called()
+
+    def test_throttle_is_applied_before_forwarding(self):
+        throttle = IngestThrottle(dev_rate=1, dev_burst=2, policy="drop")
+        throttle.clock = lambda: 100.0
+        router = IngestRouter(self.pool, 0, 2, throttle=throttle)
+        dev_ui = next(dev_ui for dev_ui in self.dev_uis if get_owner_idx(dev_ui, 2) == 1)
+        payload = {"1000": {}, "2000": {}}
+        router.route(self.client, dev_ui, payload)
+        router.route(self.client, dev_ui, {"3000": {}})  # over the limit, not forwarded
+        self.assertEqual(self.client.publish.call_count, 1)
+        # the owner does not limit the forwarded payloads again
+        router.route(self.client, dev_ui, {"3000": {}}, is_forwarded=True)
+        self.assertEqual(self.processor.calls, [(dev_ui, ["3000"])])
+
+
+    def create_fwd_router(self) -> tuple[IngestRouter, MessageAckTracker, str]:
+        router = IngestRouter(
+            self.pool,
+            0,
+            2,
+            fwd_topic_prefix="monapps/fwd",
+            ack_tracker=MessageAckTracker(self.pool.counters),
+            throttle=self.no_throttle,
+        )
+        mids = iter(range(1, 100))
+        self.client.publish.side_effect = lambda *args, **kwargs: SimpleNamespace(mid=next(mids))
+        dev_ui = next(dev_ui for dev_ui in self.dev_uis if get_owner_idx(dev_ui, 2) == 1)
+        return router, router.ack_tracker, dev_ui
+
+    def test_forwarded_message_is_acked_after_publication(self):
+        router, tracker, dev_ui = self.create_fwd_router()
+        ack = tracker.create(self.client, SimpleNamespace(mid=7, qos=1))
+        router.route(self.client, dev_ui, {"1000": {}}, ack=ack)
+        ack.part_done()  # the message is decoded and routed
+        self.client.ack.assert_not_called()
+
+        router.on_published(1)
+        self.client.ack.assert_called_once_with(7, 1)
+        self.assertEqual(router.fwd_acks, {})
+
+    def test_forwarded_message_is_acked_if_published_before_registered(self):
+        router, tracker, dev_ui = self.create_fwd_router()
+        # the network thread can get the PUBACK before 'publish' returns
+        router.on_published(1)
+        ack = tracker.create(self.client, SimpleNamespace(mid=7, qos=1))
+        router.route(self.client, dev_ui, {"1000": {}}, ack=ack)
+        ack.part_done()
+        self.client.ack.assert_called_once_with(7, 1)
+        self.assertEqual(router.early_published_mids, set())
+
+    def test_forwarded_message_is_not_acked_if_publication_failed(self):
+        router, tracker, dev_ui = self.create_fwd_router()
+        ack = tracker.create(self.client, SimpleNamespace(mid=7, qos=1))
+        router.route(self.client, dev_ui, {"1000": {}}, ack=ack)
+        ack.part_done()
+        router.on_published(1, is_failure=True)
+        # the broker delivers it again after a reconnect
+        self.client.ack.assert_not_called()
+        self.assertEqual(router.fwd_acks, {})
+
+    def test_late_forwarded_readings_need_reorder_window(self):
+        device_config_cache.invalidate()
+        dev = Device.objects.create(name="Diagn kit", dev_ui="0123456789abcdef")
+        ds = Datastream.objects.create(name="temp1", data_type=DataType.objects.create(name="Temperature"), parent=dev)
+        pool = IngestWorkerPool(num_workers=0, stats_interval_s=0)
+        owner_idx = get_owner_idx(dev.dev_ui, 2)
+        router = IngestRouter(pool, owner_idx, 2, throttle=self.no_throttle)
+        now_ts = create_now_ts_ms()
+
+        # the newer payload came to the owner directly, the older one was forwarded by the other instance
+        router.route(self.client, dev.dev_ui, {str(now_ts - 60000): {"temp1": {"v": 20.5}}})
+        router.route(self.client, dev.dev_ui, {str(now_ts - 120000): {"temp1": {"v": 20.0}}}, is_forwarded=True)
+        self.assertEqual((DsReading.objects.count(), UnusedDsReading.objects.count()), (1, 1))
+
+        ds.reorder_window = 600000
+        ds.save()
+        device_config_cache.invalidate()
+        router.route(self.client, dev.dev_ui, {str(now_ts - 30000): {"temp1": {"v": 21.0}}})
+        router.route(self.client, dev.dev_ui, {str(now_ts - 45000): {"temp1": {"v": 20.8}}}, is_forwarded=True)
+        self.assertEqual((DsReading.objects.count(), UnusedDsReading.objects.count()), (3, 1))
+
+
+class MessageAckTest(TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.msg = SimpleNamespace(mid=7, qos=1)
+
+    def test_message_is_acked_after_its_payloads_are_written(self):
+        processor = RecordingProcessor(is_held=True)
+        pool = IngestWorkerPool(processor, num_workers=2, batch_window_ms=0, stats_interval_s=0)
+        pool.start()
+        tracker = MessageAckTracker(pool.counters)
+        ack = tracker.create(self.client, self.msg)
+        for dev_ui in ("0123456789abcdef", "fedcba9876543210"):
+            pool.submit(dev_ui, {"1000": {}}, ack)
+        ack.part_done()  # the message is decoded and routed
+        self.assertTrue(processor.started.wait(5))
+        self.client.ack.assert_not_called()
+        self.assertEqual(pool.counters.snapshot()["in_flight"], 1)
+
+        processor.released.set()
+        pool.wait_until_processed()
+        self.client.ack.assert_called_once_with(7, 1)
+        pool.stop()
+        counters = pool.counters.snapshot()
+        self.assertEqual((counters["acked"], counters["in_flight"]), (1, 0))
+
+    def test_message_is_not_acked_if_not_written(self):
+        pool = IngestWorkerPool(lambda dev_ui, payload: ProcessingOutcomes.DB_ERROR, num_workers=0, stats_interval_s=0)
+        tracker = MessageAckTracker(pool.counters)
+        ack = tracker.create(self.client, self.msg)
+        pool.submit("0123456789abcdef", {"1000": {}}, ack)
+        ack.part_done()
+        # the broker delivers it again after the restart
+        self.client.ack.assert_not_called()
+        self.assertEqual(pool.counters.snapshot()["in_flight"], 1)
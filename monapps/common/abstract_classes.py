@@ -13,6 +13,7 @@ from utils.ts_utils import create_dt_from_ts_ms, create_now_ts_ms
 # from services.alarm_log import add_to_alarm_log
 from utils.update_utils import enqueue_update, update_reeval_fields
 from services.mqtt_publisher import mqtt_publisher
+from services.device_config_cache import device_config_cache
 
 logger = logging.getLogger("#abs_classes")
 
@@ -42,6 +43,7 @@ class PublishingOnSaveModel(models.Model):
         logger.debug(f"<{get_instance_full_id(self)}>: Saving")
         message_type = "c" if self.pk is None else "u"
         super().save(**kwargs)
+        device_config_cache.on_instance_changed(self, kwargs.get("update_fields"))
         # 'update_fields' is used to collect the names of the fields that were changed.
         # It will then be used in the 'save' method and reset.
         # To align with the Django 'save' method signature, this field should be
@@ -108,6 +110,7 @@ class PublishingOnSaveModel(models.Model):
         id = self.id
         del_result = super().delete(using, keep_parents)
         self.id = id
+        device_config_cache.on_instance_changed(self)
         self.publish_on_mqtt(set(), "d")
         self.total_parent_update()
 
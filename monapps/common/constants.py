@@ -153,3 +153,36 @@ class MeasUnits(models.TextChoices):
 
 
 reeval_fields = {"status", "curr_state", "health"}
+
+
+class BackpressurePolicies(models.TextChoices):  # what to do when an ingestion queue is full
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    SPILL = "spill"  # put the payload into the spool, it is written into the db later
+
+
+class ThrottlePolicies(models.TextChoices):  # what to do with the rows over the ingest rate limits
+    DROP = "drop"
+    SPILL = "spill"  # put the payload into the spool, it is written into the db later
+    SAMPLE = "sample"  # keep as many rows (evenly spaced) as the limits allow, drop the rest
+
+
+class ProcessingOutcomes(models.TextChoices):  # the result of processing of a device payload
+    PROCESSED = "processed"
+    UNKNOWN_DEVICE = "unknown_device"
+    NO_VALID_TSS = "no_valid_tss"
+    DUPLICATE = "duplicate"  # all the rows were processed already
+    DB_ERROR = "db_error"  # the db is not available, it makes sense to try again later
+    ERROR = "error"
+
+
+class LogTypes(models.IntegerChoices):
+    DEVICE = 1  # alarms that come from devices, tied to the timestamps of the payloads
+    APP = 2  # alarms of app function executions
+    ALARM = 3  # real-time alarms of the system itself
+
+
+class LogLevels(models.IntegerChoices):
+    INFO = 1
+    WARNING = 2
+    ERROR = 3
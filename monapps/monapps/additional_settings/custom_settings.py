@@ -1,6 +1,20 @@
 # Monitoring Application settings
 NUM_MAX_DFREADINGS_TO_PROCESS = 50000
 NUM_MAX_DSREADINGS_TO_PROCESS = 100000
+# ds readings of a batch are streamed from the db in chunks of this size (a server-side cursor on PostgreSQL)
+DSREADINGS_FETCH_CHUNK_SIZE = 10000
+# the ds readings of the unclosed df readings are kept in the resampling state of a datafeed for the next run
+# (instead of reading them again), if there are not more of them than this
+RESAMPLING_STATE_MAX_DSREADINGS = 1000
+# the datafeeds of different apps that read the same datastream with the same settings (see 'ResamplingKey')
+# get one series computed once and written for all of them
+DFR_SHARED_RESAMPLING = True
+# the datafeeds of an app are resampled by a pool of this many threads (with their own db connections),
+# 0 or 1 - one by one; for PostgreSQL, SQLite takes one writer at a time
+DFR_CREATOR_NUM_WORKERS = 0
+# the task sent by the ingestion ("evaluate.dirty_dfs") also runs the app functions of the apps it resampled,
+# otherwise they run on their own schedule only
+DIRTY_DFS_RUN_APP_FUNC = False
 MIN_TIME_RESOL_MS = 1000
 MIN_TIME_APP_FUNC_INVOC_MS = 60000
 
@@ -19,3 +33,30 @@ MAX_DEVICES_TO_UPD = 50
 
 # it is datetime(2999, 12, 31, 23, 59, 59, 999999, tzinfo=timezone.utc), something similar to Infinity
 MAX_TS_MS = 32503679999999
+
+# Ingestion settings
+# how long the device configuration (dev_ui -> device, data types) is cached by the processes
+# that ingest raw data, changes made in the same process invalidate the cache immediately
+INGEST_CONFIG_CACHE_TTL_MS = 60000
+# unknown devices are cached much shorter, so a device provisioned in another process is found soon
+INGEST_CONFIG_CACHE_MISS_TTL_MS = 2000
+# re-sent rows (the same timestamp and values) are dropped before processing, the timestamps of the last
+# 'INGEST_DEDUP_TSS_PER_DS' processed values are kept for up to 'INGEST_DEDUP_MAX_DSS' datastreams (0 - no filter)
+INGEST_DEDUP_TSS_PER_DS = 256
+INGEST_DEDUP_MAX_DSS = 100000
+# payloads of unknown devices, without valid timestamps or failed with an error are kept in the dead letter table
+INGEST_DEAD_LETTERS_ON = True
+
+# how readings are written into the db: "auto" - by the db vendor (COPY for PostgreSQL), "orm" - 'bulk_create' only
+BULK_WRITER_BACKEND = "auto"
+BULK_WRITER_BATCH_SIZE = 1000
+BULK_WRITER_COPY_MIN_ROWS = 500  # smaller batches are written with a multi-row INSERT
+
+# Log store settings
+# the device/app/alarm log records are written into the db in bulk, when 'LOG_STORE_MAX_RECORDS' are collected
+# or 'LOG_STORE_FLUSH_INTERVAL_MS' passed since the first collected record (the records added within a transaction
+# are collected only after the commit); the processes without the flusher thread (see 'LogStore') write them right away
+LOG_STORE_MAX_RECORDS = 500
+LOG_STORE_FLUSH_INTERVAL_MS = 2000
+LOG_STORE_ECHO = False  # also print the records into the console when they are written
+LOG_API_MAX_LIMIT = 1000  # the max number of records in one page of the API
@@ -3,3 +3,68 @@ import os
 # MQTT publisher settings
 # this name will be included into the topic of published messages
 MONAPP_INSTANCE_ID = os.environ.get("MONAPP_INSTANCE_ID", "some_instance")
+
+# MQTT subscriber settings
+MQTT_SUB_CLIENT_ID = os.environ.get("MQTT_SUB_CLIENT_ID", "monappsV3")
+# several subscriber processes can share the subscription, in this case set the group name
+# and give every process its own index (0...MQTT_SUB_NUM_INSTANCES-1),
+# every process gets the client id "<MQTT_SUB_CLIENT_ID>-<index>"
+MQTT_SUB_SHARE_GROUP = os.environ.get("MQTT_SUB_SHARE_GROUP", "")
+MQTT_SUB_NUM_INSTANCES = int(os.environ.get("MQTT_SUB_NUM_INSTANCES", 1))
+MQTT_SUB_INSTANCE_IDX = int(os.environ.get("MQTT_SUB_INSTANCE_IDX", 0))
+# payloads of the devices owned by another process are forwarded to "<prefix>/<owner index>",
+# they can reach the owner after newer payloads of the device, so the datastreams should have a reorder window
+MQTT_SUB_FWD_TOPIC_PREFIX = os.environ.get("MQTT_SUB_FWD_TOPIC_PREFIX", "monapps/fwd")
+# number of worker threads that process incoming payloads, payloads are sharded between workers by 'dev_ui',
+# 0 means that payloads are processed right in the MQTT network thread
+MQTT_SUB_NUM_WORKERS = int(os.environ.get("MQTT_SUB_NUM_WORKERS", 4))
+MQTT_SUB_QUEUE_SIZE = int(os.environ.get("MQTT_SUB_QUEUE_SIZE", 1000))  # max number of payloads per worker queue
+# what to do when a worker queue is full: "block", "drop_oldest" (not with QoS 1) or "spill"
+MQTT_SUB_BACKPRESSURE = os.environ.get("MQTT_SUB_BACKPRESSURE", "block")
+# the spool keeps the payloads that did not fit into the queues ("spill") or could not be written into the db,
+# they are written into the db in the background when it is available again
+MQTT_SUB_SPOOL_DIR = os.environ.get("MQTT_SUB_SPOOL_DIR", "/tmp/monapps_spool")
+MQTT_SUB_SPOOL_SEGMENT_MB = int(os.environ.get("MQTT_SUB_SPOOL_SEGMENT_MB", 16))
+MQTT_SUB_SPOOL_MAX_MB = int(os.environ.get("MQTT_SUB_SPOOL_MAX_MB", 1024))  # the oldest segments are dropped above
+MQTT_SUB_SPOOL_MAX_AGE_H = int(os.environ.get("MQTT_SUB_SPOOL_MAX_AGE_H", 168))  # older segments are dropped
+MQTT_SUB_SPOOL_DRAIN_INTERVAL_S = int(os.environ.get("MQTT_SUB_SPOOL_DRAIN_INTERVAL_S", 10))
+# payloads of the same device that come within the window are merged and processed in one transaction,
+# 0 - no batching
+MQTT_SUB_BATCH_WINDOW_MS = int(os.environ.get("MQTT_SUB_BATCH_WINDOW_MS", 0))
+MQTT_SUB_BATCH_MAX_ROWS = int(os.environ.get("MQTT_SUB_BATCH_MAX_ROWS", 1000))  # max timestamps in one batch
+MQTT_SUB_STATS_INTERVAL_S = int(os.environ.get("MQTT_SUB_STATS_INTERVAL_S", 60))  # 0 - do not log the counters
+# "auto" - 'orjson' if it is installed, otherwise 'json' from the standard library, or one of them explicitly
+MQTT_SUB_JSON_BACKEND = os.environ.get("MQTT_SUB_JSON_BACKEND", "auto")
+# 0 - messages are received with QoS 0 and can be lost if the subscriber cannot keep up,
+# 1 - messages are received with QoS 1 (MQTT v5, persistent session) and acknowledged only after they are
+# written into the db, the broker keeps the rest while the db is slow or unavailable
+MQTT_SUB_QOS = int(os.environ.get("MQTT_SUB_QOS", 0))
+MQTT_SUB_MAX_INFLIGHT = int(os.environ.get("MQTT_SUB_MAX_INFLIGHT", 100))  # max not acknowledged messages (QoS 1)
+MQTT_SUB_SESSION_EXPIRY_S = int(os.environ.get("MQTT_SUB_SESSION_EXPIRY_S", 3600))  # how long the broker keeps them
+MQTT_SUB_DB_RETRY_MAX_S = int(os.environ.get("MQTT_SUB_DB_RETRY_MAX_S", 30))  # max delay between retries (QoS 1)
+# how the device payload is taken from Chirpstack uplink events:
+# "codec" - from "object" (made by the JS codec of the device profile in Chirpstack),
+# "raw" - decoded here from the frame in "data" if there is a frame decoder for the device profile, otherwise "object"
+MQTT_SUB_CHIRPSTACK_DECODING = os.environ.get("MQTT_SUB_CHIRPSTACK_DECODING", "codec")
+# "device profile name=decoder name;...", the decoders are in 'services.frame_decoders'
+MQTT_SUB_FRAME_DECODERS = dict(
+    tuple(part.strip() for part in item.split("=", 1))
+    for item in os.environ.get("MQTT_SUB_FRAME_DECODERS", "Enless diagnostic kit=enless_diagn_kit").split(";")
+    if "=" in item
+)
+# token-bucket limits of incoming rows (timestamps) per device and per topic prefix (the first
+# MQTT_SUB_THROTTLE_TOPIC_LEVELS levels of the topic), 0 - no limit; the bursts are the sizes of the buckets
+MQTT_SUB_THROTTLE_DEV_ROWS_S = float(os.environ.get("MQTT_SUB_THROTTLE_DEV_ROWS_S", 0))
+MQTT_SUB_THROTTLE_DEV_BURST = int(os.environ.get("MQTT_SUB_THROTTLE_DEV_BURST", 100))
+MQTT_SUB_THROTTLE_TOPIC_ROWS_S = float(os.environ.get("MQTT_SUB_THROTTLE_TOPIC_ROWS_S", 0))
+MQTT_SUB_THROTTLE_TOPIC_BURST = int(os.environ.get("MQTT_SUB_THROTTLE_TOPIC_BURST", 10000))
+MQTT_SUB_THROTTLE_TOPIC_LEVELS = int(os.environ.get("MQTT_SUB_THROTTLE_TOPIC_LEVELS", 2))
+# what to do with the rows over the limits: "drop", "spill" or "sample"; "drop" and "spill" do not split payloads,
+# a payload bigger than a burst is accepted only when the buckets are full (and takes the next tokens in advance)
+MQTT_SUB_THROTTLE_POLICY = os.environ.get("MQTT_SUB_THROTTLE_POLICY", "sample")
+# a throttled device is reported in the device log not more often than this
+MQTT_SUB_THROTTLE_LOG_INTERVAL_S = int(os.environ.get("MQTT_SUB_THROTTLE_LOG_INTERVAL_S", 60))
+# after new readings are committed, the subscriber sends the task that creates df readings for the dirty datafeeds
+# ("evaluate.dirty_dfs") with this delay, the readings committed till then are covered by the same task,
+# so the task is sent not more often than once per interval by a process; 0 - only the periodic app tasks do it
+MQTT_SUB_DFR_DISPATCH_INTERVAL_MS = int(os.environ.get("MQTT_SUB_DFR_DISPATCH_INTERVAL_MS", 0))
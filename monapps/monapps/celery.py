@@ -1,7 +1,22 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "monapps.settings")
 app = Celery("monapps")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def start_log_store_flusher(**kwargs):
+    from services.log_store import log_store
+
+    log_store.start_flusher()
+
+
+@worker_process_shutdown.connect
+def stop_log_store_flusher(**kwargs):
+    from services.log_store import log_store
+
+    log_store.stop_flusher()
@@ -36,8 +36,10 @@ INSTALLED_APPS = [
     "apps.devices",
     "apps.dfreadings",
     "apps.dsreadings",
+    "apps.logs",
     "apps.mqtt_sub",
     "apps.wait_for_db",
+    "apps.benchmarks",
 ]
 
 MIDDLEWARE = [
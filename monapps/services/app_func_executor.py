@@ -11,10 +11,11 @@ from common.constants import HealthGrades, STATUS_FIELD_NAME, CURR_STATE_FIELD_N
 from common.complex_types import AppFunction
 from utils.ts_utils import create_now_ts_ms
 from utils.sequnce_utils import find_instance_with_max_attr
-from utils.alarm_utils import update_alarm_map
+from utils.alarm_utils import AlarmMapEngine
 from utils.update_utils import enqueue_update, update_reeval_fields, set_attr_if_cond
 from services.alarm_log import add_to_alarm_log
 from services.app_log import add_to_app_log
+from services.bulk_writer import write_objects
 
 logger = logging.getLogger("#app_func_executor")
 
@@ -79,7 +80,8 @@ class AppFuncExecutor:
     def save_new_df_readings(self, new_df_readings):
         latest_dfr = find_instance_with_max_attr(new_df_readings)
         if latest_dfr is not None:  # the same as 'if len(new_df_readings) > 0'
-            DfReading.objects.bulk_create(new_df_readings)
+            # an IntegrityError is raised if some of them already exist
+            write_objects(DfReading, new_df_readings, ignore_conflicts=False)
             logger.debug("New df readings were saved")
         return latest_dfr
 
@@ -130,23 +132,20 @@ class AppFuncExecutor:
     def update_alarms(self):
         if (alarm_payload := self.update_map.get("alarm_payload")) is None:
             return
+        # the payload can have a row for every grid point, so the maps are updated in place
+        # and put back into the app only once
+        error_engine = AlarmMapEngine(self.app, "errors", add_to_log=add_to_app_log)
+        warning_engine = AlarmMapEngine(self.app, "warnings", add_to_log=add_to_app_log)
         for ts, row in alarm_payload.items():
-            error_dict = row.get("e")
-            upd_error_map, _ = update_alarm_map(
-                self.app, error_dict, ts, "errors", add_to_log=add_to_app_log
-            )
-            set_attr_if_cond(upd_error_map, "!=", self.app, "errors")
-
-            warning_dict = row.get("w")
-            upd_warning_map, _ = update_alarm_map(
-                self.app, warning_dict, ts, "warnings", add_to_log=add_to_app_log
-            )
-            set_attr_if_cond(upd_warning_map, "!=", self.app, "warnings")
+            error_engine.apply(row.get("e"), ts)
+            warning_engine.apply(row.get("w"), ts)
 
             app_infos_for_ts = row.get("i")
             if app_infos_for_ts is not None and isinstance(app_infos_for_ts, Iterable):
                 for info_str in app_infos_for_ts:
                     add_to_app_log("INFO", info_str, ts=ts, instance=self.app)
+        error_engine.save_to_instance()
+        warning_engine.save_to_instance()
 
     def update_state(self):
         if (state := self.update_map.get("state")) is None:
@@ -0,0 +1,198 @@
+import logging
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connection, models, transaction
+
+logger = logging.getLogger("#bulk_writer")
+
+
+class BulkWriteResult(NamedTuple):
+    num_saved: int
+    num_skipped: int  # objects that were not saved as the rows with the same pk already exist
+
+
+def get_pk_fields(model: type[models.Model]) -> list[models.Field]:
+    return list(getattr(model._meta, "pk_fields", [model._meta.pk]))
+
+
+def get_pk_value(obj: models.Model, pk_fields: list[models.Field]) -> tuple:
+    return tuple(getattr(obj, field.attname) for field in pk_fields)
+
+
+class OrmBulkWriter:
+    """
+    Writes objects with 'bulk_create', works with any db.
+    With 'ignore_conflicts' the pks of the objects are checked beforehand to count the skipped ones,
+    the caller should hold the locks that prevent concurrent writes of the same rows (as the ingestion does).
+    """
+
+    def __init__(self, batch_size: int = settings.BULK_WRITER_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def write(self, model: type[models.Model], objects: list, ignore_conflicts: bool = True) -> BulkWriteResult:
+        if len(objects) == 0:
+            return BulkWriteResult(0, 0)
+        if not ignore_conflicts:  # an IntegrityError is raised on a conflict
+            model.objects.bulk_create(objects, batch_size=self.batch_size)
+            return BulkWriteResult(len(objects), 0)
+
+        num_skipped = 0
+        for i in range(0, len(objects), self.batch_size):
+            batch = objects[i : i + self.batch_size]
+            num_existing = self.count_existing(model, batch)
+            model.objects.bulk_create(batch, batch_size=len(batch), ignore_conflicts=True)
+            num_skipped += num_existing
+        return BulkWriteResult(len(objects) - num_skipped, num_skipped)
+
+    def write_rows(
+        self, model: type[models.Model], attnames: tuple[str, ...], rows: Iterable[tuple], ignore_conflicts: bool = True
+    ) -> BulkWriteResult:
+        objects = [model(**dict(zip(attnames, row))) for row in rows]
+        return self.write(model, objects, ignore_conflicts)
+
+    def count_existing(self, model: type[models.Model], objects: list) -> int:
+        """Counts the objects whose pk is in the db already or repeats the pk of a previous object."""
+        pk_fields = get_pk_fields(model)
+        pk_values = [get_pk_value(obj, pk_fields) for obj in objects]
+        unique_pk_values = set(pk_values)
+        num_repeated = len(pk_values) - len(unique_pk_values)
+        # a composite 'pk__in' becomes a long OR expression on some dbs, so the values are grouped
+        # by the leading pk fields (e.g. 'datastream_id') and only the last field is looked up with 'in'
+        last_values_by_lead: dict[tuple, list] = {}
+        for pk_value in unique_pk_values:
+            last_values_by_lead.setdefault(pk_value[:-1], []).append(pk_value[-1])
+        num_existing = 0
+        for lead_value, last_values in last_values_by_lead.items():
+            lookup = {field.attname: value for field, value in zip(pk_fields, lead_value)}
+            lookup[f"{pk_fields[-1].attname}__in"] = last_values
+            num_existing += model.objects.filter(**lookup).count()
+        return num_repeated + num_existing
+
+
+class PgBulkWriter:
+    """
+    PostgreSQL writer. Small batches are written with a multi-row 'INSERT ... ON CONFLICT DO NOTHING',
+    big ones are copied into a temporary table with 'COPY' first and then inserted with
+    'INSERT ... SELECT ... ON CONFLICT DO NOTHING'. The number of saved rows is taken from the row count,
+    so no additional queries are needed to find the skipped ones.
+    """
+
+    max_query_params = 65535  # the limit of the PostgreSQL protocol
+
+    def __init__(
+        self,
+        batch_size: int = settings.BULK_WRITER_BATCH_SIZE,
+        copy_min_rows: int = settings.BULK_WRITER_COPY_MIN_ROWS,
+    ):
+        self.batch_size = batch_size
+        self.copy_min_rows = copy_min_rows
+
+    def write(self, model: type[models.Model], objects: list, ignore_conflicts: bool = True) -> BulkWriteResult:
+        if len(objects) == 0:
+            return BulkWriteResult(0, 0)
+        fields = model._meta.local_concrete_fields
+        rows = [
+            tuple(field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields)
+            for obj in objects
+        ]
+        return self.write_prepared_rows(model, fields, rows, ignore_conflicts)
+
+    def write_rows(
+        self, model: type[models.Model], attnames: tuple[str, ...], rows: Iterable[tuple], ignore_conflicts: bool = True
+    ) -> BulkWriteResult:
+        """The values of the rows are saved as they are, no model instances are created."""
+        rows = rows if isinstance(rows, list) else list(rows)
+        if len(rows) == 0:
+            return BulkWriteResult(0, 0)
+        fields = [model._meta.get_field(attname) for attname in attnames]
+        return self.write_prepared_rows(model, fields, rows, ignore_conflicts)
+
+    def write_prepared_rows(
+        self, model: type[models.Model], fields: list[models.Field], rows: list[tuple], ignore_conflicts: bool
+    ) -> BulkWriteResult:
+        conflict_sql = " ON CONFLICT DO NOTHING" if ignore_conflicts else ""
+        with transaction.atomic(savepoint=False):
+            if len(rows) >= self.copy_min_rows:
+                num_saved = self.write_with_copy(model, fields, rows, conflict_sql)
+            else:
+                num_saved = self.write_with_insert(model, fields, rows, conflict_sql)
+        return BulkWriteResult(num_saved, len(rows) - num_saved)
+
+    def write_with_insert(self, model, fields, rows, conflict_sql) -> int:
+        qn = connection.ops.quote_name
+        columns_sql = ", ".join(qn(field.column) for field in fields)
+        row_sql = f"({', '.join(['%s'] * len(fields))})"
+        batch_size = min(self.batch_size, self.max_query_params // len(fields))
+        num_saved = 0
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i : i + batch_size]
+                cursor.execute(
+                    f"INSERT INTO {qn(model._meta.db_table)} ({columns_sql}) "
+                    f"VALUES {', '.join([row_sql] * len(batch))}{conflict_sql}",
+                    [value for row in batch for value in row],
+                )
+                num_saved += cursor.rowcount
+        return num_saved
+
+    def write_with_copy(self, model, fields, rows, conflict_sql) -> int:
+        qn = connection.ops.quote_name
+        table_name = qn(model._meta.db_table)
+        tmp_table_name = qn(f"tmp_{model._meta.db_table}")
+        columns_sql = ", ".join(qn(field.column) for field in fields)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {tmp_table_name} "
+                f"(LIKE {table_name} INCLUDING DEFAULTS EXCLUDING CONSTRAINTS) ON COMMIT DROP"
+            )
+            # 'copy' is a method of the psycopg cursor, so the errors are wrapped here explicitly
+            with connection.wrap_database_errors:
+                with cursor.cursor.copy(f"COPY {tmp_table_name} ({columns_sql}) FROM STDIN") as copy:
+                    for row in rows:
+                        copy.write_row(row)
+            cursor.execute(
+                f"INSERT INTO {table_name} ({columns_sql}) SELECT {columns_sql} FROM {tmp_table_name}{conflict_sql}"
+            )
+            num_saved = cursor.rowcount
+            # the same model can be written again in the same transaction
+            cursor.execute(f"DROP TABLE {tmp_table_name}")
+        return num_saved
+
+
+bulk_writer_classes = {
+    "orm": OrmBulkWriter,
+    "postgresql": PgBulkWriter,
+}
+
+
+def get_bulk_writer() -> OrmBulkWriter | PgBulkWriter:
+    """'BULK_WRITER_BACKEND' "auto" selects the writer by the db vendor, 'bulk_create' is used for unknown ones."""
+    backend = settings.BULK_WRITER_BACKEND
+    if backend == "auto":
+        backend = connection.vendor if connection.vendor in bulk_writer_classes else "orm"
+    if backend not in bulk_writer_classes:
+        raise ValueError(f"Unknown bulk writer backend: {backend}")
+    return bulk_writer_classes[backend]()
+
+
+def write_rows(
+    model: type[models.Model], attnames: tuple[str, ...], rows: Iterable[tuple], ignore_conflicts: bool = True
+) -> BulkWriteResult:
+    """
+    Writes rows of values of the fields 'attnames' (the values should be ready for the db),
+    the PostgreSQL writer saves them without creating model instances.
+    """
+    result = get_bulk_writer().write_rows(model, attnames, rows, ignore_conflicts)
+    if result.num_skipped > 0:
+        logger.warning(f"{result.num_skipped} {model.__name__} not saved as they already exist")
+    return result
+
+
+def write_objects(model: type[models.Model], objects: list, ignore_conflicts: bool = True) -> BulkWriteResult:
+    result = get_bulk_writer().write(model, objects, ignore_conflicts)
+    if result.num_skipped > 0:
+        logger.warning(f"{result.num_skipped} {model.__name__} not saved as they already exist")
+    return result
+
@@ -0,0 +1,49 @@
+import logging
+import threading
+import traceback
+
+from django.conf import settings
+
+from common.constants import ProcessingOutcomes
+from utils.ts_utils import create_now_ts_ms
+
+logger = logging.getLogger("#dead_letters")
+
+# the outcomes of the payloads that are kept, db errors are retried or spooled instead
+DEAD_LETTER_OUTCOMES = frozenset(
+    (ProcessingOutcomes.UNKNOWN_DEVICE, ProcessingOutcomes.NO_VALID_TSS, ProcessingOutcomes.ERROR)
+)
+
+
+class DeadLetterStore:
+    """
+    Keeps the device payloads that could not be processed in the dead letter table,
+    so they can be processed again later (e.g. when the unknown device is created).
+    The payloads are counted per reason during the whole life of the process.
+    """
+
+    def __init__(self, is_on: bool = settings.INGEST_DEAD_LETTERS_ON):
+        self.is_on = is_on
+        self.lock = threading.Lock()
+        self.counts = {outcome.value: 0 for outcome in ProcessingOutcomes if outcome in DEAD_LETTER_OUTCOMES}
+
+    def add(self, dev_ui: str, payload: dict, reason: ProcessingOutcomes, error: str = ""):
+        from apps.mqtt_sub.models import DeadLetter
+
+        with self.lock:
+            self.counts[reason] += 1
+        if not self.is_on:
+            return
+        try:
+            DeadLetter.objects.create(
+                dev_ui=dev_ui, reason=reason, payload=payload, error=error, created_ts=create_now_ts_ms()
+            )
+        except Exception:
+            logger.error(f"Cannot keep the payload for '{dev_ui}' ({reason}): {traceback.format_exc(-1)}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {f"dead_{reason}": num for reason, num in self.counts.items()}
+
+
+dead_letter_store = DeadLetterStore()
@@ -0,0 +1,107 @@
+import threading
+import logging
+from typing import Any
+
+from django.conf import settings
+
+from utils.ts_utils import create_now_ts_ms
+
+logger = logging.getLogger("#dev_conf_cache")
+
+# the fields of the models that affect the cached configuration
+config_fields_by_model = {
+    "device": {"dev_ui"},
+    "datatype": None,  # any change
+}
+
+
+class DeviceConfigCache:
+    """
+    Per-process cache of the static configuration used while processing raw data:
+    'dev_ui' -> device pk (or None for unknown devices) and data types of the datastreams.
+    Any save/delete of a model that can change the configuration increments the version,
+    values read from the db under an older version are not put into the cache.
+    Changes made in other processes are picked up after 'ttl_ms', unknown devices after 'miss_ttl_ms'.
+    """
+
+    def __init__(
+        self,
+        ttl_ms: int = settings.INGEST_CONFIG_CACHE_TTL_MS,
+        miss_ttl_ms: int = settings.INGEST_CONFIG_CACHE_MISS_TTL_MS,
+    ):
+        self.ttl_ms = ttl_ms
+        self.miss_ttl_ms = miss_ttl_ms
+        self.lock = threading.Lock()
+        self.version = 0
+        self.dev_pk_map: dict[str, tuple[int | None, int]] = {}  # {dev_ui: (dev_pk, expires_ts)}
+        self.data_type_map: dict[int, tuple[Any, int]] = {}  # {data_type_pk: (data_type, expires_ts)}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.dev_pk_map.clear()
+            self.data_type_map.clear()
+        logger.debug(f"Invalidated, version {self.version}")
+
+    def on_instance_changed(self, instance, update_fields=None):
+        """Is called from 'save'/'delete' of the models, 'update_fields' is None for 'delete' and full saves."""
+        model_name = instance._meta.model_name
+        if model_name not in config_fields_by_model:
+            return
+        config_fields = config_fields_by_model[model_name]
+        if update_fields is None or config_fields is None or config_fields.intersection(update_fields):
+            self.invalidate()
+
+    def get_entry(self, cache_map: dict, key) -> tuple[bool, Any]:
+        now_ts = create_now_ts_ms()
+        with self.lock:  # the worker threads share the cache
+            entry = cache_map.get(key)
+            if entry is None or now_ts > entry[1]:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, entry[0]
+
+    def put_entry(self, cache_map: dict, key, value, version: int, ttl_ms: int | None = None):
+        expires_ts = create_now_ts_ms() + (self.ttl_ms if ttl_ms is None else ttl_ms)
+        with self.lock:
+            if version == self.version:  # otherwise the value could be read before the invalidation
+                cache_map[key] = (value, expires_ts)
+
+    def get_dev_pk(self, dev_ui: str) -> tuple[bool, int | None]:
+        """Returns (is_cached, dev_pk), 'dev_pk' is None for a cached unknown device."""
+        return self.get_entry(self.dev_pk_map, dev_ui)
+
+    def put_dev_pk(self, dev_ui: str, dev_pk: int | None, version: int):
+        self.put_entry(self.dev_pk_map, dev_ui, dev_pk, version, self.miss_ttl_ms if dev_pk is None else None)
+
+    def drop_dev_pk(self, dev_ui: str):
+        with self.lock:
+            self.dev_pk_map.pop(dev_ui, None)
+
+    def attach_data_types(self, datastreams):
+        """Puts the cached data types into the datastream instances, so no FK query is needed later."""
+        from apps.datatypes.models import DataType
+
+        missing_pks = set()
+        for ds in datastreams:
+            is_cached, data_type = self.get_entry(self.data_type_map, ds.data_type_id)
+            if is_cached:
+                ds.data_type = data_type
+            else:
+                missing_pks.add(ds.data_type_id)
+        if len(missing_pks) == 0:
+            return
+
+        version = self.version
+        data_type_map = DataType.objects.in_bulk(missing_pks)
+        for pk, data_type in data_type_map.items():
+            self.put_entry(self.data_type_map, pk, data_type, version)
+        for ds in datastreams:
+            if ds.data_type_id in data_type_map:
+                ds.data_type = data_type_map[ds.data_type_id]
+
+
+device_config_cache = DeviceConfigCache()
@@ -2,25 +2,14 @@ from typing import Literal
 
 from django.db.models import Model
 
-from utils.ts_utils import create_dt_from_ts_ms
-from utils.db_field_utils import get_instance_full_id
+from common.constants import LogTypes, LogLevels
+from services.log_store import log_store
 
 
 # reflects the alarms that come from different devices (or datastreams)
 # these alarms can be tied to timestamps in the past, therefore a timestamp is mandatory
-# at the moment - simply put messages into the console
-# but later it's necessary to add these records to the db
+# the records are written into the db in bulk by the log store
 def add_to_device_log(
     type: Literal["ERROR", "WARNING", "INFO"], msg: str, ts: int, instance: Model | str = "Unknown", status: str = ""
 ):
-
-    dt_str = create_dt_from_ts_ms(ts).isoformat(timespec="milliseconds")
-
-    if not status:
-        status = "IN"
-
-    if isinstance(instance, Model):
-        instance_id = get_instance_full_id(instance)
-    else:
-        instance_id = instance
-    print(f"[DEVICE LOG]\t[{type}]\t[{status.upper()}]\t{dt_str}\t{instance_id}\t{msg}")
+    log_store.add(LogTypes.DEVICE, LogLevels[type], msg, ts, instance, status.upper() == "OUT")
@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import F, QuerySet
+
+from apps.applications.models import Application
+from apps.datafeeds.models import Datafeed
+from monapps.celery import app as celery_app
+
+logger = logging.getLogger("#dfr_dispatch")
+
+DIRTY_DFS_TASK_NAME = "evaluate.dirty_dfs"
+
+
+def get_dirty_df_qs() -> QuerySet[Datafeed]:
+    """The native datafeeds whose datastreams got readings or nodata markers after their last resampling run."""
+    return Datafeed.objects.filter(datastream__isnull=False, resampled_version__lt=F("datastream__data_version"))
+
+
+def get_dirty_app_qs() -> QuerySet[Application]:
+    app_pks = get_dirty_df_qs().values("parent_id")
+    return Application.objects.filter(pk__in=app_pks, is_enabled=True).select_related("type", "task")
+
+
+class DfrDispatchNotifier:
+    """
+    The ingestion notifies it after new readings are committed. The notifications are coalesced:
+    the first one sends the task that resamples the dirty datafeeds with a countdown of the interval,
+    the next ones are covered by that task until the interval passes. So the task is sent not more often
+    than once per interval by a process (the max rate), and the readings wait for resampling
+    not much longer than the interval instead of the next tick of the app task.
+    A task that could not start within the next interval expires, the next one covers it.
+    """
+
+    def __init__(self, interval_ms: int = settings.MQTT_SUB_DFR_DISPATCH_INTERVAL_MS):
+        self.interval_s = interval_ms / 1000
+        self.clock = time.monotonic
+        self.lock = threading.Lock()
+        self.next_send_at = 0.0
+        self.num_sent = 0
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.interval_s > 0
+
+    def notify(self):
+        if not self.is_enabled:
+            return
+        with self.lock:
+            now = self.clock()
+            if now < self.next_send_at:
+                return
+            self.next_send_at = now + self.interval_s
+        try:
+            self.send()
+        except Exception as e:
+            with self.lock:
+                self.next_send_at = 0.0  # the next notification tries again
+            logger.error(f"Cannot send the '{DIRTY_DFS_TASK_NAME}' task: {e}")
+            return
+        with self.lock:
+            self.num_sent += 1
+
+    def send(self):
+        celery_app.send_task(DIRTY_DFS_TASK_NAME, countdown=self.interval_s, expires=self.interval_s * 2)
+
+
+dfr_dispatch_notifier = DfrDispatchNotifier()
@@ -0,0 +1,117 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from services.payload_decoding import DecodedDevPayload
+
+logger = logging.getLogger("#dup_filter")
+
+
+class DuplicateFilter:
+    """
+    Per-process filter of re-sent rows (gateways and ESF retransmit uplinks).
+    The values of the rows written into the db are recorded per datastream ({ts: value} of the last
+    'max_tss_per_ds' timestamps, for the 'max_dss' datastreams used most recently).
+    A row of a new payload is a duplicate if it has no alarms or infos, and all its values were recorded
+    for the same timestamps. Duplicates are dropped before the payload is processed.
+    Datastreams are identified by (device pk, datastream name) as the datastreams themselves are not loaded
+    at this point. The rows and duplicates are counted per device between two 'stats' calls.
+    """
+
+    def __init__(
+        self, max_tss_per_ds: int = settings.INGEST_DEDUP_TSS_PER_DS, max_dss: int = settings.INGEST_DEDUP_MAX_DSS
+    ):
+        self.max_tss_per_ds = max_tss_per_ds
+        self.max_dss = max_dss
+        self.lock = threading.Lock()
+        self.recent_values: OrderedDict[tuple[int, str], dict[int, int | float]] = OrderedDict()
+        self.totals = {"rows": 0, "duplicates": 0}
+        self.dev_counts: dict[str, list[int]] = {}  # {dev_ui: [rows, duplicates]}
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.max_tss_per_ds > 0 and self.max_dss > 0
+
+    def drop_duplicates(self, dev_pk: int, dev_ui: str, decoded: DecodedDevPayload) -> int:
+        """Removes the duplicate rows from 'decoded', returns the number of them."""
+        num_rows = len(decoded)
+        dup_idxs = []
+        if self.is_enabled:
+            with self.lock:
+                ds_columns = [
+                    (ds_values, self.recent_values.get((dev_pk, ds_name)))
+                    for ds_name, ds_values in decoded.values.items()
+                ]
+            for idx, ts in enumerate(decoded.tss):
+                if self.is_duplicate(idx, ts, ds_columns, decoded):
+                    dup_idxs.append(idx)
+            if len(dup_idxs) > 0:
+                dup_idx_set = set(dup_idxs)
+                decoded.take_rows([idx for idx in range(num_rows) if idx not in dup_idx_set])
+                logger.debug(f"{len(dup_idxs)} duplicate rows dropped for '{dev_ui}'")
+
+        with self.lock:
+            self.totals["rows"] += num_rows
+            self.totals["duplicates"] += len(dup_idxs)
+            dev_counts = self.dev_counts.setdefault(dev_ui, [0, 0])
+            dev_counts[0] += num_rows
+            dev_counts[1] += len(dup_idxs)
+        return len(dup_idxs)
+
+    def is_duplicate(self, idx: int, ts: int, ds_columns: list, decoded: DecodedDevPayload) -> bool:
+        if ts in decoded.dev_alarm_rows:
+            return False
+        has_value = False
+        for ds_values, recent_ds_values in ds_columns:
+            if (value := ds_values[idx]) is None:
+                continue
+            if recent_ds_values is None or recent_ds_values.get(ts, None) != value:
+                return False
+            has_value = True
+        if not has_value:
+            return False
+        return not any(ts in ds_alarm_rows for ds_alarm_rows in decoded.ds_alarm_rows.values())
+
+    def record(self, dev_pk: int, decoded: DecodedDevPayload):
+        """Is called when the payload is committed into the db."""
+        if not self.is_enabled:
+            return
+        with self.lock:
+            for ds_name, ds_values in decoded.values.items():
+                key = (dev_pk, ds_name)
+                recent_ds_values = self.recent_values.get(key)
+                if recent_ds_values is None:
+                    recent_ds_values = self.recent_values[key] = {}
+                    if len(self.recent_values) > self.max_dss:
+                        self.recent_values.popitem(last=False)
+                else:
+                    self.recent_values.move_to_end(key)
+                for ts, value in zip(decoded.tss, ds_values):
+                    if value is not None:
+                        recent_ds_values.pop(ts, None)  # to keep the order of recording
+                        recent_ds_values[ts] = value
+                while len(recent_ds_values) > self.max_tss_per_ds:
+                    del recent_ds_values[next(iter(recent_ds_values))]
+
+    def clear(self):
+        with self.lock:
+            self.recent_values.clear()
+
+    def stats(self, num_top_devices: int = 5) -> dict:
+        """The totals and the devices with the most duplicates since the previous call."""
+        with self.lock:
+            dev_counts, self.dev_counts = self.dev_counts, {}
+            totals = dict(self.totals)
+        top_devices = sorted(dev_counts.items(), key=lambda item: item[1][1], reverse=True)[:num_top_devices]
+        return {
+            "dup_rows": totals["duplicates"],
+            "dup_rate": round(totals["duplicates"] / totals["rows"], 4) if totals["rows"] > 0 else None,
+            "dup_top_devices": {
+                dev_ui: round(num_dups / num_rows, 4) for dev_ui, (num_rows, num_dups) in top_devices if num_dups > 0
+            },
+        }
+
+
+duplicate_filter = DuplicateFilter()
@@ -0,0 +1,99 @@
+import math
+import struct
+from typing import NamedTuple
+
+
+class FrameField(NamedTuple):
+    ds_name: str
+    length: int = 2  # bytes, big endian
+    scale: float = 1.0
+    is_signed: bool = False
+
+
+class FrameLayout(NamedTuple):
+    fields: tuple[FrameField, ...]
+    valid_range: tuple[float, float] | None = None  # the values outside are reported as "Sensor broken"
+
+
+class FrameDecodingError(ValueError):
+    pass
+
+
+struct_codes = {1: "B", 2: "H", 4: "I"}  # unsigned, the signed values are converted as the JS codecs do
+
+
+class TableFrameDecoder:
+    """
+    Decodes the frames where the layout is selected by a "sensor type" byte and the values follow
+    one by one from a fixed offset. A 'struct.Struct' is compiled for every layout once,
+    so a frame is unpacked with one call.
+    Returns a row {ds_name: {"v": value}} or {ds_name: {"e": {"Sensor broken": {}}}} for the values out of range.
+    """
+
+    def __init__(self, layouts: dict[int, FrameLayout], type_offset: int, values_offset: int):
+        self.type_offset = type_offset
+        self.compiled = {}
+        for sensor_type, layout in layouts.items():
+            fmt = f">{values_offset}x" + "".join(struct_codes[field.length] for field in layout.fields)
+            # (ds_name, scale, complement or 0 for the unsigned values)
+            fields = tuple(
+                (field.ds_name, field.scale, 1 << (field.length * 8 - 1) if field.is_signed else 0)
+                for field in layout.fields
+            )
+            self.compiled[sensor_type] = (struct.Struct(fmt), fields, layout.valid_range)
+
+    def decode(self, frame: bytes) -> dict[str, dict]:
+        if len(frame) <= self.type_offset:
+            raise FrameDecodingError("The frame is too short")
+        try:
+            frame_struct, fields, valid_range = self.compiled[frame[self.type_offset]]
+        except KeyError:
+            raise FrameDecodingError(f"Unknown sensor type {frame[self.type_offset]}")
+        if len(frame) < frame_struct.size:
+            raise FrameDecodingError(f"The frame is too short for the sensor type {frame[self.type_offset]}")
+
+        row = {}
+        for (ds_name, scale, complement), value in zip(fields, frame_struct.unpack_from(frame)):
+            if complement and value > complement:  # as in the JS codec, 'complement' itself stays positive
+                value -= complement * 2
+            # rounded to 0.1 like 'Math.round' does (the halves up)
+            value = math.floor(value * scale * 10 + 0.5) / 10
+            if valid_range is not None and not (valid_range[0] <= value <= valid_range[1]):
+                row[ds_name] = {"e": {"Sensor broken": {}}}  # a non-persistent error
+            else:
+                row[ds_name] = {"v": value}
+        return row
+
+
+def create_enless_diagn_kit_decoder() -> TableFrameDecoder:
+    """The same layouts as 'chirpstack_codecs/Enless_diagn_kit.js'."""
+    temp1 = FrameField("temp1", scale=0.1, is_signed=True)
+    temp2 = FrameField("temp2", scale=0.1, is_signed=True)
+    humidity = FrameField("humidity", scale=0.1)
+    voc = FrameField("voc")
+    co2 = FrameField("co2")
+    pulses = (FrameField("pulse_ch1", length=4), FrameField("pulse_ch2", length=4), FrameField("pulse_oc", length=4))
+    current = FrameField("current", scale=0.001)
+    layouts = {
+        4: FrameLayout((temp1, humidity)),
+        5: FrameLayout((temp1, humidity, voc)),
+        6: FrameLayout((temp1, humidity, voc, co2)),
+        7: FrameLayout((temp1,)),
+        8: FrameLayout(pulses),
+        9: FrameLayout(pulses),
+        10: FrameLayout(pulses),
+        11: FrameLayout(pulses),
+        12: FrameLayout((temp1, temp2), valid_range=(-100, 400)),  # twin-temp sensor kit
+        13: FrameLayout((current,), valid_range=(3.6, 20.4)),  # 4-20 mA input kit
+        14: FrameLayout((temp1, humidity)),
+        15: FrameLayout((temp1,)),
+        16: FrameLayout((temp1,)),
+        17: FrameLayout((temp1, temp2)),
+    }
+    return TableFrameDecoder(layouts, type_offset=3, values_offset=6)
+
+
+# decoders by name, 'MQTT_SUB_FRAME_DECODERS' maps Chirpstack device profiles to them
+frame_decoders: dict[str, TableFrameDecoder] = {
+    "enless_diagn_kit": create_enless_diagn_kit_decoder(),
+}
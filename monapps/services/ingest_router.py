@@ -0,0 +1,128 @@
+import json
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+
+from common.constants import ThrottlePolicies
+from services.ingest_throttle import IngestThrottle, ingest_throttle
+from services.ingest_worker_pool import IngestWorkerPool
+from services.message_acks import MessageAck, MessageAckTracker
+
+logger = logging.getLogger("#ingest_router")
+
+
+def get_owner_idx(dev_ui: str, num_instances: int) -> int:
+    # a different hash than the one used for sharding between the workers of one process,
+    # otherwise every process would use only some of its workers
+    digest = hashlib.blake2b(dev_ui.encode("utf-8"), digest_size=4).digest()
+    return int.from_bytes(digest) % num_instances
+
+
+class IngestRouter:
+    """
+    Routes device payloads when several subscriber processes share one subscription.
+    The broker delivers messages to the processes in turn, but every device is "owned" by only one process,
+    so the Device/Datastream rows of a device are never locked by two processes at the same time.
+    Payloads of not owned devices are forwarded to the owner via the broker.
+    The rate limits ('throttle') are applied before the routing, forwarded payloads are not limited again.
+    NOTE: the broker hands the messages of one device to different processes, so a forwarded payload can reach
+    the owner after a newer payload that came to it directly. Its readings are accepted only within
+    the 'reorder_window' of the datastreams, so the datastreams of such devices should have one.
+    With manual acknowledgements the message of a forwarded payload is acknowledged when the broker confirms
+    the publication ('on_published'), a publication lost on a disconnect leaves it to be delivered again.
+    """
+
+    def __init__(
+        self,
+        pool: IngestWorkerPool,
+        instance_idx: int = settings.MQTT_SUB_INSTANCE_IDX,
+        num_instances: int = settings.MQTT_SUB_NUM_INSTANCES,
+        fwd_topic_prefix: str = settings.MQTT_SUB_FWD_TOPIC_PREFIX,
+        ack_tracker: MessageAckTracker | None = None,
+        throttle: IngestThrottle = ingest_throttle,
+    ):
+        if not 0 <= instance_idx < num_instances:
+            raise ValueError(f"Instance index {instance_idx} is out of range for {num_instances} instances")
+        self.pool = pool
+        self.instance_idx = instance_idx
+        self.num_instances = num_instances
+        self.fwd_topic_prefix = fwd_topic_prefix
+        self.ack_tracker = ack_tracker  # is set if messages are acknowledged manually (QoS 1)
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.fwd_acks: dict[int, MessageAck] = {}  # {mid of the publication: ack}
+        self.early_published_mids: set[int] = set()  # confirmed before the ack was registered
+
+    @property
+    def is_sharded(self) -> bool:
+        return self.num_instances > 1
+
+    @property
+    def fwd_topic(self) -> str:
+        return f"{self.fwd_topic_prefix}/{self.instance_idx}"
+
+    def is_fwd_topic(self, topic: str) -> bool:
+        return topic == self.fwd_topic
+
+    def route(
+        self,
+        client,
+        dev_ui: str,
+        dev_payload: dict,
+        is_forwarded: bool = False,
+        ack: MessageAck | None = None,
+        topic: str = "",
+    ):
+        if not is_forwarded and self.throttle.is_enabled:
+            allowed_payload, _ = self.throttle.apply(topic, dev_ui, dev_payload)
+            if allowed_payload is None:
+                if self.throttle.policy == ThrottlePolicies.SPILL and self.pool.spool is not None:
+                    self.pool.spill(dev_ui, dev_payload)  # it is written later by the spool drainer
+                return
+            dev_payload = allowed_payload
+
+        # forwarded payloads are always processed locally to avoid ping-pong
+        # if the processes were started with different settings
+        if not self.is_sharded or is_forwarded:
+            self.pool.submit(dev_ui, dev_payload, ack)
+            return
+
+        owner_idx = get_owner_idx(dev_ui, self.num_instances)
+        if owner_idx == self.instance_idx:
+            self.pool.submit(dev_ui, dev_payload, ack)
+            return
+
+        # the forwarded payload is acknowledged by the owner, here the message can be acknowledged
+        # as soon as the broker has the publication
+        msg_info = client.publish(f"{self.fwd_topic_prefix}/{owner_idx}", json.dumps({dev_ui: dev_payload}), qos=1)
+        self.pool.counters.inc("forwarded")
+        if ack is not None:
+            ack.add_part()
+            with self.lock:
+                if msg_info.mid in self.early_published_mids:
+                    self.early_published_mids.discard(msg_info.mid)
+                    is_published = True
+                else:
+                    self.fwd_acks[msg_info.mid] = ack
+                    is_published = False
+            if is_published:
+                ack.part_done()
+        logger.debug(f"Payload for '{dev_ui}' forwarded to the instance {owner_idx}")
+
+    def on_published(self, mid: int, is_failure: bool = False):
+        """Is called when the broker confirms a publication (PUBACK)."""
+        if self.ack_tracker is None:
+            return
+        with self.lock:
+            ack = self.fwd_acks.pop(mid, None)
+            if ack is None and not is_failure:
+                self.early_published_mids.add(mid)
+        if ack is None:
+            return
+        if is_failure:
+            # not acknowledged, the message is delivered again after a reconnect
+            logger.error(f"The broker refused a forwarded payload (mid {mid})")
+            return
+        ack.part_done()
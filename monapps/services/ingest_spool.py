@@ -0,0 +1,251 @@
+import os
+import json
+import logging
+import threading
+import time
+import traceback
+from collections.abc import Iterator
+from typing import Any, Callable
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from common.constants import ProcessingOutcomes
+from utils.raw_payload_utils import get_ts_sort_key
+from utils.ts_utils import create_now_ts_ms
+
+logger = logging.getLogger("#ingest_spool")
+
+type ProcessFunc = Callable[[str, dict], Any]
+
+
+class IngestSpool:
+    """
+    Append-only spool of device payloads that could not be written into the db (or did not fit into the queues).
+    Payloads are appended to segment files, one rawdata message {dev_ui: payload} per line (so a segment can also
+    be imported with 'import_raw_data'). A new segment is started when the current one exceeds 'segment_max_bytes'.
+    The oldest segments are dropped when the spool exceeds 'max_bytes' or they are older than 'max_age_s'.
+    The drainer takes the closed segments one by one (the oldest first) when the db is available and
+    processes the payloads of every device in the timestamp order in batches of up to 'batch_max_rows' timestamps
+    (the rows re-sent with the same timestamp are processed one after another, in the order they were appended).
+    A segment is deleted when all its payloads are processed, if the db fails in the middle the segment is
+    processed again later (the readings that are already written are skipped as duplicates).
+    While a device has payloads in the spool, its live payloads are appended to the spool as well
+    ('append_if_pending'), otherwise the newer live readings would move 'ts_to_start_with' forward
+    and the replayed ones would end up unused (and their alarms applied over the newer ones).
+    A device is held ('hold') while older payloads of it are still in the worker pool, then the spool
+    is not drained and the current segment is not rotated, so the older payloads go into the same segment
+    as the newer spilled ones (and are replayed in the timestamp order) or are written directly before them.
+    """
+
+    def __init__(
+        self,
+        spool_dir: str = settings.MQTT_SUB_SPOOL_DIR,
+        segment_max_bytes: int = settings.MQTT_SUB_SPOOL_SEGMENT_MB * 1024 * 1024,
+        max_bytes: int = settings.MQTT_SUB_SPOOL_MAX_MB * 1024 * 1024,
+        max_age_s: int = settings.MQTT_SUB_SPOOL_MAX_AGE_H * 3600,
+        batch_max_rows: int = settings.MQTT_SUB_BATCH_MAX_ROWS,
+    ):
+        self.spool_dir = spool_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.batch_max_rows = batch_max_rows
+        self.lock = threading.Lock()
+        self.file = None  # the segment that is being appended
+        self.file_path = None
+        self.seq = 0
+        self.totals = {
+            "appended": 0,
+            "replayed": 0,
+            "replayed_rows": 0,
+            "replay_failed": 0,
+            "dropped_segments": 0,
+        }
+        self.last_replay_rows_per_s = None
+        self.pending: dict[str, dict[str, int]] = {}  # {segment path: {dev_ui: payloads not replayed yet}}
+        self.held_dev_uis: set[str] = set()
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.load_pending()
+
+    def get_segment_paths(self) -> list[str]:
+        # the names start with the creation time, so the sorting gives the order of creation
+        return sorted(
+            os.path.join(self.spool_dir, name)
+            for name in os.listdir(self.spool_dir)
+            if name.startswith("seg_") and name.endswith(".jsonl")
+        )
+
+    def load_pending(self):
+        """The segments left by the previous run of the process."""
+        for path in self.get_segment_paths():
+            dev_counts = self.pending.setdefault(path, {})
+            for message in self.read_segment(path):
+                for dev_ui in message:
+                    dev_counts[dev_ui] = dev_counts.get(dev_ui, 0) + 1
+
+    def has_pending(self, dev_ui: str) -> bool:
+        with self.lock:
+            return self.has_pending_locked(dev_ui)
+
+    def has_pending_locked(self, dev_ui: str) -> bool:
+        return any(dev_ui in dev_counts for dev_counts in self.pending.values())
+
+    def hold(self, dev_ui: str):
+        with self.lock:
+            self.held_dev_uis.add(dev_ui)
+
+    def release(self, dev_ui: str):
+        with self.lock:
+            self.held_dev_uis.discard(dev_ui)
+
+    def append(self, dev_ui: str, payload: dict):
+        self.append_if(dev_ui, payload, only_if_pending=False)
+
+    def append_if_pending(self, dev_ui: str, payload: dict) -> bool:
+        """Appends the payload if the device has payloads in the spool, returns True if appended."""
+        return self.append_if(dev_ui, payload, only_if_pending=True)
+
+    def append_if(self, dev_ui: str, payload: dict, only_if_pending: bool) -> bool:
+        line = (json.dumps({dev_ui: payload}) + "\n").encode("utf-8")
+        with self.lock:
+            # checked under the same lock as the replay releases the devices
+            if only_if_pending and not self.has_pending_locked(dev_ui):
+                return False
+            if self.file is None:
+                self.seq += 1
+                self.file_path = os.path.join(self.spool_dir, f"seg_{create_now_ts_ms():015d}_{self.seq:06d}.jsonl")
+                self.file = open(self.file_path, "ab")
+            self.file.write(line)
+            self.file.flush()
+            dev_counts = self.pending.setdefault(self.file_path, {})
+            dev_counts[dev_ui] = dev_counts.get(dev_ui, 0) + 1
+            self.totals["appended"] += 1
+            is_segment_full = self.file.tell() >= self.segment_max_bytes and len(self.held_dev_uis) == 0
+            if is_segment_full:
+                self.close_segment()
+        if is_segment_full:  # the limits are also checked by the drainer
+            self.enforce_limits()
+        return True
+
+    def close_segment(self):
+        """Is called under the lock."""
+        if self.file is None:
+            return
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        self.file_path = None
+
+    def enforce_limits(self):
+        with self.lock:
+            paths = self.get_segment_paths()
+            sizes = [os.path.getsize(path) for path in paths]
+            total_bytes = sum(sizes)
+            now_s = time.time()
+            for path, size in zip(paths, sizes):
+                is_too_old = now_s - os.path.getmtime(path) > self.max_age_s
+                if total_bytes <= self.max_bytes and not is_too_old:
+                    break
+                if path == self.file_path:
+                    self.close_segment()
+                os.remove(path)
+                self.pending.pop(path, None)
+                total_bytes -= size
+                self.totals["dropped_segments"] += 1
+                logger.error(f"Spool segment '{path}' dropped, {'too old' if is_too_old else 'the spool is full'}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            paths = self.get_segment_paths()
+            oldest_age_s = round(time.time() - os.path.getmtime(paths[0])) if len(paths) > 0 else None
+            return {
+                "spool_segments": len(paths),
+                "spool_bytes": sum(os.path.getsize(path) for path in paths),
+                "spool_oldest_age_s": oldest_age_s,
+                **{f"spool_{k}": v for k, v in self.totals.items()},
+                "spool_replay_rows_per_s": self.last_replay_rows_per_s,
+            }
+
+    def run_drainer(self, process_func: ProcessFunc, stop_event: threading.Event, interval_s: float):
+        while not stop_event.wait(interval_s):
+            try:
+                self.drain(process_func, stop_event)
+            except Exception:
+                logger.error(f"Error while draining the spool: {traceback.format_exc(-1)}")
+        connection.close()
+
+    def drain(self, process_func: ProcessFunc, stop_event: threading.Event | None = None):
+        self.enforce_limits()
+        with self.lock:
+            if len(self.held_dev_uis) > 0:
+                return  # older payloads of the held devices are yet to come into the current segment
+            self.close_segment()  # payloads coming from now on go into a new segment
+            paths = self.get_segment_paths()
+        if len(paths) == 0 or not self.is_db_available():
+            return
+        for path in paths:
+            if stop_event is not None and stop_event.is_set():
+                return
+            if not self.replay_segment(path, process_func):
+                return  # the db is not available again, try later
+
+    def is_db_available(self) -> bool:
+        close_old_connections()
+        try:
+            connection.ensure_connection()
+        except Exception:
+            return False
+        return True
+
+    def read_segment(self, path: str) -> Iterator[dict]:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:  # a line can be incomplete if the process was killed while appending
+                    logger.warning(f"Incorrect line in the spool segment '{path}' skipped")
+
+    def create_batches(self, rows: list[tuple[str, dict]]) -> list[dict]:
+        # the sort is stable, so a row re-sent with the same timestamp stays after the earlier one;
+        # it starts the next batch (like in 'merge_dev_payloads'), so the alarms of both rows are applied
+        rows.sort(key=lambda row: get_ts_sort_key(row[0]))
+        batches = [{}]
+        for ts, row in rows:
+            if ts in batches[-1] or len(batches[-1]) >= self.batch_max_rows:
+                batches.append({})
+            batches[-1][ts] = row
+        return [batch for batch in batches if len(batch) > 0]
+
+    def replay_segment(self, path: str, process_func: ProcessFunc) -> bool:
+        started_at = time.monotonic()
+        rows_by_dev_ui: dict[str, list[tuple[str, dict]]] = {}
+        for message in self.read_segment(path):
+            for dev_ui, payload in message.items():
+                rows_by_dev_ui.setdefault(dev_ui, []).extend(payload.items())
+
+        num_rows = 0
+        for dev_ui, rows in rows_by_dev_ui.items():
+            for batch in self.create_batches(rows):
+                outcome = process_func(dev_ui, batch)
+                if outcome == ProcessingOutcomes.DB_ERROR:
+                    logger.warning(f"DB error while replaying the spool segment '{path}', it will be replayed later")
+                    return False
+                with self.lock:
+                    self.totals["replayed"] += 1
+                    self.totals["replayed_rows"] += len(batch)
+                    if outcome == ProcessingOutcomes.ERROR:
+                        self.totals["replay_failed"] += 1
+                num_rows += len(batch)
+            with self.lock:
+                # the live payloads of the device are processed directly again if it has no other segments
+                self.pending.get(path, {}).pop(dev_ui, None)
+
+        with self.lock:
+            if os.path.exists(path):  # could be dropped by the limits meanwhile
+                os.remove(path)
+            self.pending.pop(path, None)
+        elapsed_s = time.monotonic() - started_at
+        self.last_replay_rows_per_s = round(num_rows / elapsed_s) if elapsed_s > 0 else None
+        logger.info(f"Spool segment '{path}' replayed, rows: {num_rows}, {self.last_replay_rows_per_s} rows/s")
+        return True
@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from common.constants import ThrottlePolicies
+from services.device_config_cache import device_config_cache
+from services.device_log import add_to_device_log
+from utils.raw_payload_utils import get_ts_sort_key
+from utils.ts_utils import create_now_ts_ms
+
+logger = logging.getLogger("#ingest_throttle")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens
+
+
+class IngestThrottle:
+    """
+    Token-bucket limits of incoming rows per device ('dev_ui') and per topic prefix, so a misbehaving device
+    (or a group of them) cannot monopolize the workers and the row locks. Every row (timestamp) of a device
+    payload takes a token from both buckets. The rows over the limits are dropped, spilled into the spool
+    or sampled (the evenly spaced rows that fit the limits are kept), according to the policy.
+    With "drop" and "spill" a payload is not split: a payload with more rows than a burst (e.g. the backlog
+    of a device that was offline) is accepted as a whole when the buckets are full, the tokens go below zero
+    then and the next payloads wait until the buckets are refilled.
+    A throttled device is reported in the device log (not more often than 'log_interval_s'),
+    the throttled rows are counted per device between two 'stats' calls.
+    """
+
+    def __init__(
+        self,
+        dev_rate: float = settings.MQTT_SUB_THROTTLE_DEV_ROWS_S,
+        dev_burst: int = settings.MQTT_SUB_THROTTLE_DEV_BURST,
+        topic_rate: float = settings.MQTT_SUB_THROTTLE_TOPIC_ROWS_S,
+        topic_burst: int = settings.MQTT_SUB_THROTTLE_TOPIC_BURST,
+        topic_levels: int = settings.MQTT_SUB_THROTTLE_TOPIC_LEVELS,
+        policy: str = settings.MQTT_SUB_THROTTLE_POLICY,
+        log_interval_s: int = settings.MQTT_SUB_THROTTLE_LOG_INTERVAL_S,
+        max_buckets: int = 100000,
+    ):
+        if policy not in ThrottlePolicies.values:
+            raise ValueError(f"Unknown throttle policy: {policy}")
+        self.dev_rate = dev_rate
+        self.dev_burst = dev_burst
+        self.topic_rate = topic_rate
+        self.topic_burst = topic_burst
+        self.topic_levels = topic_levels
+        self.policy = policy
+        self.log_interval_s = log_interval_s
+        self.max_buckets = max_buckets
+        self.clock = time.monotonic
+        self.lock = threading.Lock()
+        self.dev_buckets: dict[str, TokenBucket] = {}
+        self.topic_buckets: dict[str, TokenBucket] = {}
+        self.totals = {"payloads": 0, "rows": 0}
+        self.dev_counts: dict[str, int] = {}  # {dev_ui: throttled rows}
+        self.logged_at: dict[str, tuple[float, int]] = {}  # {dev_ui: (when logged, throttled rows not logged yet)}
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.dev_rate > 0 or self.topic_rate > 0
+
+    def get_topic_prefix(self, topic: str) -> str:
+        return "/".join(topic.split("/", self.topic_levels)[: self.topic_levels])
+
+    def get_bucket(self, buckets: dict[str, TokenBucket], key: str, rate: float, burst: int, now: float):
+        if (bucket := buckets.get(key)) is None:
+            if len(buckets) >= self.max_buckets:
+                # the idle buckets are full anyway, a new bucket starts full
+                for idle_key in [k for k, b in buckets.items() if b.refill(now) >= b.burst]:
+                    del buckets[idle_key]
+                if len(buckets) >= self.max_buckets:
+                    buckets.clear()
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def apply(self, topic: str, dev_ui: str, dev_payload: dict) -> tuple[dict | None, int]:
+        """
+        Returns (the payload to process or None, the number of throttled rows). The throttled payloads
+        are not spilled here, with the "spill" policy the caller puts them into the spool.
+        """
+        if not self.is_enabled:
+            return dev_payload, 0
+        num_rows = len(dev_payload)
+        with self.lock:
+            now = self.clock()
+            buckets = []
+            if self.dev_rate > 0:
+                buckets.append(self.get_bucket(self.dev_buckets, dev_ui, self.dev_rate, self.dev_burst, now))
+            if self.topic_rate > 0:
+                prefix = self.get_topic_prefix(topic)
+                buckets.append(self.get_bucket(self.topic_buckets, prefix, self.topic_rate, self.topic_burst, now))
+            num_allowed = max(0, min(num_rows, int(min(bucket.tokens for bucket in buckets))))
+            if num_allowed < num_rows and self.policy != ThrottlePolicies.SAMPLE:
+                # the payload is not split
+                num_allowed = num_rows if all(bucket.tokens >= bucket.burst for bucket in buckets) else 0
+            for bucket in buckets:
+                bucket.tokens -= num_allowed
+            num_throttled = num_rows - num_allowed
+            if num_throttled > 0:
+                self.totals["payloads"] += 1
+                self.totals["rows"] += num_throttled
+                self.dev_counts[dev_ui] = self.dev_counts.get(dev_ui, 0) + num_throttled
+                num_to_log = self.count_for_log(dev_ui, num_throttled, now)
+
+        if num_throttled == 0:
+            return dev_payload, 0
+        if num_to_log > 0:
+            self.add_to_log(dev_ui, num_to_log)
+        if num_allowed == 0:
+            return None, num_throttled
+        keys = sorted(dev_payload, key=get_ts_sort_key)  # evenly spaced in time
+        step = num_rows / num_allowed
+        sampled_keys = [keys[int(idx * step)] for idx in range(num_allowed)]
+        return {key: dev_payload[key] for key in sampled_keys}, num_throttled
+
+    def count_for_log(self, dev_ui: str, num_throttled: int, now: float) -> int:
+        """Returns the number of throttled rows to report now (with the not reported ones), 0 if it is too early."""
+        logged_at, num_not_logged = self.logged_at.get(dev_ui, (None, 0))
+        if logged_at is not None and now - logged_at < self.log_interval_s:
+            self.logged_at[dev_ui] = (logged_at, num_not_logged + num_throttled)
+            return 0
+        if len(self.logged_at) >= self.max_buckets:
+            self.logged_at.clear()
+        self.logged_at[dev_ui] = (now, 0)
+        return num_not_logged + num_throttled
+
+    def add_to_log(self, dev_ui: str, num_throttled: int):
+        _, dev_pk = device_config_cache.get_dev_pk(dev_ui)
+        instance = f"device {dev_pk}" if dev_pk is not None else dev_ui  # as the device itself would be logged
+        msg = f"Ingest rate limit exceeded, {num_throttled} rows throttled (policy '{self.policy}')"
+        add_to_device_log("WARNING", msg, create_now_ts_ms(), instance)
+        logger.warning(f"{msg} for '{dev_ui}'")
+
+    def stats(self, num_top_devices: int = 5) -> dict:
+        """The totals and the devices with the most throttled rows since the previous call."""
+        if not self.is_enabled:
+            return {}
+        with self.lock:
+            dev_counts, self.dev_counts = self.dev_counts, {}
+            totals = dict(self.totals)
+        top_devices = sorted(dev_counts.items(), key=lambda item: item[1], reverse=True)[:num_top_devices]
+        return {
+            "throttled_payloads": totals["payloads"],
+            "throttled_rows": totals["rows"],
+            "throttled_top_devices": dict(top_devices),
+        }
+
+
+ingest_throttle = IngestThrottle()
@@ -0,0 +1,401 @@
+import queue
+import logging
+import threading
+import time
+import traceback
+import zlib
+from typing import Any, Callable
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from common.constants import BackpressurePolicies, ProcessingOutcomes
+from services.raw_data_processor import RawDataProcessor
+from services.ingest_spool import IngestSpool
+from services.duplicate_filter import duplicate_filter
+from services.dead_letters import dead_letter_store
+from services.ingest_throttle import ingest_throttle
+from utils.raw_payload_utils import merge_dev_payloads
+
+logger = logging.getLogger("#ingest_pool")
+
+type ProcessFunc = Callable[[str, dict], Any]
+
+
+def process_dev_payload(dev_ui: str, payload: dict):
+    return RawDataProcessor(dev_ui, payload).execute()
+
+
+def get_shard_idx(dev_ui: str, num_shards: int) -> int:
+    # 'crc32' is used instead of 'hash' as the latter is salted differently in every process
+    return zlib.crc32(dev_ui.encode("utf-8")) % num_shards
+
+
+class IngestCounters:
+    """
+    Thread-safe counters of the ingestion pipeline.
+    Latencies are collected between two snapshots, the totals are collected during the whole life of the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {
+            "received": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "batches": 0,
+            "forwarded": 0,
+            "db_retries": 0,
+            "acked": 0,
+        }
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0  # QoS 1 messages that are not acknowledged yet
+        self.max_in_flight = 0
+        self.reset_latencies()
+
+    def reset_latencies(self):
+        self.num_latencies = 0
+        self.wait_ms_sum = 0.0
+        self.proc_ms_sum = 0.0
+        self.wait_ms_max = 0.0
+        self.proc_ms_max = 0.0
+        self.num_acks = 0
+        self.ack_ms_sum = 0.0
+        self.ack_ms_max = 0.0
+
+    def inc(self, name: str, num: int = 1):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + num
+
+    def set_queue_depth(self, depth: int):
+        with self.lock:
+            self.queue_depth = depth
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+
+    def add_in_flight(self, num: int):
+        with self.lock:
+            self.in_flight += num
+            if self.in_flight > self.max_in_flight:
+                self.max_in_flight = self.in_flight
+
+    def add_ack_latency(self, ack_ms: float):
+        with self.lock:
+            self.num_acks += 1
+            self.ack_ms_sum += ack_ms
+            self.ack_ms_max = max(self.ack_ms_max, ack_ms)
+
+    def add_latency(self, wait_ms: float, proc_ms: float):
+        with self.lock:
+            self.num_latencies += 1
+            self.wait_ms_sum += wait_ms
+            self.proc_ms_sum += proc_ms
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+            self.proc_ms_max = max(self.proc_ms_max, proc_ms)
+
+    def snapshot(self, reset: bool = True) -> dict:
+        with self.lock:
+            num = self.num_latencies
+            snapshot = {
+                **self.totals,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "avg_wait_ms": round(self.wait_ms_sum / num, 1) if num > 0 else None,
+                "max_wait_ms": round(self.wait_ms_max, 1),
+                "avg_proc_ms": round(self.proc_ms_sum / num, 1) if num > 0 else None,
+                "max_proc_ms": round(self.proc_ms_max, 1),
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "avg_ack_ms": round(self.ack_ms_sum / self.num_acks, 1) if self.num_acks > 0 else None,
+                "max_ack_ms": round(self.ack_ms_max, 1),
+            }
+            if reset:
+                self.reset_latencies()
+                self.max_queue_depth = self.queue_depth
+                self.max_in_flight = self.in_flight
+        return snapshot
+
+
+class IngestWorkerPool:
+    """
+    Decouples receiving of raw data (the MQTT network thread) from writing it into the db.
+    Every device payload is put into one of the bounded queues chosen by 'dev_ui',
+    so all the payloads of one device are processed by the same worker in the order of arrival.
+    If 'batch_window_ms' > 0, a worker collects payloads during this window (or until 'batch_max_rows'
+    timestamps are collected) and merges the payloads of the same device, so they are processed in one transaction.
+    If 'retry_db_errors' is True, payloads that failed because of the db are processed again (with a growing delay)
+    until they are written, the worker does not take new payloads meanwhile.
+    A payload can be submitted with an 'ack' ('MessageAck'), its 'part_done' is called when the payload is written
+    (or spilled), the messages of dropped payloads are not acknowledged.
+    With a 'spool', payloads are spilled into it when the queue is full (the "spill" policy) and when they
+    cannot be written because of a db error (if they are not retried), the spool is drained in the background.
+    The payloads of a device that has payloads in the spool go into the spool too, so they are written
+    after the older ones. If a payload is spilled while older payloads of the device are still in the queue,
+    the spool holds the device until they are processed (they are deferred to the spool or written directly),
+    otherwise the spilled payload could be replayed before them.
+    """
+
+    def __init__(
+        self,
+        process_func: ProcessFunc = process_dev_payload,
+        num_workers: int = settings.MQTT_SUB_NUM_WORKERS,
+        queue_size: int = settings.MQTT_SUB_QUEUE_SIZE,
+        policy: str = settings.MQTT_SUB_BACKPRESSURE,
+        stats_interval_s: int = settings.MQTT_SUB_STATS_INTERVAL_S,
+        batch_window_ms: int = settings.MQTT_SUB_BATCH_WINDOW_MS,
+        batch_max_rows: int = settings.MQTT_SUB_BATCH_MAX_ROWS,
+        retry_db_errors: bool = False,
+        db_retry_max_s: int = settings.MQTT_SUB_DB_RETRY_MAX_S,
+        spool: IngestSpool | None = None,
+        spool_drain_interval_s: float = settings.MQTT_SUB_SPOOL_DRAIN_INTERVAL_S,
+    ):
+        if policy not in BackpressurePolicies.values:
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        if policy == BackpressurePolicies.SPILL and spool is None:
+            raise ValueError("The 'spill' policy needs a spool")
+        self.process_func = process_func
+        self.num_workers = num_workers
+        self.policy = policy
+        self.stats_interval_s = stats_interval_s
+        self.batch_window_ms = batch_window_ms
+        self.batch_max_rows = batch_max_rows
+        self.retry_db_errors = retry_db_errors
+        self.db_retry_max_s = db_retry_max_s
+        self.spool = spool
+        self.spool_drain_interval_s = spool_drain_interval_s
+        self.counters = IngestCounters()
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self.threads = []
+        self.dev_lock = threading.Lock()
+        self.num_queued: dict[str, int] = {}  # {dev_ui: payloads submitted to the queues and not processed yet}
+        self.num_held: dict[str, int] = {}  # {dev_ui: payloads submitted before the spill and not processed yet}
+        self.stop_event = threading.Event()
+        self.is_stopping = False
+
+    def start(self):
+        for idx in range(self.num_workers):
+            thread = threading.Thread(target=self.run_worker, args=(idx,), name=f"ingest-worker-{idx}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.stats_interval_s > 0:
+            threading.Thread(target=self.run_stats_reporter, name="ingest-stats", daemon=True).start()
+        if self.spool is not None:
+            threading.Thread(
+                target=self.spool.run_drainer,
+                args=(self.process_func, self.stop_event, self.spool_drain_interval_s),
+                name="ingest-spool-drainer",
+                daemon=True,
+            ).start()
+        logger.info(f"Ingest worker pool started, workers: {self.num_workers}, policy: '{self.policy}'")
+
+    def stop(self, timeout: float | None = None):
+        # all the payloads already in the queues are processed before the workers exit,
+        # but the db errors are not retried anymore
+        self.is_stopping = True
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.stop_event.set()
+        logger.info(f"Ingest worker pool stopped, counters: {self.counters.snapshot()}")
+
+    def submit(self, dev_ui: str, payload: dict, ack=None) -> bool:
+        """Returns False if the payload was not put into the queue (dropped or spilled)."""
+        self.counters.inc("received")
+        if ack is not None:
+            ack.add_part()
+        item = (dev_ui, payload, time.monotonic(), ack)
+        if self.num_workers == 0:  # no workers, process in the caller thread
+            self.process_items([item])
+            return True
+
+        q = self.queues[get_shard_idx(dev_ui, self.num_workers)]
+        is_queued = True
+        with self.dev_lock:  # counted before it is put, so a spill cannot miss it
+            self.num_queued[dev_ui] = self.num_queued.get(dev_ui, 0) + 1
+
+        match self.policy:
+            case BackpressurePolicies.BLOCK:
+                while True:
+                    try:
+                        q.put(item, timeout=5)
+                        break
+                    except queue.Full:
+                        logger.warning(f"Ingest queue is full, waiting for a free slot for '{dev_ui}'")
+            case BackpressurePolicies.DROP_OLDEST:
+                while True:
+                    try:
+                        q.put_nowait(item)
+                        break
+                    except queue.Full:
+                        try:
+                            # the message of a dropped payload is not acknowledged, the data is not written
+                            dropped_dev_ui, _, _, _ = q.get_nowait()
+                            q.task_done()
+                            self.release_items([(dropped_dev_ui,)])
+                            self.counters.inc("dropped")
+                            logger.warning(f"Ingest queue is full, the oldest payload for '{dropped_dev_ui}' dropped")
+                        except queue.Empty:
+                            pass
+            case BackpressurePolicies.SPILL:
+                try:
+                    q.put_nowait(item)
+                except queue.Full:
+                    self.spill_after_queued(dev_ui, payload)
+                    is_queued = False
+                    if ack is not None:
+                        ack.part_done()
+
+        self.counters.set_queue_depth(self.get_queue_depth())
+        return is_queued
+
+    def wait_until_processed(self):
+        """Waits until all the payloads submitted so far are processed."""
+        for q in self.queues:
+            q.join()
+
+    def get_queue_depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def spill(self, dev_ui: str, payload: dict) -> bool:
+        try:
+            self.spool.append(dev_ui, payload)
+        except OSError:
+            self.counters.inc("dropped")
+            logger.error(f"Cannot spill the payload for '{dev_ui}', dropped: {traceback.format_exc(-1)}")
+            return False
+        self.counters.inc("spilled")
+        logger.warning(f"The payload for '{dev_ui}' spilled")
+        return True
+
+    def spill_after_queued(self, dev_ui: str, payload: dict):
+        with self.dev_lock:
+            num_queued = self.num_queued.pop(dev_ui) - 1  # the payload itself was not queued
+            if num_queued > 0:
+                self.num_queued[dev_ui] = num_queued
+                # the older payloads go into the spool after this one (or are written directly),
+                # the spool is not drained until then
+                self.spool.hold(dev_ui)
+                self.num_held[dev_ui] = num_queued
+        self.spill(dev_ui, payload)
+
+    def release_items(self, items: list[tuple]):
+        """The payloads left the pool, the devices are released by the spool after their older payloads."""
+        with self.dev_lock:
+            for dev_ui, *_ in items:
+                if (num_queued := self.num_queued.pop(dev_ui, 0) - 1) > 0:
+                    self.num_queued[dev_ui] = num_queued
+                # the payloads of a device are processed in the order of submission
+                if dev_ui in self.num_held:
+                    self.num_held[dev_ui] -= 1
+                    if self.num_held[dev_ui] == 0:
+                        del self.num_held[dev_ui]
+                        self.spool.release(dev_ui)
+
+    def defer_to_spool(self, dev_ui: str, payload: dict) -> bool:
+        """Returns True if the payload was appended to the spool after the older payloads of the device."""
+        try:
+            is_spilled = self.spool.append_if_pending(dev_ui, payload)
+        except OSError:
+            # processed now, the spooled payloads of the device can end up unused when they are replayed
+            logger.error(f"Cannot spill the payload for '{dev_ui}' after its spooled ones: {traceback.format_exc(-1)}")
+            return False
+        if is_spilled:
+            self.counters.inc("spilled")
+            logger.debug(f"The payload for '{dev_ui}' spilled after its spooled ones")
+        return is_spilled
+
+    def run_worker(self, idx: int):
+        q = self.queues[idx]
+        is_stopping = False
+        while not is_stopping:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                break
+            items = [item]
+            if self.batch_window_ms > 0:
+                is_stopping = self.collect_batch(q, items)
+            try:
+                self.process_items(items)
+            finally:
+                self.release_items(items)
+                for _ in items:
+                    q.task_done()
+        connection.close()  # every thread has its own db connection
+
+    def collect_batch(self, q: queue.Queue, items: list) -> bool:
+        """Adds more items from the queue to 'items', returns True if the stop sentinel was met."""
+        deadline = time.monotonic() + self.batch_window_ms / 1000
+        num_rows = len(items[0][1])
+        while num_rows < self.batch_max_rows:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                q.task_done()
+                return True
+            items.append(item)
+            num_rows += len(item[1])
+        return False
+
+    def process_items(self, items: list[tuple[str, dict, float, Any]]):
+        started_at = time.monotonic()
+        close_old_connections()
+        if len(items) == 1:
+            dev_payloads = [(items[0][0], items[0][1])]
+        else:
+            dev_payloads = merge_dev_payloads((dev_ui, payload) for dev_ui, payload, _, _ in items)
+        are_all_written = True
+        for dev_ui, payload in dev_payloads:
+            if not self.process_dev_payload(dev_ui, payload):
+                are_all_written = False
+        self.counters.inc("batches", len(dev_payloads))
+        finished_at = time.monotonic()
+        for _, _, enqueued_at, ack in items:
+            self.counters.add_latency((started_at - enqueued_at) * 1000, (finished_at - started_at) * 1000)
+            # not written payloads (the db was unavailable till the stop) are not acknowledged,
+            # so the broker delivers them again after the restart
+            if ack is not None and are_all_written:
+                ack.part_done()
+
+    def process_dev_payload(self, dev_ui: str, payload: dict) -> bool:
+        """Returns False if the payload was not written because of a db error."""
+        if self.spool is not None and self.defer_to_spool(dev_ui, payload):
+            return True
+        retry_s = 1
+        while True:
+            try:
+                outcome = self.process_func(dev_ui, payload)
+            except Exception:
+                self.counters.inc("failed")
+                logger.error(f"Error while processing a payload for '{dev_ui}': {traceback.format_exc(-1)}")
+                return True
+            if outcome != ProcessingOutcomes.DB_ERROR:
+                # the payloads that cannot be processed (unknown devices etc.) are not retried
+                self.counters.inc("failed" if outcome == ProcessingOutcomes.ERROR else "processed")
+                return True
+            if not self.retry_db_errors and self.spool is not None:
+                return self.spill(dev_ui, payload)  # will be written when the db is available again
+            if not self.retry_db_errors or self.is_stopping:
+                self.counters.inc("failed")
+                return False
+            self.counters.inc("db_retries")
+            logger.warning(f"DB error while processing a payload for '{dev_ui}', retrying in {retry_s} s")
+            time.sleep(retry_s)
+            retry_s = min(retry_s * 2, self.db_retry_max_s)
+            close_old_connections()
+
+    def run_stats_reporter(self):
+        while not self.stop_event.wait(self.stats_interval_s):
+            self.counters.set_queue_depth(self.get_queue_depth())
+            stats = self.counters.snapshot() | (self.spool.stats() if self.spool is not None else {})
+            stats |= duplicate_filter.stats() | dead_letter_store.stats() | ingest_throttle.stats()
+            logger.info(f"Ingest counters: {stats}")
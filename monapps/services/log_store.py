@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+import traceback
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Model
+
+from common.constants import LogTypes, LogLevels
+from utils.db_field_utils import get_instance_full_id
+from utils.ts_utils import create_dt_from_ts_ms
+
+logger = logging.getLogger("#log_store")
+
+# (log_type, level, is_out, ts, instance, msg), 'instance' is resolved into its full id only when written
+type LogItem = tuple[int, int, bool, int, Model | str, str]
+
+
+class LogStore:
+    """
+    Collects the records of the device, app and alarm logs and writes them into the db in bulk.
+    The records added within a transaction are collected only when it commits (they are dropped on a rollback,
+    as the changes they describe). The records are written when 'max_records' are collected,
+    or when 'flush_interval_ms' passed since the first of them. The long-running processes start the flusher thread
+    that writes them, an addition that makes them due only wakes it up. Without the flusher nothing would write
+    a lone record later (e.g. in the web processes), so every addition writes the records right away.
+    A process with the flusher should call 'stop_flusher' before it exits, not to lose the last records.
+    """
+
+    def __init__(
+        self,
+        max_records: int = settings.LOG_STORE_MAX_RECORDS,
+        flush_interval_ms: int = settings.LOG_STORE_FLUSH_INTERVAL_MS,
+        is_echo_on: bool = settings.LOG_STORE_ECHO,
+    ):
+        self.max_records = max_records
+        self.flush_interval_ms = flush_interval_ms
+        self.is_echo_on = is_echo_on
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # the records are written in the order of collection
+        self.items: list[LogItem] = []
+        self.first_added_at = 0.0
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.flusher = None
+
+    def add(self, log_type: LogTypes, level: LogLevels, msg: str, ts: int, instance: Model | str, is_out: bool):
+        item = (log_type, level, is_out, ts, instance, msg)
+        if connection.in_atomic_block:
+            transaction.on_commit(partial(self.collect, item), robust=True)
+        else:
+            self.collect(item)
+
+    def collect(self, item: LogItem):
+        with self.lock:
+            if len(self.items) == 0:
+                self.first_added_at = time.monotonic()
+            self.items.append(item)
+        if self.flusher is None:
+            self.flush()
+        elif self.is_flush_due():
+            self.wake_event.set()
+
+    def is_flush_due(self) -> bool:
+        with self.lock:
+            return len(self.items) >= self.max_records or (
+                len(self.items) > 0 and (time.monotonic() - self.first_added_at) * 1000 >= self.flush_interval_ms
+            )
+
+    def flush(self):
+        from apps.logs.models import LogRecord
+
+        with self.flush_lock:
+            with self.lock:
+                items, self.items = self.items, []
+            if len(items) == 0:
+                return
+            records = [
+                LogRecord(
+                    log_type=log_type,
+                    level=level,
+                    is_out=is_out,
+                    time=ts,
+                    instance=instance if isinstance(instance, str) else get_instance_full_id(instance),
+                    msg=msg,
+                )
+                for log_type, level, is_out, ts, instance, msg in items
+            ]
+            if self.is_echo_on:
+                for record in records:
+                    print(format_log_record(record))
+            try:
+                LogRecord.objects.bulk_create(records, batch_size=self.max_records)
+            except Exception:
+                # the records are not lost completely
+                logger.error(f"Cannot write {len(records)} log records: {traceback.format_exc(-1)}")
+                for record in records:
+                    logger.error(format_log_record(record))
+
+    def start_flusher(self):
+        """Starts the thread that writes the collected records when they are due."""
+        if self.flusher is not None:
+            return
+        self.stop_event.clear()
+        self.wake_event.clear()
+        self.flusher = threading.Thread(target=self.run_flusher, name="log-store-flusher", daemon=True)
+        self.flusher.start()
+
+    def stop_flusher(self):
+        if self.flusher is None:
+            return
+        self.stop_event.set()
+        self.wake_event.set()
+        self.flusher.join()
+        self.flusher = None
+        self.flush()
+
+    def run_flusher(self):
+        while True:
+            self.wake_event.wait(self.flush_interval_ms / 1000)
+            self.wake_event.clear()
+            if self.stop_event.is_set():
+                break
+            if self.is_flush_due():
+                close_old_connections()
+                self.flush()
+        connection.close()
+
+
+def format_log_record(record) -> str:
+    dt_str = create_dt_from_ts_ms(record.time).isoformat(timespec="milliseconds")
+    return (
+        f"[{LogTypes(record.log_type).name} LOG]\t[{LogLevels(record.level).name}]\t"
+        f"[{'OUT' if record.is_out else 'IN'}]\t{dt_str}\t{record.instance}\t{record.msg}"
+    )
+
+
+log_store = LogStore()
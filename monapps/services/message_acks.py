@@ -0,0 +1,56 @@
+import time
+import logging
+import threading
+
+from services.ingest_worker_pool import IngestCounters
+
+logger = logging.getLogger("#message_acks")
+
+
+class MessageAck:
+    """
+    Acknowledges a QoS 1 message when all its parts are done. Every device payload of the message
+    submitted to the worker pool is a part ('add_part' when submitted, 'part_done' after the transaction commits).
+    The message itself is a part while it is being decoded and routed, so it cannot be acknowledged
+    before all the device payloads are submitted.
+    """
+
+    __slots__ = ("tracker", "client", "mid", "qos", "received_at", "num_pending")
+
+    def __init__(self, tracker: "MessageAckTracker", client, mid: int, qos: int):
+        self.tracker = tracker
+        self.client = client
+        self.mid = mid
+        self.qos = qos
+        self.received_at = time.monotonic()
+        self.num_pending = 1
+
+    def add_part(self):
+        with self.tracker.lock:
+            self.num_pending += 1
+
+    def part_done(self):
+        with self.tracker.lock:
+            self.num_pending -= 1
+            if self.num_pending != 0:
+                return
+        self.tracker.ack(self)
+
+
+class MessageAckTracker:
+    """Creates 'MessageAck's for the received messages and collects the in-flight and ack latency metrics."""
+
+    def __init__(self, counters: IngestCounters):
+        self.counters = counters
+        self.lock = threading.Lock()
+
+    def create(self, client, msg) -> MessageAck:
+        self.counters.add_in_flight(1)
+        return MessageAck(self, client, msg.mid, msg.qos)
+
+    def ack(self, msg_ack: MessageAck):
+        # QoS 0 messages are not acknowledged by paho, so they are only counted
+        msg_ack.client.ack(msg_ack.mid, msg_ack.qos)
+        self.counters.add_in_flight(-1)
+        self.counters.inc("acked")
+        self.counters.add_ack_latency((time.monotonic() - msg_ack.received_at) * 1000)
@@ -1,6 +1,10 @@
 import logging
+import time
 import traceback
-from django.db import transaction
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.db import connection, transaction
 from django.conf import settings
 
 from apps.applications.models import Application
@@ -9,49 +13,141 @@ from apps.datafeeds.models import Datafeed
 from apps.dsreadings.models import DsReading
 from apps.dfreadings.models import DfReading
 from common.constants import AugmentationPolicy
-from utils.dfr_utils import create_df_readings
-from utils.ts_utils import ceil_timestamp
+from utils.dfr_utils import NUM_PREV_DF_READINGS, create_df_readings, get_prev_df_readings, uses_prev_df_readings
+from utils.dsr_utils import DsValues, fetch_ds_values, fetch_nodata_marker_tss
+from utils.update_utils import set_attr_if_cond
+from utils.ts_utils import ceil_timestamp, create_now_ts_ms
+from services.bulk_writer import write_objects
+from services.resampling_plan import create_resampling_plan, get_resampling_key, resampling_counters
 
 
 logger = logging.getLogger("#dfr_creator")
 
 
 class NewDfrCreator:
-    def __init__(self, app: Application):
+    """
+    With 'num_workers' > 1 the groups of the resampling plan (independent datafeeds) are resampled concurrently
+    by a thread pool, every thread with its own db connection and transactions, the row locks are the same.
+    'timings' - {df pk: ms} of the last run (the datafeeds of a group get the time of the group).
+    """
+
+    def __init__(self, app: Application, num_workers: int = settings.DFR_CREATOR_NUM_WORKERS):
         self.app = app
+        self.num_workers = num_workers
+        self.timings: dict[int, float] = {}
 
     def execute(self):
         if not self.app.is_enabled:
             return
 
-        native_df_qs = self.app.get_native_df_qs()
-        for df in native_df_qs:
-            try:
-                self.create_df_readings_for_ind_df(df)
-            except Exception:
-                logger.error(f"Error while creating readings for df {df.pk} {df.name}, {traceback.format_exc(-1)}")
+        dfs = []
+        for df in self.app.get_native_df_qs().select_related("datastream"):
+            df.parent = self.app
+            if self.needs_resampling(df):
+                dfs.append(df)
+        if len(dfs) == 0:
+            return
+
+        # the datafeeds of other apps that read the same datastreams with the same settings get the same series,
+        # it is computed once and written for all of them (their runs skip them then as they are not dirty)
+        if settings.DFR_SHARED_RESAMPLING:
+            sibling_dfs = (
+                Datafeed.objects.filter(datastream__in={df.datastream_id for df in dfs}, parent__is_enabled=True)
+                .exclude(parent=self.app)
+                .select_related("parent")
+            )
+            plan = create_resampling_plan(dfs, sibling_dfs)
+        else:
+            plan = [[df] for df in dfs]
+        started_at = time.perf_counter()
+        num_workers = min(self.num_workers, len(plan))
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="dfr_creator") as executor:
+                results = list(executor.map(self.resample_group_in_thread, plan))
+        else:
+            results = [self.resample_group(group) for group in plan]
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+
+        num_dfs, num_series = 0, 0
+        self.timings = {}
+        for group, (num_group_dfs, group_ms) in zip(plan, results):
+            if num_group_dfs is not None:
+                num_dfs += num_group_dfs
+                num_series += 1
+            for df in group:
+                self.timings[df.pk] = group_ms
+        resampling_counters.add(num_dfs, num_series)
+        logger.debug(
+            f"Resampled {num_dfs} datafeeds in {num_series} series in {elapsed_ms:.1f} ms ({num_workers} workers), "
+            f"timings {self.timings}, totals {resampling_counters.snapshot()}"
+        )
+
+    def resample_group(self, group: list[Datafeed]) -> tuple[int | None, float]:
+        """Returns (the number of the datafeeds that got the df readings or None on error, ms)."""
+        df = group[0]
+        started_at = time.perf_counter()
+        num_dfs = None
+        try:
+            num_dfs = self.create_df_readings_for_ind_df(df, group[1:])
+        except Exception:
+            logger.error(f"Error while creating readings for df {df.pk} {df.name}, {traceback.format_exc(-1)}")
+        return num_dfs, (time.perf_counter() - started_at) * 1000
+
+    def resample_group_in_thread(self, group: list[Datafeed]) -> tuple[int | None, float]:
+        try:
+            return self.resample_group(group)
+        finally:
+            connection.close()  # every thread has its own db connection
 
     @transaction.atomic
-    def create_df_readings_for_ind_df(self, nat_df: Datafeed) -> None:
+    def create_df_readings_for_ind_df(self, nat_df: Datafeed, followers: list[Datafeed] = ()) -> int:
+        """
+        'followers' - the datafeeds expected to have the same resampling key, they get the copies of the df readings
+        of 'nat_df' (the ones whose key has changed by the time they are locked are left for their own runs).
+        Returns the number of the datafeeds that got the df readings.
+        """
         ds = nat_df.datastream
         if ds is None:  # shouldn't be possible at all, just in case
-            return
+            return 0
 
-        # lock both df and ds
-        nat_df = Datafeed.objects.select_for_update().get(pk=nat_df.pk)
+        # lock the datafeeds and the ds, the datafeeds in the order of their pks
+        # as the runs of other apps can lock the same ones
+        app_map = {df.pk: df.parent for df in (nat_df, *followers)}
+        locked_dfs = list(Datafeed.objects.select_for_update().filter(pk__in=app_map).order_by("pk"))
         ds = Datastream.objects.select_for_update().get(pk=ds.pk)
+        for df in locked_dfs:
+            df.parent = app_map[df.pk]
+            df.datastream = ds
+        nat_df = next(df for df in locked_dfs if df.pk == nat_df.pk)
+        key = get_resampling_key(nat_df)
+        followers = [df for df in locked_dfs if df is not nat_df and get_resampling_key(df) == key]
+
+        ds_reading_qs = DsReading.objects.filter(datastream__id=ds.pk)
+        watermark_ts = None
+        if ds.reorder_window > 0:
+            # the readings newer than the watermark can still be complemented by late ones, they wait
+            watermark_ts = create_now_ts_ms() - ds.reorder_window
+            ds_reading_qs = ds_reading_qs.filter(time__lte=watermark_ts)
 
         # first, find the rts up to which new df readings will be created (the rts itself is included)
-        last_dsr = DsReading.objects.filter(datastream__id=ds.pk).order_by("time").last()
-        if last_dsr is None:
+        last_dsr_ts = ds_reading_qs.order_by("-time").values_list("time", flat=True).first()
+        if last_dsr_ts is None:
             # it means that there are no ds readings at all,
             # it may happen at the beginning of evaluation
             if nat_df.is_aug_on and nat_df.aug_policy == AugmentationPolicy.TILL_NOW:
                 end_rts_by_very_last_ds_reading = 0  # it can be any small value, 0 works well here
             else:
-                return
+                # the state tells the next runs where this one started (see 'needs_resampling')
+                no_ds_values = DsValues(np.empty(0, dtype=np.int64), np.empty(0, dtype=float))
+                start_rts = max(self.app.cursor_ts, nat_df.ts_to_start_with)
+                state = self.create_resampling_state(ds, no_ds_values, start_rts, None)
+                for df in (nat_df, *followers):
+                    set_attr_if_cond(state, "!=", df, "resampling_state")
+                    set_attr_if_cond(ds.data_version, "!=", df, "resampled_version")
+                    df.save(update_fields=df.update_fields)
+                return 1 + len(followers)
         else:
-            end_rts_by_very_last_ds_reading = ceil_timestamp(last_dsr.time, self.app.time_resample)
+            end_rts_by_very_last_ds_reading = ceil_timestamp(last_dsr_ts, self.app.time_resample)
 
         # then find the rts starting from which new df readings will be created (the rts itself is not included)
         # df readings older than 'app.cursor_ts' are not created
@@ -59,23 +155,62 @@ class NewDfrCreator:
 
         last_saved_dfr_rts = None
 
+        # the readings after 'start_rts' that the previous run has read already (usually of the unclosed df readings)
+        # are taken from the state, only the newer ones are read from the db
+        state = self.get_resampling_state(nat_df, ds, start_rts, watermark_ts)
+        # [[time, db_value], ...] of the df readings 'from the past' for the restoration, None - not known
+        prev_dfr_rows = state.get("prev_dfrs")
+        with_prev_dfrs = uses_prev_df_readings(nat_df, ds)
+
+        nd_tss = None
+        if ds.is_rbe and nat_df.is_aug_on:
+            # the nodata markers for all the batches, a batch takes the ones after its 'start_rts'
+            nd_tss = fetch_nodata_marker_tss(ds.pk, start_rts)
+
         num_dsrs_to_process = settings.NUM_MAX_DSREADINGS_TO_PROCESS
         # if there are too many ds readings, they are processed in batches of size 'NUM_MAX_DSREADINGS_TO_PROCESS'
         while True:
-            ds_readings = list(
-                DsReading.objects.filter(datastream__id=ds.pk, time__gt=start_rts).order_by("time")[
-                    :num_dsrs_to_process
-                ]
-            )
+            # (time, db_value) columns instead of model instances
+            if len(state) > 0:  # only for the first batch
+                ds_values = DsValues(np.array(state["tss"], dtype=np.int64), np.array(state["values"], dtype=float))
+                num_to_fetch = num_dsrs_to_process - len(ds_values)
+                if last_dsr_ts is not None and last_dsr_ts > state["last_ds_ts"] and num_to_fetch > 0:
+                    ds_values = ds_values.append(
+                        fetch_ds_values(ds_reading_qs.filter(time__gt=state["last_ds_ts"]), num_to_fetch)
+                    )
+                state = {}
+            else:
+                ds_values = fetch_ds_values(ds_reading_qs.filter(time__gt=start_rts), num_dsrs_to_process)
+            batch_nd_tss = None if nd_tss is None else nd_tss[np.searchsorted(nd_tss, start_rts, side="right") :]
+
+            prev_df_readings = None
+            if with_prev_dfrs and len(ds_values) > 0:
+                if prev_dfr_rows is None:
+                    prev_df_readings = get_prev_df_readings(nat_df, start_rts)
+                    prev_dfr_rows = [[dfr.time, dfr.db_value] for dfr in prev_df_readings]
+                else:
+                    prev_df_readings = [
+                        DfReading(time=time, db_value=db_value, datafeed=nat_df, restored=False)
+                        for time, db_value in prev_dfr_rows
+                    ]
 
             df_readings, last_dfr_rts, rts_to_start_with_next_time = create_df_readings(
-                ds_readings, nat_df, start_rts
+                ds_values, nat_df, start_rts, batch_nd_tss, prev_df_readings
             )
+            if prev_dfr_rows is not None:
+                # all the saved df readings are not after 'rts_to_start_with_next_time'
+                prev_dfr_rows += [[dfr.time, dfr.db_value] for dfr in df_readings if not dfr.restored]
+                prev_dfr_rows = prev_dfr_rows[-NUM_PREV_DF_READINGS:]
 
             last_saved_dfr_rts = None
             if len(df_readings) > 0:
                 logger.debug(f"Saving {len(df_readings)} readings for df {nat_df.pk} '{nat_df.name}'")
-                DfReading.objects.bulk_create(df_readings)
+                copies = [
+                    DfReading(time=dfr.time, db_value=dfr.db_value, restored=dfr.restored, datafeed=df)
+                    for df in followers
+                    for dfr in df_readings
+                ]
+                write_objects(DfReading, df_readings + copies, ignore_conflicts=False)
                 last_saved_dfr_rts = df_readings[-1].time
                 logger.debug(f"Last saved dfr rts: {last_saved_dfr_rts}")
 
@@ -109,13 +244,19 @@ class NewDfrCreator:
                 num_dsrs_to_process = settings.NUM_MAX_DSREADINGS_TO_PROCESS
                 start_rts = rts_to_start_with_next_time
 
-        if rts_to_start_with_next_time > nat_df.ts_to_start_with:
-            nat_df.ts_to_start_with = rts_to_start_with_next_time
-            nat_df.update_fields.add("ts_to_start_with")
-        if last_saved_dfr_rts is not None:
-            nat_df.last_reading_ts = last_saved_dfr_rts
-            nat_df.update_fields.add("last_reading_ts")
-        nat_df.save(update_fields=nat_df.update_fields)
+        # the last batch has all the readings from its 'start_rts' up to its last one
+        state = self.create_resampling_state(ds, ds_values, rts_to_start_with_next_time, prev_dfr_rows)
+        for df in (nat_df, *followers):
+            if rts_to_start_with_next_time > df.ts_to_start_with:
+                df.ts_to_start_with = rts_to_start_with_next_time
+                df.update_fields.add("ts_to_start_with")
+            if last_saved_dfr_rts is not None:
+                df.last_reading_ts = last_saved_dfr_rts
+                df.update_fields.add("last_reading_ts")
+            set_attr_if_cond(state, "!=", df, "resampling_state")
+            # the readings and markers saved after the lock of the datastream make the datafeed dirty again
+            set_attr_if_cond(ds.data_version, "!=", df, "resampled_version")
+            df.save(update_fields=df.update_fields)
 
         if rts_to_start_with_next_time > ds.ts_to_start_with:
             ds.ts_to_start_with = rts_to_start_with_next_time
@@ -130,3 +271,64 @@ class NewDfrCreator:
         # (because in the most cases it would be an rts before the
         # last df reading produced by a resampling function).
         # But for the sake of simplicity only one variable is used.
+        return 1 + len(followers)
+
+    def needs_resampling(self, df: Datafeed) -> bool:
+        """
+        False if the datastream got no readings or nodata markers since the last run ('data_version'),
+        the run would start where the last one stopped (its state has the same datastream, 'time_resample'
+        and 'start_rts', otherwise the datafeed was re-pointed or reset and 'resampled_version' is not
+        about its datastream) and the result does not depend on the time (the augmentation till now
+        and the watermark do). A datafeed without a state (too many readings to keep) is always resampled.
+        """
+        ds = df.datastream
+        state = df.resampling_state
+        return (
+            df.resampled_version < ds.data_version
+            or state.get("ds") != ds.pk
+            or state.get("time_resample") != self.app.time_resample
+            or state.get("start_rts") != max(self.app.cursor_ts, df.ts_to_start_with)
+            or ds.reorder_window > 0
+            or (df.is_aug_on and df.aug_policy == AugmentationPolicy.TILL_NOW)
+        )
+
+    def get_resampling_state(self, nat_df: Datafeed, ds: Datastream, start_rts: int, watermark_ts: int | None) -> dict:
+        """
+        The state saved by the previous run or {} if it cannot be used: the run starts elsewhere
+        (e.g. 'cursor_ts' was moved), the datafeed settings were changed, readings were saved among the ones
+        that were read ('num_backfills') or the watermark was moved back.
+        """
+        state = nat_df.resampling_state
+        if (
+            len(state) == 0
+            or state["start_rts"] != start_rts
+            or state["ds"] != ds.pk
+            or state["time_resample"] != self.app.time_resample
+            or state["backfills"] != ds.num_backfills
+            or (watermark_ts is not None and len(state["tss"]) > 0 and state["tss"][-1] > watermark_ts)
+        ):
+            return {}
+        return state
+
+    def create_resampling_state(
+        self, ds: Datastream, ds_values: DsValues, start_rts: int, prev_dfr_rows: list[list] | None
+    ) -> dict:
+        """
+        'ds_values' - the readings of the last batch, they are complete from the 'start_rts' of the batch
+        (which is not after the 'start_rts' here) to the last one.
+        """
+        is_after = ds_values.tss > start_rts
+        if is_after.sum() > settings.RESAMPLING_STATE_MAX_DSREADINGS:
+            return {}
+        tss = ds_values.tss[is_after].tolist()
+        return {
+            "start_rts": start_rts,
+            "ds": ds.pk,
+            "time_resample": self.app.time_resample,
+            "backfills": ds.num_backfills,
+            # the next run reads the readings after 'last_ds_ts' only
+            "last_ds_ts": tss[-1] if len(tss) > 0 else start_rts,
+            "tss": tss,
+            "values": ds_values.values[is_after].tolist(),
+            "prev_dfrs": prev_dfr_rows,
+        }
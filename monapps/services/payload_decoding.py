@@ -0,0 +1,224 @@
+import base64
+import json
+import logging
+from typing import Any, Callable
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:  # optional, 'json' from the standard library is used without it
+    orjson = None
+
+from services.frame_decoders import frame_decoders, TableFrameDecoder
+from utils.ts_utils import create_now_ts_ms, create_ts_ms_from_iso_str
+
+logger = logging.getLogger("#payload_decoding")
+
+type JsonLoadsFunc = Callable[[bytes | str], Any]
+type AlarmRow = dict[str, Any]  # {"e": {...}, "w": {...}, "i": [...]}, only the keys that came in the payload
+type MessageDecoder = Callable[[Any], list[tuple[str, dict]]]
+
+ALARM_KEYS = frozenset(("e", "w", "i"))  # the keys of a row that are not datastream names
+NUMERIC_TYPES = frozenset((int, float, bool))  # the same as "isinstance(value, (int, float))" for JSON values
+
+
+class PayloadValidationError(ValueError):
+    pass
+
+
+def get_json_loads(backend: str = settings.MQTT_SUB_JSON_BACKEND) -> JsonLoadsFunc:
+    """Both backends parse bytes directly, so a message payload does not have to be decoded into 'str' first."""
+    match backend:
+        case "auto":
+            return orjson.loads if orjson is not None else json.loads
+        case "orjson":
+            if orjson is None:
+                raise ImportError("'orjson' is selected as the JSON backend, but it is not installed")
+            return orjson.loads
+        case "json":
+            return json.loads
+    raise ValueError(f"Unknown JSON backend: {backend}")
+
+
+json_loads = get_json_loads()
+
+
+def decode_rawdata_message(payload: Any) -> list[tuple[str, dict]]:
+    """
+    {"dev_ui1": {"1234567890123": {...}, ...}, "dev_ui2": {...}, ...} - payloads from ESF
+    (or forwarded by another subscriber process), 'dev_ui's are lowercased.
+    """
+    if type(payload) is not dict:
+        raise PayloadValidationError("Incorrect payload")
+    dev_payloads = []
+    for dev_ui, dev_payload in payload.items():
+        if type(dev_payload) is not dict:
+            logger.warning(f"Incorrect payload for device '{dev_ui}'")
+            continue
+        dev_payloads.append((dev_ui.lower(), dev_payload))  # unify all 'dev_ui's stored in the db
+    return dev_payloads
+
+
+def decode_chirpstack_message(payload: Any) -> list[tuple[str, dict]]:
+    """
+    Chirpstack uplink event, the device payload is in "object" (it is made by the device codec).
+    In the "raw" decoding mode the frame in "data" is decoded here instead, if there is a frame decoder
+    for the device profile.
+    """
+    if (
+        type(payload) is not dict
+        or type(device_info := payload.get("deviceInfo")) is not dict
+        or type(dev_ui := device_info.get("devEui")) is not str
+    ):
+        raise PayloadValidationError("Incorrect Chirpstack payload")
+    if (
+        settings.MQTT_SUB_CHIRPSTACK_DECODING == "raw"
+        and type(data := payload.get("data")) is str
+        and (frame_decoder := get_frame_decoder(device_info)) is not None
+    ):
+        return [(dev_ui.lower(), decode_chirpstack_frame(payload, data, frame_decoder))]
+    if type(dev_payload := payload.get("object")) is not dict:
+        raise PayloadValidationError("Incorrect Chirpstack payload")
+    return [(dev_ui.lower(), dev_payload)]
+
+
+def get_frame_decoder(device_info: dict) -> TableFrameDecoder | None:
+    decoder_name = settings.MQTT_SUB_FRAME_DECODERS.get(device_info.get("deviceProfileName"))
+    return frame_decoders.get(decoder_name) if decoder_name is not None else None
+
+
+def decode_chirpstack_frame(payload: dict, data: str, frame_decoder: TableFrameDecoder) -> dict:
+    """
+    The frame is base64-encoded in "data". The timestamp is the time of reception (so the frames
+    of a backlog keep their own times), or now if there is no such time (as the JS codecs do).
+    Raises ValueError if the frame cannot be decoded.
+    """
+    row = frame_decoder.decode(base64.b64decode(data, validate=True))
+    ts = create_ts_ms_from_iso_str(time_str) if type(time_str := payload.get("time")) is str else create_now_ts_ms()
+    return {str(ts): row}
+
+
+class MessageDecoderRegistry:
+    """
+    Selects the decoder of a message by its topic. Decoders are checked in the order of registration,
+    the default one is used if no decoder matches. The choice is cached per topic.
+    """
+
+    def __init__(self, default_decoder: MessageDecoder):
+        self.default_decoder = default_decoder
+        self.entries: list[tuple[Callable[[str], bool], MessageDecoder]] = []
+        self.decoder_by_topic: dict[str, MessageDecoder] = {}
+
+    def register(self, is_topic_matching: Callable[[str], bool], decoder: MessageDecoder):
+        self.entries.append((is_topic_matching, decoder))
+        self.decoder_by_topic.clear()
+
+    def get_decoder(self, topic: str) -> MessageDecoder:
+        if (decoder := self.decoder_by_topic.get(topic)) is None:
+            decoder = next(
+                (decoder for is_topic_matching, decoder in self.entries if is_topic_matching(topic)),
+                self.default_decoder,
+            )
+            if len(self.decoder_by_topic) < 10000:  # topics usually repeat, but just in case
+                self.decoder_by_topic[topic] = decoder
+        return decoder
+
+    def decode(self, topic: str, msg_payload: bytes | str) -> list[tuple[str, dict]]:
+        """Returns [(dev_ui, dev_payload), ...], raises ValueError if the message cannot be decoded."""
+        return self.get_decoder(topic)(json_loads(msg_payload))
+
+
+message_decoder_registry = MessageDecoderRegistry(decode_rawdata_message)
+message_decoder_registry.register(lambda topic: "chirpstack" in topic, decode_chirpstack_message)
+
+
+class DecodedDevPayload:
+    """
+    A device payload prepared for processing:
+    'tss' - sorted timestamps,
+    'values' - {ds_name: [value or None for every timestamp]}, only numeric values are kept,
+    'ds_alarm_rows' - {ds_name: {ts: alarm row}}, only for the timestamps where the datastream has alarms or infos,
+    'dev_alarm_rows' - {ts: alarm row} for the device.
+    """
+
+    __slots__ = ("tss", "values", "ds_alarm_rows", "dev_alarm_rows", "num_invalid")
+
+    def __init__(self):
+        self.tss: list[int] = []
+        self.values: dict[str, list[int | float | None]] = {}
+        self.ds_alarm_rows: dict[str, dict[int, AlarmRow]] = {}
+        self.dev_alarm_rows: dict[int, AlarmRow] = {}
+        self.num_invalid = 0  # rows and items that did not pass the validation
+
+    def __len__(self):
+        return len(self.tss)
+
+    def take_rows(self, idxs: list[int]):
+        """Keeps only the rows with the indexes 'idxs' (in the same order)."""
+        kept_tss = set(self.tss[idx] for idx in idxs)
+        self.tss = [self.tss[idx] for idx in idxs]
+        self.values = {key: [values[idx] for idx in idxs] for key, values in self.values.items()}
+        self.ds_alarm_rows = {
+            key: {ts: row for ts, row in rows.items() if ts in kept_tss} for key, rows in self.ds_alarm_rows.items()
+        }
+        self.dev_alarm_rows = {ts: row for ts, row in self.dev_alarm_rows.items() if ts in kept_tss}
+
+
+def decode_dev_payload(dev_payload: dict) -> DecodedDevPayload:
+    """
+    Validates a device payload {"1234567890123": {"e": {...}, "w": {...}, "i": [...], "ds_name": {...}}, ...}
+    and converts it into a 'DecodedDevPayload'. Invalid parts are skipped (and logged).
+    If several keys give the same timestamp, the last row is used.
+    """
+    decoded = DecodedDevPayload()
+    row_map = {}
+    for k, row in dev_payload.items():
+        try:
+            ts = int(k)
+        except ValueError as e:
+            decoded.num_invalid += 1
+            logger.error(f"Cannot convert {k} to a timestamp, {e}")
+            continue
+        if type(row) is not dict:
+            decoded.num_invalid += 1
+            logger.error(f"Incorrect row for the timestamp {k}")
+            continue
+        row_map[ts] = row
+
+    decoded.tss = tss = sorted(row_map)
+    num_tss = len(tss)
+    values = decoded.values
+    for idx, ts in enumerate(tss):
+        for key, item in row_map[ts].items():
+            if key in ALARM_KEYS:
+                if (item := validate_alarm_item(key, item, decoded)) is not None:
+                    decoded.dev_alarm_rows.setdefault(ts, {})[key] = item
+                continue
+
+            if type(item) is not dict:
+                decoded.num_invalid += 1
+                logger.error(f"Incorrect row of the datastream '{key}' for the timestamp {ts}")
+                continue
+            if type(value := item.get("v")) in NUMERIC_TYPES:
+                try:
+                    values[key][idx] = value
+                except KeyError:  # the first value of the datastream
+                    values[key] = [None] * num_tss
+                    values[key][idx] = value
+                if len(item) == 1:  # the most common case, only a value
+                    continue
+            for alarm_key in ("e", "w", "i"):
+                if (alarm_item := item.get(alarm_key)) is not None:
+                    if (alarm_item := validate_alarm_item(alarm_key, alarm_item, decoded)) is not None:
+                        decoded.ds_alarm_rows.setdefault(key, {}).setdefault(ts, {})[alarm_key] = alarm_item
+    return decoded
+
+
+def validate_alarm_item(key: str, item: Any, decoded: DecodedDevPayload) -> Any:
+    # errors and warnings should be dicts {"alarm name": {...}, ...}, infos are iterated as they are
+    if key != "i" and item is not None and type(item) is not dict:
+        decoded.num_invalid += 1
+        logger.error(f"Incorrect alarm dictionary '{key}': {item}")
+        return None
+    return item
@@ -3,7 +3,7 @@ import traceback
 from itertools import islice
 from collections.abc import Iterable
 
-from django.db import transaction
+from django.db import transaction, OperationalError, InterfaceError
 from django.conf import settings
 
 from apps.datastreams.models import Datastream
@@ -16,13 +16,19 @@ from apps.dsreadings.models import (
     NoDataMarker,
     UnusedNoDataMarker,
 )
-from utils.dsr_utils import create_ds_readings, create_nodata_markers
+from utils.dsr_utils import DS_READING_FIELDS, create_ds_values, create_nodata_markers
 from utils.ts_utils import create_now_ts_ms
 from utils.update_utils import set_attr_if_cond, enqueue_update
-from utils.alarm_utils import update_alarm_map, at_least_one_alarm_in
+from utils.alarm_utils import AlarmMapEngine, at_least_one_alarm_in
 from utils.sequnce_utils import find_max_ts
 from services.device_log import add_to_device_log
-from common.constants import HealthGrades, VariableTypes, DataAggrTypes
+from services.device_config_cache import device_config_cache
+from services.duplicate_filter import duplicate_filter
+from services.dead_letters import DEAD_LETTER_OUTCOMES, dead_letter_store
+from services.dfr_dispatch import dfr_dispatch_notifier
+from services.bulk_writer import write_objects, write_rows
+from services.payload_decoding import decode_dev_payload, AlarmRow
+from common.constants import HealthGrades, VariableTypes, DataAggrTypes, ProcessingOutcomes
 
 logger = logging.getLogger("#raw_data_proc")
 
@@ -32,76 +38,111 @@ class RawDataProcessor:
         self.now_ts = create_now_ts_ms()
         self.dev_ui = dev_ui
         self.payload = payload
-        self.int_key_payload = {}
+        self.num_skipped = 0  # readings and markers not saved as they already exist
+        self.num_duplicates = 0  # re-sent rows dropped before processing
+        self.error = ""  # the traceback if the processing failed
+        self.has_new_data = False  # readings or nodata markers were saved, the datafeeds are to be resampled
+
+    def execute(self) -> ProcessingOutcomes:
+        outcome = self.process()
+        if outcome in DEAD_LETTER_OUTCOMES:
+            dead_letter_store.add(self.dev_ui, self.payload, outcome, self.error)
+        return outcome
+
+    def process(self) -> ProcessingOutcomes:
+        try:
+            if not self.discover_device():
+                logger.error(f"Cannot discover device {self.dev_ui}")
+                return ProcessingOutcomes.UNKNOWN_DEVICE
 
-    def execute(self):
+            if not self.condition_payload():
+                logger.error("No valid timestamps in the payload")
+                return ProcessingOutcomes.NO_VALID_TSS
 
-        if not self.discover_device():
-            logger.error(f"Cannot discover device {self.dev_ui}")
-            return
+            if not self.drop_duplicates():
+                logger.debug(f"All the rows for {self.dev_ui} were processed already")
+                return ProcessingOutcomes.DUPLICATE
 
-        if not self.condition_payload():
-            logger.error("No valid timestamps in the payload")
-            return
-        try:
             with transaction.atomic():
                 self.prepare_for_processing()
                 self.process_payload()
                 self.process_after_cycle()
+                # the rows are recorded only when they are really in the db
+                transaction.on_commit(lambda: duplicate_filter.record(self.dev.pk, self.dev_payload), robust=True)
+                if self.has_new_data:
+                    transaction.on_commit(dfr_dispatch_notifier.notify, robust=True)
+        except (OperationalError, InterfaceError):
+            # the transaction was rolled back, the payload can be processed again later
+            logger.error(f"DB error while processing a message: {traceback.format_exc(-1)}")
+            return ProcessingOutcomes.DB_ERROR
         except Exception:
             # add_to_alarm_log("ERROR", "Error while processing a message", instance="MQTT Sub")
-            logger.error(f"Error while processing a message: {traceback.format_exc(-1)}")
+            self.error = traceback.format_exc(-1)
+            logger.error(f"Error while processing a message: {self.error}")
+            return ProcessingOutcomes.ERROR
+        return ProcessingOutcomes.PROCESSED
 
     def discover_device(self):
-        try:
-            self.dev = Device.objects.get(dev_ui=self.dev_ui)
-            return True
-        except (Device.DoesNotExist, Device.MultipleObjectsReturned):
-            return False
+        is_cached, self.dev_pk = device_config_cache.get_dev_pk(self.dev_ui)
+        if not is_cached:
+            version = device_config_cache.version
+            self.dev_pk = Device.objects.filter(dev_ui=self.dev_ui).values_list("pk", flat=True).first()
+            device_config_cache.put_dev_pk(self.dev_ui, self.dev_pk, version)
+        return self.dev_pk is not None
 
     def condition_payload(self):
-        self.replace_str_tss_with_ints()
-        if len(self.int_key_payload) == 0:
-            return False
-        self.int_key_payload = dict(sorted(self.int_key_payload.items()))  # sort by timestamps
-        return True
-
-    def replace_str_tss_with_ints(self):
-        for k, v in self.payload.items():
-            try:
-                ts = int(k)
-            except ValueError as e:
-                logger.error(f"Cannot convert {k} to a timestamp, {e}")
-            else:
-                self.int_key_payload[ts] = v
+        # timestamps are converted and sorted, values and alarms are validated
+        self.dev_payload = decode_dev_payload(self.payload)
+        return len(self.dev_payload.tss) > 0
+
+    def drop_duplicates(self):
+        # re-sent rows are dropped, returns False if nothing is left
+        self.num_duplicates = duplicate_filter.drop_duplicates(self.dev_pk, self.dev_ui, self.dev_payload)
+        return len(self.dev_payload.tss) > 0
 
     def prepare_for_processing(self):
-        self.dev = Device.objects.select_for_update().get(dev_ui=self.dev.dev_ui)
-        ds_qs = self.dev.datastreams.filter(is_enabled=True).select_for_update()  # get ACTIVE datastreams only
+        # only rows are locked (and their current state is read) here,
+        # the static configuration comes from the cache
+        self.dev = Device.objects.select_for_update().filter(pk=self.dev_pk, dev_ui=self.dev_ui).first()
+        if self.dev is None:  # the cached pk is outdated (the device was changed in another process)
+            device_config_cache.drop_dev_pk(self.dev_ui)
+            self.dev = Device.objects.select_for_update().get(dev_ui=self.dev_ui)
+        ds_qs = list(self.dev.datastreams.filter(is_enabled=True).select_for_update())  # get ACTIVE datastreams only
+        device_config_cache.attach_data_types(ds_qs)
         self.ds_map = {ds.name: ds for ds in ds_qs}
         self.nd_marker_map = {ds.name: set() for ds in ds_qs}
         self.ds_reading_map = {ds.name: {} for ds in ds_qs}
+        # alarm maps are updated in place for all the timestamps and put back into the instances after the cycle
+        self.alarm_engine_map = {
+            (instance, alarm_map_type): AlarmMapEngine(instance, alarm_map_type, add_to_log=add_to_device_log)
+            for instance in (*ds_qs, self.dev)
+            for alarm_map_type in ("errors", "warnings")
+        }
 
     def process_payload(self):
-        for ts, row in self.int_key_payload.items():
+        dev_payload = self.dev_payload
+        no_alarms = {}  # a plug
+        ds_columns = [
+            (ds, dev_payload.values.get(ds.name), dev_payload.ds_alarm_rows.get(ds.name, no_alarms))
+            for ds in self.ds_map.values()
+        ]
+        for idx, ts in enumerate(dev_payload.tss):
             self.needing_nd_marker_dss = set()
             self.at_least_one_ds_has_no_errors_and_has_value = False
             # process the datastreams
-            for ds in self.ds_map.values():
-                if (ds_row := row.get(ds.name)) is None:
-                    ds_row = {}  # a plug
+            for ds, ds_values, ds_alarm_rows in ds_columns:
+                new_value = ds_values[idx] if ds_values is not None else None
                 # 'process_ds_payload' should be executed even if there is no data
                 # for the datastream in the row
-                self.process_ds_payload(ds, ts, ds_row)
+                self.process_ds_payload(ds, ts, new_value, ds_alarm_rows.get(ts, no_alarms))
 
             # Process the device
-            self.process_dev_payload(self.dev, ts, row)
+            self.process_dev_payload(self.dev, ts, dev_payload.dev_alarm_rows.get(ts, no_alarms))
 
-    def process_ds_payload(self, ds: Datastream, ts: int, ds_row: dict):
+    def process_ds_payload(self, ds: Datastream, ts: int, new_value: int | float | None, ds_row: AlarmRow):
         # process values
         has_value = False
-        new_value = ds_row.get("v")
-        if new_value is not None and isinstance(new_value, (int, float)):
+        if new_value is not None:
             # add value to the array to be saved later
             self.ds_reading_map[ds.name][ts] = new_value
             has_value = True
@@ -110,11 +151,7 @@ class RawDataProcessor:
         error_dict = ds_row.get("e")
         # even if 'error_dict_for_ts' is None, the alarm map will be processed
         # to ensure 'out' statuses proper assigment
-        upd_error_map, is_nd_marker_needed = update_alarm_map(
-            ds, error_dict, ts, "errors", has_value, add_to_log=add_to_device_log
-        )
-
-        set_attr_if_cond(upd_error_map, "!=", ds, "errors")
+        is_nd_marker_needed = self.alarm_engine_map[(ds, "errors")].apply(error_dict, ts, has_value)
 
         if is_nd_marker_needed:
             self.needing_nd_marker_dss.add(ds.name)
@@ -124,8 +161,7 @@ class RawDataProcessor:
 
         # process warnings
         warning_dict = ds_row.get("w")
-        upd_warning_map, _ = update_alarm_map(ds, warning_dict, ts, "warnings", add_to_log=add_to_device_log)
-        set_attr_if_cond(upd_warning_map, "!=", ds, "warnings")
+        self.alarm_engine_map[(ds, "warnings")].apply(warning_dict, ts)
 
         # process infos
         infos_for_ts = ds_row.get("i")
@@ -133,26 +169,19 @@ class RawDataProcessor:
             for info_str in infos_for_ts:
                 add_to_device_log("INFO", info_str, ts, ds, "")
 
-    def process_dev_payload(self, dev: Device, ts: int, row: dict):
+    def process_dev_payload(self, dev: Device, ts: int, row: AlarmRow):
         # process errors
         error_dict = row.get("e")
-        upd_error_map, is_nd_marker_needed = update_alarm_map(
-            dev,
-            error_dict,
-            ts,
-            "errors",
-            self.at_least_one_ds_has_no_errors_and_has_value,
-            add_to_log=add_to_device_log,
+        is_nd_marker_needed = self.alarm_engine_map[(dev, "errors")].apply(
+            error_dict, ts, self.at_least_one_ds_has_no_errors_and_has_value
         )
-        set_attr_if_cond(upd_error_map, "!=", dev, "errors")
 
         if is_nd_marker_needed:
             self.needing_nd_marker_dss.update(self.ds_map.keys())  # on device error all datastreams acquire nd markers
 
         # process device warnings
         warning_dict = row.get("w")
-        upd_warning_map, _ = update_alarm_map(dev, warning_dict, ts, "warnings", add_to_log=add_to_device_log)
-        set_attr_if_cond(upd_warning_map, "!=", dev, "warnings")
+        self.alarm_engine_map[(dev, "warnings")].apply(warning_dict, ts)
 
         # process device infos
         infos = row.get("i")
@@ -165,6 +194,9 @@ class RawDataProcessor:
             self.nd_marker_map[ds_name].add(ts)
 
     def process_after_cycle(self):
+        for engine in self.alarm_engine_map.values():
+            engine.save_to_instance()
+
         for ds in self.ds_map.values():
             self.process_ds_after_cycle(ds)
 
@@ -199,42 +231,71 @@ class RawDataProcessor:
         else:
             nd_markers, unused_nd_markers = create_nodata_markers(self.nd_marker_map[ds.name], ds, self.now_ts)
 
-        # create ds readings
-        ds_readings, unused_ds_readings, invalid_ds_readings, non_roc_ds_readings = create_ds_readings(
+        # classify the values of the datastream, readings are created only when saved
+        ds_values, unused_ds_values, invalid_ds_values, non_roc_ds_values = create_ds_values(
             self.ds_reading_map[ds.name], ds, self.now_ts
         )
 
+        if len(ds_values) > 0 and ds.last_reading_ts is not None and int(ds_values.tss[0]) <= ds.last_reading_ts:
+            # the readings can land where the resampling of the datafeeds has read already,
+            # the first readings of a datastream cannot
+            ds.num_backfills += 1
+            ds.update_fields.add("num_backfills")
+
         # update 'ts_to_start_with' and 'last_reading_ts'
-        ts_to_start_with = max(find_max_ts(ds_readings), find_max_ts(nd_markers))
+        last_reading_ts = int(ds_values.tss[-1]) if len(ds_values) > 0 else 0  # ds_values - only valid readings
+        ts_to_start_with = max(last_reading_ts, find_max_ts(nd_markers))
+        if ds.reorder_window > 0:
+            # the late readings are accepted up to the watermark
+            ts_to_start_with = min(ts_to_start_with, self.now_ts - ds.reorder_window)
         set_attr_if_cond(ts_to_start_with, ">", ds, "ts_to_start_with")
 
-        last_reading_ts = find_max_ts(ds_readings)  # ds_readings - only valid readings
-        set_attr_if_cond(last_reading_ts, ">", ds, "last_reading_ts")
+        if set_attr_if_cond(last_reading_ts, ">", ds, "last_reading_ts"):
+            # the base point for the ROC filter of the next readings
+            ds.last_reading_value = float(ds_values.values[-1])
+            ds.update_fields.add("last_reading_value")
 
         # for periodic datastreams plan health recalculation right away
         if ds.time_update is not None:
             ds.health_next_eval_ts = self.now_ts + settings.TIME_DS_HEALTH_EVAL_MS
             ds.update_fields.add("health_next_eval_ts")
 
-        # finally, save the datastream and readings
-        ds.save(update_fields=ds.update_fields)
-
+        # finally, save the readings and the datastream
+        # the readings that already exist are skipped and counted
         t = (
-            (ds_readings, DsReading),
-            (unused_ds_readings, UnusedDsReading),
-            (invalid_ds_readings, InvalidDsReading),
-            (non_roc_ds_readings, NonRocDsReading),
-            (nd_markers, NoDataMarker),
-            (unused_nd_markers, UnusedNoDataMarker),
+            (ds_values, DsReading),
+            (unused_ds_values, UnusedDsReading),
+            (invalid_ds_values, InvalidDsReading),
+            (non_roc_ds_values, NonRocDsReading),
         )
-        for objects, model in t:
-            batch_size = 100
-            for i in range(0, len(objects), batch_size):
-                if (batch:= objects[i:i + batch_size]):
-                    # ignore_conflicts=True will skip saving the object if it already exists
-                    # TODO: how to track such "unsaved" objects?
-                    model.objects.bulk_create(batch, batch_size=len(batch), ignore_conflicts=True)
-            logger.debug(f"Saved {len(objects)} {model.__name__}")
+        for values, model in t:
+            if len(values) == 0:
+                continue
+            num_saved, num_skipped = write_rows(model, DS_READING_FIELDS, values.rows(ds.pk), ignore_conflicts=True)
+            self.num_skipped += num_skipped
+            logger.debug(f"Saved {num_saved} {model.__name__}, skipped {num_skipped}")
+            if model is DsReading and num_saved > 0:
+                self.mark_new_data(ds)
+            if model is DsReading and num_skipped > 0 and ds.last_reading_value is not None:
+                # the db can keep another value for the last reading, the next base point will be taken from the db
+                ds.last_reading_value = None
+                ds.update_fields.add("last_reading_value")
+
+        for objects, model in ((nd_markers, NoDataMarker), (unused_nd_markers, UnusedNoDataMarker)):
+            num_saved, num_skipped = write_objects(model, objects, ignore_conflicts=True)
+            self.num_skipped += num_skipped
+            logger.debug(f"Saved {num_saved} {model.__name__}, skipped {num_skipped}")
+            if model is NoDataMarker and num_saved > 0:
+                self.mark_new_data(ds)
+
+        ds.save(update_fields=ds.update_fields)
+
+    def mark_new_data(self, ds: Datastream):
+        # the datafeeds of the datastream become dirty when the transaction is committed
+        if "data_version" not in ds.update_fields:
+            ds.data_version += 1
+            ds.update_fields.add("data_version")
+        self.has_new_data = True
 
     def process_dev_after_cycle(self, dev: Device):
         # define device health
@@ -248,9 +309,9 @@ class RawDataProcessor:
         elif at_least_one_warning_in:
             msg_health = HealthGrades.WARNING
 
-        if not set_attr_if_cond(msg_health, "!=", dev, "msg_health"):
-            return
-
-        enqueue_update(dev, self.now_ts)
+        if set_attr_if_cond(msg_health, "!=", dev, "msg_health"):
+            enqueue_update(dev, self.now_ts)
 
+        # alarm maps can change even if the health is the same, so the device is saved anyway
+        # (nothing happens if there is nothing in 'update_fields')
         dev.save(update_fields=dev.update_fields)
@@ -0,0 +1,73 @@
+import threading
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from apps.datafeeds.models import Datafeed
+
+
+class ResamplingKey(NamedTuple):
+    """The inputs of the resampling of a native datafeed, the datafeeds with equal keys get the same df readings."""
+
+    ds_pk: int
+    time_resample: int
+    data_type_pk: int  # the df readings of integer data types are rounded
+    is_rest_on: bool
+    is_aug_on: bool
+    aug_policy: int
+    start_rts: int
+    # the restoration takes the previous df readings, the datafeeds are expected to have the same ones
+    last_reading_ts: int | None
+
+
+def get_resampling_key(df: Datafeed) -> ResamplingKey:
+    """'df.parent' (the app) should be attached, 'cursor_ts' of the app is taken from it."""
+    return ResamplingKey(
+        df.datastream_id,
+        df.parent.time_resample,
+        df.data_type_id,
+        df.is_rest_on,
+        df.is_aug_on,
+        df.aug_policy,
+        max(df.parent.cursor_ts, df.ts_to_start_with),
+        df.last_reading_ts,
+    )
+
+
+def create_resampling_plan(dfs: Iterable[Datafeed], sibling_dfs: Iterable[Datafeed]) -> list[list[Datafeed]]:
+    """
+    Groups the native datafeeds to resample ('dfs') with the datafeeds of the same datastream ('sibling_dfs',
+    usually of other apps) by the resampling key. The series is computed once per group, for the first datafeed,
+    and written for all of them. The groups of siblings only are not in the plan.
+    """
+    groups: dict[ResamplingKey, list[Datafeed]] = {}
+    for df in dfs:
+        groups.setdefault(get_resampling_key(df), []).append(df)
+    for df in sibling_dfs:
+        if (group := groups.get(get_resampling_key(df))) is not None and df not in group:
+            group.append(df)
+    return list(groups.values())
+
+
+class ResamplingCounters:
+    """
+    Thread-safe totals of the resampling runs of the process: the datafeeds that got df readings
+    and the series computed for them, the dedup ratio is datafeeds/series.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {"datafeeds": 0, "series": 0}
+
+    def add(self, num_dfs: int, num_series: int = 1):
+        with self.lock:
+            self.totals["datafeeds"] += num_dfs
+            self.totals["series"] += num_series
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            totals = dict(self.totals)
+        totals["dedup_ratio"] = round(totals["datafeeds"] / totals["series"], 2) if totals["series"] > 0 else 1.0
+        return totals
+
+
+resampling_counters = ResamplingCounters()
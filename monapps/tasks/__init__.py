@@ -1,3 +1,4 @@
+from .create_dirty_dfrs import create_dirty_dfrs
 from .exec_app_func import exec_app_func
 from .update_assets import update_assets
 from .update_devices import update_devices
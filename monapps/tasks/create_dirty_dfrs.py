@@ -0,0 +1,22 @@
+import logging
+
+from celery import shared_task
+from django.conf import settings
+
+from services.app_func_executor import AppFuncExecutor
+from services.dfr_dispatch import DIRTY_DFS_TASK_NAME, get_dirty_app_qs
+from services.new_dfr_creator import NewDfrCreator
+from tasks.exec_app_func import discover_app_func
+
+logger = logging.getLogger("#dirty_dfs_task")
+
+
+@shared_task(bind=True, name=DIRTY_DFS_TASK_NAME)
+def create_dirty_dfrs(self) -> None:
+    # sent by the ingestion, only the apps with dirty datafeeds are resampled (and only these datafeeds)
+    for app in get_dirty_app_qs():
+        NewDfrCreator(app).execute()
+        if not settings.DIRTY_DFS_RUN_APP_FUNC or app.task is None:
+            continue
+        if (app_func := discover_app_func(app)) is not None:
+            AppFuncExecutor(app, app_func, app.task).execute()
@@ -50,6 +50,116 @@ type AddToLogFunc = Callable[
 ]
 
 
+class AlarmMapEngine:
+    """
+    Applies alarm payloads of consecutive timestamps to one alarm map ("errors" or "warnings") of an instance.
+    The map is copied once when the engine is created, transitions are applied in place and
+    only the alarms with the status "in" are checked when looking for alarms that should go "out".
+    The transitions and the log calls are the same as if 'update_alarm_map' were called for every timestamp.
+    The map is put back into the instance by 'save_to_instance' (once, after all the timestamps are applied).
+    """
+
+    def __init__(
+        self,
+        instance: Device | Datastream | Application,
+        alarm_map_type: Literal["errors", "warnings"],
+        add_to_log: AddToLogFunc = add_to_alarm_log,
+    ):
+        self.instance = instance
+        self.alarm_map_type = alarm_map_type
+        self.is_errors = alarm_map_type == "errors"
+        self.log_level: Literal["ERROR", "WARNING"] = alarm_map_type[:-1].upper()
+        self.add_to_log = add_to_log
+        self.alarm_map = copy.deepcopy(getattr(instance, alarm_map_type))
+        # the order of the alarms in the map, the "out" sweep keeps it for the log calls
+        self.alarm_idxs = {alarm_name: idx for idx, alarm_name in enumerate(self.alarm_map)}
+        self.in_alarm_names = {name for name, ind_alarm_obj in self.alarm_map.items() if ind_alarm_obj["st"] == "in"}
+        self.is_dirty = False
+
+    def set_alarm_attr(self, alarm_name: str, attr: str, value):
+        ind_alarm_obj = self.alarm_map[alarm_name]
+        if ind_alarm_obj.get(attr) != value:
+            ind_alarm_obj[attr] = value
+            self.is_dirty = True
+
+    def set_alarm_status(self, alarm_name: str, new_status: str, ts: int):
+        self.set_alarm_attr(alarm_name, "st", new_status)
+        self.set_alarm_attr(alarm_name, "lastTransTs", ts)
+        if new_status == "in":
+            self.in_alarm_names.add(alarm_name)
+        else:
+            self.in_alarm_names.discard(alarm_name)
+
+    def apply(self, alarm_dict: AlarmPayloadDictForTs | None, ts: int, has_value: bool = False) -> bool:
+        """
+        Applies the alarm dictionary for a timestamp, see 'update_alarm_map' for the details.
+        Returns True if an nd marker is needed.
+        """
+        is_nd_marker_needed = False
+        if alarm_dict is not None:
+            for alarm_name, ind_alarm_obj in alarm_dict.items():  # ind_alarm_obj can be {"st": "in"} or {}
+                is_persistent = isinstance(ind_alarm_obj, dict) and (
+                    (new_status := str(ind_alarm_obj.get("st")).lower()) == "in" or new_status == "out"
+                )
+                if not is_persistent:
+                    new_status = "in"
+
+                if alarm_name in self.alarm_map:
+                    self.set_alarm_attr(alarm_name, "persist", is_persistent)
+                    self.set_alarm_attr(alarm_name, "lastInPayloadTs", ts)
+                    # it is not reasonable to create an nd marker every time when the same alarm
+                    # with the status "in" comes, but if there is also a value in parallel,
+                    # then an nd marker should be created
+                    if self.is_errors and new_status == "in" and has_value:
+                        is_nd_marker_needed = True
+                    if self.alarm_map[alarm_name]["st"] != new_status:
+                        self.set_alarm_status(alarm_name, new_status, ts)
+                        self.add_to_log(self.log_level, alarm_name, ts, self.instance, new_status)
+                        # also, an nd marker should be created when the alarm
+                        # emerges first time after being "out"
+                        if self.is_errors and new_status == "in":
+                            is_nd_marker_needed = True
+                else:
+                    self.alarm_map[alarm_name] = {
+                        "persist": is_persistent,
+                        "st": new_status,
+                        "lastInPayloadTs": ts,
+                        "lastTransTs": ts,  # an arguable question what to put here when "out"
+                    }
+                    self.alarm_idxs[alarm_name] = len(self.alarm_idxs)
+                    self.is_dirty = True
+                    if new_status == "in":  # if the first message has the status "out", then no sense in logging it
+                        self.in_alarm_names.add(alarm_name)
+                        self.add_to_log(self.log_level, alarm_name, ts, self.instance, "in")
+                        if self.is_errors:
+                            is_nd_marker_needed = True
+
+        if len(self.in_alarm_names) > 0:
+            for alarm_name in sorted(self.in_alarm_names, key=self.alarm_idxs.__getitem__):
+                ind_alarm_obj = self.alarm_map[alarm_name]
+                # if there is at least one datastream with a value and without an error,
+                # all persistent errors get discarded, otherwise, it acquires "out" in the upper part of the code
+                if ind_alarm_obj["persist"]:
+                    is_out = self.is_errors and ind_alarm_obj["lastInPayloadTs"] < ts and has_value
+                else:
+                    # non-persistent alarms acquire "out" when there is no such an alarm in 'alarm_dict'
+                    is_out = alarm_dict is None or alarm_dict.get(alarm_name) is None
+                if is_out:
+                    self.set_alarm_status(alarm_name, "out", ts)
+                    self.add_to_log(self.log_level, alarm_name, ts, self.instance, "out")
+
+        return is_nd_marker_needed
+
+    def save_to_instance(self) -> bool:
+        """Puts the updated map into the instance and marks it for saving, returns True if the map changed."""
+        if not self.is_dirty:
+            return False
+        setattr(self.instance, self.alarm_map_type, self.alarm_map)
+        self.instance.update_fields.add(self.alarm_map_type)
+        self.is_dirty = False
+        return True
+
+
 def update_alarm_map(
     instance: Device | Datastream | Application,
     alarm_dict: AlarmPayloadDictForTs | None,
@@ -66,97 +176,9 @@ def update_alarm_map(
     devices and datastreams. If "has_value" is True, then persistent errors (but not warnings) that have status "in"
     will be assigned status "out" if there is no record for this error for this timestamp.
     'add_to_log' is used to reflect alarm transitions in a certain log.
+    When a payload with many timestamps is processed, use 'AlarmMapEngine' directly to avoid copying the map
+    for every timestamp.
     """
-    alarm_map = getattr(instance, alarm_map_type)
-    log_level: Literal["ERROR", "WARNING"] = alarm_map_type[:-1].upper()
-    is_nd_marker_needed = False
-    upd_alarm_map = copy.deepcopy(alarm_map)
-    if alarm_dict is not None:
-        for alarm_name, ind_alarm_obj in alarm_dict.items():  # ind_alarm_obj can be {"st": "in"} or {}
-            if alarm_name in upd_alarm_map:
-                if isinstance(ind_alarm_obj, dict) and (
-                    (new_status := str(ind_alarm_obj.get("st")).lower()) == "in" or new_status == "out"
-                ):
-                    upd_alarm_map[alarm_name]["persist"] = True
-                    upd_alarm_map[alarm_name]["lastInPayloadTs"] = ts
-                    # it is not reasonable to create an nd marker every time
-                    # when the same persistent alarm with the status "in" comes
-                    # but if there is also a value in parallel, then an nd marker
-                    # should be created
-                    if alarm_map_type == "errors" and new_status == "in" and has_value:
-                        is_nd_marker_needed = True
-                    # print(f"Persistent alarm '{alarm_name}' comes again with st='{new_status}'")
-                    if upd_alarm_map[alarm_name]["st"] != new_status:
-                        upd_alarm_map[alarm_name]["st"] = new_status
-                        upd_alarm_map[alarm_name]["lastTransTs"] = ts
-                        add_to_log(log_level, alarm_name, ts, instance, new_status)
-                        # also, an nd marker should be created when the alarm
-                        # emerges first time after being "out"
-                        if alarm_map_type == "errors" and new_status == "in":
-                            is_nd_marker_needed = True
-                else:
-                    upd_alarm_map[alarm_name]["persist"] = False
-                    upd_alarm_map[alarm_name]["lastInPayloadTs"] = ts
-                    # it is not reasonable to create an nd marker every time
-                    # when the same non-persistent alarm comes
-                    # but if there is also a value in parallel, then an nd marker
-                    # should be created
-                    if alarm_map_type == "errors" and has_value:
-                        is_nd_marker_needed = True
-                    # print(f"NON-Persistent alarm '{alarm_name}' comes again with st='in'")
-                    if upd_alarm_map[alarm_name]["st"] != "in":
-                        upd_alarm_map[alarm_name]["st"] = "in"
-                        upd_alarm_map[alarm_name]["lastTransTs"] = ts
-                        add_to_log(log_level, alarm_name, ts, instance, "in")
-                        # also, an nd marker should be created when the alarm
-                        # emerges first time after being "out"
-                        if alarm_map_type == "errors":
-                            is_nd_marker_needed = True
-
-            else:
-                upd_alarm_map[alarm_name] = {}
-                if isinstance(ind_alarm_obj, dict) and (
-                    (new_status := str(ind_alarm_obj.get("st")).lower()) == "in" or new_status == "out"
-                ):
-                    upd_alarm_map[alarm_name]["persist"] = True
-                    upd_alarm_map[alarm_name]["st"] = new_status
-                    upd_alarm_map[alarm_name]["lastInPayloadTs"] = ts
-                    upd_alarm_map[alarm_name]["lastTransTs"] = ts  # an arguable question what to put here when "out"
-                    # print(f"Persistent alarm '{alarm_name}' comes FIRST TIME with st='{new_status}'")
-                    if new_status == "in":  # if the first message has the status "out", then no sense in logging it
-                        add_to_log(log_level, alarm_name, ts, instance, "in")
-                        if alarm_map_type == "errors":
-                            is_nd_marker_needed = True
-                else:
-                    upd_alarm_map[alarm_name]["persist"] = False
-                    upd_alarm_map[alarm_name]["st"] = "in"
-                    upd_alarm_map[alarm_name]["lastInPayloadTs"] = ts
-                    upd_alarm_map[alarm_name]["lastTransTs"] = ts
-                    # print(f"NON-Persistent alarm '{alarm_name}' comes FIRST TIME with st='in'")
-                    add_to_log(log_level, alarm_name, ts, instance, "in")
-                    if alarm_map_type == "errors":
-                        is_nd_marker_needed = True
-
-    for alarm_name, ind_alarm_obj in upd_alarm_map.items():
-        # if there is at least one datastream with a value and without an error,
-        # all persistent errors get discarded, otherwise, it acquires "out" in the upper part of the code
-        if ind_alarm_obj["persist"]:
-            if (
-                alarm_map_type == "errors"
-                and ind_alarm_obj["st"] == "in"
-                and ind_alarm_obj["lastInPayloadTs"] < ts
-                and has_value
-            ):
-                ind_alarm_obj["st"] = "out"
-                ind_alarm_obj["lastTransTs"] = ts
-                # print(f"Persistent alarm '{alarm_name}' st='out' because at least one ds has readings and no errors")
-                add_to_log(log_level, alarm_name, ts, instance, "out")
-        else:
-            # non-persisten alarms acquire "out" when there is no such an alarm in 'alarm_dict_for_ts'
-            if ind_alarm_obj["st"] == "in" and (alarm_dict is None or alarm_dict.get(alarm_name) is None):
-                ind_alarm_obj["st"] = "out"
-                ind_alarm_obj["lastTransTs"] = ts
-                # print(f"NON-Persistent alarm '{alarm_name}' st='out' because no fresh alarm incoming readings")
-                add_to_log(log_level, alarm_name, ts, instance, "out")
-
-    return upd_alarm_map, is_nd_marker_needed
+    engine = AlarmMapEngine(instance, alarm_map_type, add_to_log)
+    is_nd_marker_needed = engine.apply(alarm_dict, ts, has_value)
+    return engine.alarm_map, is_nd_marker_needed
@@ -1,6 +1,7 @@
 import logging
+import numpy as np
 from scipy.interpolate import PchipInterpolator
-from typing import Callable, List
+from typing import List
 
 from apps.datastreams.models import Datastream
 from apps.datafeeds.models import Datafeed
@@ -9,21 +10,28 @@ from apps.dfreadings.models import DfReading
 
 from common.complex_types import IndDfReadingMap
 from common.constants import DataAggrTypes, NotToUseDfrTypes, VariableTypes, AugmentationPolicy
-from utils.ts_utils import ceil_timestamp, create_grid, create_now_ts_ms
+from utils.dsr_utils import DsValues, fetch_nodata_marker_tss
+from utils.ts_utils import ceil_timestamp, count_grid_points, create_grid, create_now_ts_ms
 from utils.alarm_utils import add_to_alarm_log
 
 logger = logging.getLogger("#dfr_utils")
 
+NUM_PREV_DF_READINGS = 3  # df readings 'from the past' for the restoration
+
 
 def create_df_readings(
-    ds_readings: list[DsReading],
+    ds_values: DsValues,
     nat_df: Datafeed,
     start_rts: int,
+    nd_tss: np.ndarray | None = None,
+    prev_df_readings: list[DfReading] | None = None,
 ) -> tuple[List[DfReading], int | None, int]:
     """
     Creates datafeed readings from a set of datastream readings.
-    The variable 'ds_readings' should represent readings whose timestamps
+    The variable 'ds_values' should represent readings whose timestamps
     are > 'start_rts' ('rts' means a 'rounded timestamp').
+    'nd_tss' - sorted timestamps of the nodata markers > 'start_rts', they are taken from the db if None.
+    'prev_df_readings' - see 'get_prev_df_readings', they are taken from the db if None.
     Returns:
     'df_readings' - a list of created df readings.
     'last_dfr_rts' - a timestamp of a very last df reading created by a resample function (usually not saved).
@@ -43,50 +51,54 @@ def create_df_readings(
         )
         return default_tuple
     time_resample = nat_df.time_resample
+    tss, values = ds_values.tss, get_values_to_resample(ds_values, ds)
+    last_bucket_rts = None  # for the augmented df readings
 
     if ds.data_type.var_type == VariableTypes.CONTINUOUS and ds.data_type.agg_type == DataAggrTypes.AVG:
         # temperature, pressure etc
-        if len(ds_readings) == 0:
+        if len(tss) == 0:
             return default_tuple
-        df_reading_map = resample_ds_readings(ds_readings, nat_df, time_resample, find_average)
+        df_reading_map = resample_ds_readings(tss, values, nat_df, time_resample, DataAggrTypes.AVG)
         if nat_df.is_rest_on:
             if ds.time_change is None:
                 raise ValueError("time_change cannot be None for CONTINUOUS/AVG if restoration is on")
-            df_reading_map = restore_continuous_avg(df_reading_map, nat_df, time_resample, ds.time_change, start_rts)
+            df_reading_map = restore_continuous_avg(
+                df_reading_map, nat_df, time_resample, ds.time_change, start_rts, prev_df_readings
+            )
 
     elif (
         ds.data_type.var_type == VariableTypes.CONTINUOUS or ds.data_type.var_type == VariableTypes.DISCRETE
     ) and ds.data_type.agg_type == DataAggrTypes.SUM:
-        if len(ds_readings) == 0 and (not nat_df.is_aug_on or nat_df.aug_policy != AugmentationPolicy.TILL_NOW):
+        if len(tss) == 0 and (not nat_df.is_aug_on or nat_df.aug_policy != AugmentationPolicy.TILL_NOW):
             return default_tuple
         if not ds.is_totalizer:
             if ds.is_rbe and nat_df.is_aug_on:
-                df_reading_map = resample_and_augment_ds_readings(
-                    ds_readings, nat_df, ds, time_resample, start_rts, find_sum
+                df_reading_map, last_bucket_rts = resample_and_augment_ds_readings(
+                    tss, values, nd_tss, nat_df, ds, time_resample, start_rts, DataAggrTypes.SUM
                 )
             else:
-                df_reading_map = resample_ds_readings(ds_readings, nat_df, time_resample, find_sum)
+                df_reading_map = resample_ds_readings(tss, values, nat_df, time_resample, DataAggrTypes.SUM)
         else:
             if ds.is_rbe and nat_df.is_aug_on:
-                df_reading_map = resample_and_augment_ds_readings(
-                    ds_readings, nat_df, ds, time_resample, start_rts, find_last_value
+                df_reading_map, last_bucket_rts = resample_and_augment_ds_readings(
+                    tss, values, nd_tss, nat_df, ds, time_resample, start_rts, DataAggrTypes.LAST
                 )
             else:
-                df_reading_map = resample_ds_readings(ds_readings, nat_df, time_resample, find_last_value)
+                df_reading_map = resample_ds_readings(tss, values, nat_df, time_resample, DataAggrTypes.LAST)
                 if nat_df.is_rest_on:
                     if ds.time_change is None:
                         raise ValueError("time_change cannot be None for CONTINUOUS/AVG if restoration is on")
                     df_reading_map = restore_totalizer(df_reading_map, nat_df, time_resample, ds.time_change, start_rts)
 
     elif ds.data_type.agg_type == DataAggrTypes.LAST:  # for all var_types
-        if len(ds_readings) == 0 and (not nat_df.is_aug_on or nat_df.aug_policy != AugmentationPolicy.TILL_NOW):
+        if len(tss) == 0 and (not nat_df.is_aug_on or nat_df.aug_policy != AugmentationPolicy.TILL_NOW):
             return default_tuple
         if ds.is_rbe and nat_df.is_aug_on:
-            df_reading_map = resample_and_augment_ds_readings(
-                ds_readings, nat_df, ds, time_resample, start_rts, find_last_value
+            df_reading_map, last_bucket_rts = resample_and_augment_ds_readings(
+                tss, values, nd_tss, nat_df, ds, time_resample, start_rts, DataAggrTypes.LAST
             )
         else:
-            df_reading_map = resample_ds_readings(ds_readings, nat_df, time_resample, find_last_value)
+            df_reading_map = resample_ds_readings(tss, values, nat_df, time_resample, DataAggrTypes.LAST)
 
     else:
         raise ValueError(
@@ -114,113 +126,119 @@ def create_df_readings(
         df_readings.append(df_reading_map[rts])
         rts_to_start_with_next_time = rts
 
-    if len(df_reading_rtss) > 0:  # almost impossible that len(df_reading_rtss) == 0 if we got to this point
+    if last_bucket_rts is not None:  # can be beyond the augmentation grid
+        last_dfr_rts = last_bucket_rts
+    elif len(df_reading_rtss) > 0:  # almost impossible that len(df_reading_rtss) == 0 if we got to this point
         last_dfr_rts = max(df_reading_rtss)  # it is the ts of the last (unclosed) df reading
 
     return df_readings, last_dfr_rts, rts_to_start_with_next_time
 
 
-def find_average(ds_readings: list[DsReading]) -> float | None:
-
-    if len(ds_readings) == 0:
-        return None
-    sum = 0
-    length = len(ds_readings)
-    for r in ds_readings:
-        sum += r.value
-    avgd_value = sum / length
-    return avgd_value
-
+def get_values_to_resample(ds_values: DsValues, ds: Datastream) -> np.ndarray:
+    """
+    The values ('db_value') truncated for integer datastreams, as the 'value' property of a ds reading does.
+    """
+    if ds.is_value_interger:
+        return np.trunc(ds_values.values)
+    return ds_values.values
 
-def find_sum(ds_readings: list[DsReading]) -> float | int | None:
 
-    if len(ds_readings) == 0:
-        return None
-    sum = 0
-    for r in ds_readings:
-        sum += r.value
-    return sum
+def sum_groups_in_order(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Sums the groups of values [starts[i], ends[i]) adding the values one by one in their order,
+    so the sums of floats are the same as the ones of a sequential sum (unlike 'np.add.reduceat').
+    The k-th values of all the groups are added at once, the number of steps is the size of the biggest group.
+    """
+    sums = np.zeros(len(starts), dtype=np.float64)
+    sizes = ends - starts
+    for k in range(int(sizes.max(initial=0))):
+        group_idxs = np.flatnonzero(sizes > k)
+        sums[group_idxs] += values[starts[group_idxs] + k]
+    return sums
 
 
-def find_last_value(ds_readings: list[DsReading]) -> float | int | None:
+def aggregate_by_rts(
+    tss: np.ndarray, values: np.ndarray, time_resample: int, agg_type: DataAggrTypes
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Groups the values by rounded (ceiled) timestamps and aggregates every group.
+    'tss' should not be empty.
+    Returns the rtss, the aggregated values and the timestamps of the last values of the groups, sorted by rts.
+    """
+    order = np.argsort(tss, kind="stable")
+    tss = tss[order]
+    values = values[order]
+    rtss = -(-tss // time_resample) * time_resample
+
+    is_first = np.empty(len(rtss), dtype=bool)
+    is_first[0] = True
+    np.not_equal(rtss[1:], rtss[:-1], out=is_first[1:])
+    starts = np.flatnonzero(is_first)
+    ends = np.append(starts[1:], len(rtss))  # not included
+
+    if agg_type == DataAggrTypes.AVG:
+        agg_values = sum_groups_in_order(values, starts, ends) / (ends - starts)
+    elif agg_type == DataAggrTypes.SUM:
+        agg_values = sum_groups_in_order(values, starts, ends)
+    elif agg_type == DataAggrTypes.LAST:
+        agg_values = values[ends - 1]
+    else:
+        raise ValueError(f"Unknown aggregation type {agg_type}")
 
-    if len(ds_readings) == 0:
-        return None
-    ds_readings.sort(key=lambda r: r.time)
-    last_value = ds_readings[-1].value
-    return last_value
+    return rtss[starts], agg_values, tss[ends - 1]
 
 
 def resample_ds_readings(
-    ds_readings: list[DsReading], df: Datafeed, time_resample: int, agg_func: Callable[[list[DsReading]], float | None]
+    tss: np.ndarray, values: np.ndarray, df: Datafeed, time_resample: int, agg_type: DataAggrTypes
 ) -> IndDfReadingMap:
     """
-    A generic function, can be used with different aggregation functions.
+    A generic function, can be used with different aggregation types.
     """
 
-    sorted_ds_readings = sorted(ds_readings, key=lambda x: x.time)
-    df_reading_map = {}
-
-    last_df_reading_rts = 0
-    for r in sorted_ds_readings:
-        rts = ceil_timestamp(r.time, time_resample)
-        if rts not in df_reading_map:
-            df_reading_map[rts] = []
-
-        df_reading_map[rts].append(r)
-        last_df_reading_rts = rts
+    if len(tss) == 0:
+        return {}
 
-    for rts in df_reading_map:
-        agg_value = agg_func(df_reading_map[rts])
-        if agg_value is not None:
-            dfr = DfReading(time=rts, value=agg_value, datafeed=df, restored=False)
-            df_reading_map[rts] = dfr
-            # injection of 'not_to_use' property
-            if rts == last_df_reading_rts:
-                dfr.not_to_use = NotToUseDfrTypes.UNCLOSED
+    rtss, agg_values, _ = aggregate_by_rts(tss, values, time_resample, agg_type)
+    df_reading_map = {
+        rts: DfReading(time=rts, value=value, datafeed=df, restored=False)
+        for rts, value in zip(rtss.tolist(), agg_values.tolist())
+    }
+    # injection of 'not_to_use' property
+    df_reading_map[int(rtss[-1])].not_to_use = NotToUseDfrTypes.UNCLOSED
 
     return df_reading_map
 
 
 def resample_and_augment_ds_readings(
-    ds_readings: list[DsReading],
+    tss: np.ndarray,
+    values: np.ndarray,
+    nd_tss: np.ndarray | None,
     df: Datafeed,
     ds: Datastream,
     time_resample: int,
     start_rts: int,
-    agg_func: Callable[[list[DsReading]], float | int | None],
-) -> IndDfReadingMap:
+    agg_type: DataAggrTypes,
+) -> tuple[IndDfReadingMap, int | None]:
     """
     Assumes that 'df.is_aug_on' is True
-    Timestamps of the instances in 'ds_readings' should be > 'start_rts'
+    Timestamps in 'tss' and 'nd_tss' (of nodata markers, taken from the db if None) should be > 'start_rts'
+    The readings are resampled on the grid after 'start_rts', the empty grid points are augmented
+    (SUM: 0, LAST: the previous value) unless the last item before them is a nodata marker
+    (a marker with the same timestamp as a reading is after the reading).
+    Returns the df readings and the rts of the last bucket. Buckets of readings and markers beyond
+    the end of the grid don't get df readings but count here, they mean that there is more data ahead.
     """
 
-    if len(ds_readings) == 0 and df.aug_policy != AugmentationPolicy.TILL_NOW:
-        return {}
-
-    df_reading_map = {}
-
-    nodata_markers = list(NoDataMarker.objects.filter(datastream__id=ds.pk, time__gt=start_rts).order_by("time"))
-
-    # as the sort provided by 'sorted' is stable,
-    # then if both DsReading and NoDataMarker instances have the same timestamps,
-    # then the NoDataMarker instance will be the last after the sorting
-    sorted_ds_readings_and_nodata_markers = sorted(ds_readings + nodata_markers, key=lambda x: x.time)
+    if len(tss) == 0 and df.aug_policy != AugmentationPolicy.TILL_NOW:
+        return {}, None
 
-    last_df_reading_rts = None  # it may happen that there are no ds readings in 'ds_readings'
-    for r in sorted_ds_readings_and_nodata_markers:
-        rts = ceil_timestamp(r.time, time_resample)
-        if rts not in df_reading_map:
-            df_reading_map[rts] = []
+    if nd_tss is None:
+        nd_tss = fetch_nodata_marker_tss(ds.pk, start_rts)
 
-        df_reading_map[rts].append(r)
-        if isinstance(r, DsReading):
-            last_df_reading_rts = rts
-
-    last_dfr_from_prev_period = DfReading.objects.filter(datafeed__id=df.pk, time=start_rts).order_by("time").first()
-    # add this dfr temporarily, it will be removed at the end of the function
-    if last_dfr_from_prev_period is not None:
-        df_reading_map[start_rts] = last_dfr_from_prev_period
+    # the dfr taken from the previous period is not returned, it is only the base for augmentation
+    start_dfr = DfReading.objects.filter(datafeed__id=df.pk, time=start_rts).order_by("time").first()
+    if start_dfr is not None:
+        start_dfr.datafeed = df  # 'value' needs it
 
     else:  # for SUM + TILL_NOW it is necessary to check if there is a NoDataMarker at the last position
         if ds.data_type.agg_type == DataAggrTypes.SUM and df.aug_policy == AugmentationPolicy.TILL_NOW:
@@ -234,68 +252,106 @@ def resample_and_augment_ds_readings(
                 last_dsr_before_start_rts is not None
                 and last_dsr_before_start_rts.time > last_ndm_before_start_rts.time
             ):
-                # temporarily add this point
-                df_reading_map[start_rts] = DfReading(time=start_rts, value=0, datafeed=df, restored=True)
+                start_dfr = DfReading(time=start_rts, value=0, datafeed=df, restored=True)
 
     # create a grid according to the augmentation policy
     if df.aug_policy == AugmentationPolicy.TILL_LAST_DF_READING:
-        if last_df_reading_rts is None:  # impossible to have it None at this point, just for the linter
-            return {}
-        end_rts_acc_to_aug_policy = last_df_reading_rts
+        end_rts_acc_to_aug_policy = ceil_timestamp(int(tss.max()), time_resample)
     elif df.aug_policy == AugmentationPolicy.TILL_NOW:
-        end_rts_acc_to_aug_policy = ceil_timestamp(create_now_ts_ms() - ds.till_now_margin, time_resample)
+        # not past the watermark of late readings
+        margin = max(ds.till_now_margin, ds.reorder_window)
+        end_rts_acc_to_aug_policy = ceil_timestamp(create_now_ts_ms() - margin, time_resample)
     else:
         raise ValueError("Wrong augmentation policy")
 
-    grid = create_grid(start_rts + time_resample, end_rts_acc_to_aug_policy, time_resample)
+    # grid point 'idx' is 'start_rts + (idx + 1) * time_resample'
+    num_points = count_grid_points(start_rts + time_resample, end_rts_acc_to_aug_policy, time_resample)
+    idxs = np.arange(num_points)
+    beyond_grid_rtss = []
+
+    has_reading = np.zeros(num_points, dtype=bool)
+    reading_values = np.zeros(num_points)
+    last_reading_tss = np.full(num_points, np.iinfo(np.int64).min)
+    if len(tss) > 0:
+        rtss, agg_values, last_tss = aggregate_by_rts(tss, values, time_resample, agg_type)
+        point_idxs = (rtss - start_rts) // time_resample - 1
+        in_grid = point_idxs < num_points
+        has_reading[point_idxs[in_grid]] = True
+        reading_values[point_idxs[in_grid]] = agg_values[in_grid]
+        last_reading_tss[point_idxs[in_grid]] = last_tss[in_grid]
+        beyond_grid_rtss.extend(rtss[~in_grid].tolist())
+
+    has_marker = np.zeros(num_points, dtype=bool)
+    last_marker_tss = np.zeros(num_points, dtype=np.int64)
+    if len(nd_tss) > 0:
+        nd_rtss, _, last_nd_tss = aggregate_by_rts(nd_tss, np.zeros(len(nd_tss)), time_resample, DataAggrTypes.LAST)
+        point_idxs = (nd_rtss - start_rts) // time_resample - 1
+        in_grid = point_idxs < num_points
+        has_marker[point_idxs[in_grid]] = True
+        last_marker_tss[point_idxs[in_grid]] = last_nd_tss[in_grid]
+        beyond_grid_rtss.extend(nd_rtss[~in_grid].tolist())
+
+    # a nodata period starts at a point where a marker is the last item and lasts till the next reading
+    has_items = has_reading | has_marker
+    is_marker_last = has_marker & (last_marker_tss >= last_reading_tss)
+    last_item_idxs = np.maximum.accumulate(np.where(has_items, idxs, -1))
+    is_nodata_period = np.where(last_item_idxs >= 0, is_marker_last[last_item_idxs], start_dfr is None)
+    is_augmented = ~has_items & ~is_nodata_period
+
+    if is_augmented.any() and ds.data_type.agg_type not in (DataAggrTypes.SUM, DataAggrTypes.LAST):
+        raise ValueError(f"Unknown augmentation type for {ds.data_type.agg_type}")
+    # for LAST the augmented points repeat the last point with a reading (or 'start_dfr')
+    source_idxs = np.maximum.accumulate(np.where(has_reading, idxs, -1))
 
-    last_df_reading_rts = None
-    is_nodata_period = df_reading_map.get(start_rts, None) is None
+    df_reading_map = {}
+    dfr_idxs = np.flatnonzero(has_reading | is_augmented)
+    for idx, is_restored, value, source_idx in zip(
+        dfr_idxs.tolist(),
+        is_augmented[dfr_idxs].tolist(),
+        reading_values[dfr_idxs].tolist(),
+        source_idxs[dfr_idxs].tolist(),
+    ):
+        rts = start_rts + (idx + 1) * time_resample
+        if is_restored:
+            if ds.data_type.agg_type == DataAggrTypes.SUM:
+                value = 0
+            else:
+                source_rts = start_rts + (source_idx + 1) * time_resample
+                value = (start_dfr if source_idx < 0 else df_reading_map[source_rts]).value
+        df_reading_map[rts] = DfReading(time=rts, value=value, datafeed=df, restored=is_restored)
 
-    for rts in grid:
-        arr = df_reading_map.get(rts, None)  # 'arr' is already sorted by time
-        if arr is not None:
-            new_arr = [r for r in arr if isinstance(r, DsReading)]
-            agg_value = agg_func(new_arr)  # if 'new_arr' is empty, 'agg_func' will return None
+    # injection of 'not_to_use' property
+    if len(dfr_idxs) > 0:
+        last_df_reading_rts = start_rts + (int(dfr_idxs[-1]) + 1) * time_resample
+        df_reading_map[last_df_reading_rts].not_to_use = NotToUseDfrTypes.UNCLOSED
+        beyond_grid_rtss.append(last_df_reading_rts)
 
-            if agg_value is not None:
-                is_nodata_period = False
-                dfr = DfReading(time=rts, value=agg_value, datafeed=df, restored=False)
-                df_reading_map[rts] = dfr
-                last_df_reading_rts = rts
-            else:  # only nodata marker in 'arr'
-                del df_reading_map[rts]
+    return df_reading_map, max(beyond_grid_rtss, default=None)
 
-            if isinstance(arr[-1], NoDataMarker):  # if the last item in 'arr' is NoDataMarker
-                is_nodata_period = True
-        else:
-            if not is_nodata_period:
-                prev_dfr = df_reading_map.get(rts - time_resample, None)
-                if prev_dfr is not None:
-                    if ds.data_type.agg_type == DataAggrTypes.SUM:
-                        dfr = DfReading(time=rts, value=0, datafeed=df, restored=True)
-                    elif ds.data_type.agg_type == DataAggrTypes.LAST:
-                        dfr = DfReading(time=rts, value=prev_dfr.value, datafeed=df, restored=True)
-                    else:
-                        raise ValueError(f"Unknown augmentation type for {ds.data_type.agg_type}")
-                    df_reading_map[rts] = dfr
-                    last_df_reading_rts = rts
-
-    # removing the dfr taken from the previous period
-    if df_reading_map.get(start_rts, None) is not None:
-        del df_reading_map[start_rts]
 
-    # injection of 'not_to_use' property
-    if last_df_reading_rts is not None:
-        # if not df_reading_map[last_df_reading_rts].restored:
-        df_reading_map[last_df_reading_rts].not_to_use = NotToUseDfrTypes.UNCLOSED
+def uses_prev_df_readings(df: Datafeed, ds: Datastream) -> bool:
+    """If the df readings 'from the past' are used for the restoration ('restore_continuous_avg')."""
+    is_continuous_avg = (
+        ds.data_type.var_type == VariableTypes.CONTINUOUS and ds.data_type.agg_type == DataAggrTypes.AVG
+    )
+    return is_continuous_avg and df.is_rest_on
 
-    return df_reading_map
+
+def get_prev_df_readings(df: Datafeed, start_rts: int) -> list[DfReading]:
+    """The last native df readings up to 'start_rts' (included), sorted by time."""
+    # Django doesn't allow negative indexes in slicing, that's why '-time' and then 'reversed'
+    qs = DfReading.objects.filter(datafeed__id=df.pk, time__lte=start_rts, restored=False).order_by("-time")
+    return list(reversed(qs[:NUM_PREV_DF_READINGS]))
 
 
 # For 'continuous + AVG' datastreams
 def restore_continuous_avg(
-    df_reading_map: IndDfReadingMap, df: Datafeed, time_resample: int, time_change: int, start_rts: int
+    df_reading_map: IndDfReadingMap,
+    df: Datafeed,
+    time_resample: int,
+    time_change: int,
+    start_rts: int,
+    prev_df_readings: list[DfReading] | None = None,
 ) -> IndDfReadingMap:
 
     sorted_df_readings = sorted(df_reading_map.values(), key=lambda x: x.time)
@@ -304,11 +360,9 @@ def restore_continuous_avg(
         dfr.not_to_use = None
 
     # get some readings 'from the past' to have enough readings for interpolation
-    last_df_readings_from_prev_period = DfReading.objects.filter(
-        datafeed__id=df.pk, time__lte=start_rts, restored=False
-    ).order_by("-time")[:3]  # Django doesn't allow negative indexes in slicing
-    # that's why we use '-time' and then 'reversed'
-    last_df_readings_from_prev_period = list(reversed(last_df_readings_from_prev_period))
+    if prev_df_readings is None:
+        prev_df_readings = get_prev_df_readings(df, start_rts)
+    last_df_readings_from_prev_period = prev_df_readings
 
     # add some readings 'from the past' to have enough readings for interpolation
     next_rts = sorted_df_readings[0].time
@@ -1,40 +1,97 @@
 import logging
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+from itertools import repeat
+
+import numpy as np
+from django.conf import settings
+from django.db.models import QuerySet
 
 from apps.datastreams.models import Datastream
-from apps.dsreadings.models import (
-    DsReading,
-    UnusedDsReading,
-    InvalidDsReading,
-    NonRocDsReading,
-    NoDataMarker,
-    UnusedNoDataMarker,
-)
+from apps.dsreadings.models import DsReading, NoDataMarker, UnusedNoDataMarker
 from common.constants import DataAggrTypes, VariableTypes
 
 logger = logging.getLogger("#dsr_utils")
 
 
-def create_ds_readings(
-    pairs_ts_value: dict[int, float | int], ds: Datastream, now: int
-) -> tuple[list[DsReading], list[UnusedDsReading], list[InvalidDsReading], list[NonRocDsReading]]:
+class DsValues:
+    """Readings of one datastream in columns, 'tss' are sorted."""
+
+    __slots__ = ("tss", "values")
+
+    def __init__(self, tss: np.ndarray, values: np.ndarray):
+        self.tss = tss  # int64
+        self.values = values  # float64, the values as they are saved ('db_value')
+
+    def __len__(self):
+        return len(self.tss)
+
+    def select(self, mask_or_idxs) -> "DsValues":
+        return DsValues(self.tss[mask_or_idxs], self.values[mask_or_idxs])
+
+    def append(self, other: "DsValues") -> "DsValues":
+        """'other' should be after these readings."""
+        return DsValues(np.concatenate((self.tss, other.tss)), np.concatenate((self.values, other.values)))
+
+    def rows(self, ds_pk: int) -> Iterator[tuple[int, int, float]]:
+        """Rows for 'write_rows' with the fields 'DS_READING_FIELDS'."""
+        return zip(self.tss.tolist(), repeat(ds_pk), self.values.tolist())
+
+
+DS_READING_FIELDS = ("time", "datastream_id", "db_value")
+DS_VALUE_DTYPE = np.dtype([("time", np.int64), ("db_value", np.float64)])
+
+
+def fetch_ds_values(
+    ds_reading_qs: QuerySet, limit: int, chunk_size: int = settings.DSREADINGS_FETCH_CHUNK_SIZE
+) -> DsValues:
+    """
+    Streams the first 'limit' readings of 'ds_reading_qs' (by time) into columns,
+    no model instances are created. The rows are read in chunks of 'chunk_size'.
+    """
+    rows = ds_reading_qs.order_by("time").values_list("time", "db_value")[:limit].iterator(chunk_size=chunk_size)
+    records = np.fromiter(rows, dtype=DS_VALUE_DTYPE)
+    return DsValues(np.ascontiguousarray(records["time"]), np.ascontiguousarray(records["db_value"]))
+
+
+def fetch_nodata_marker_tss(ds_pk: int, start_ts: int) -> np.ndarray:
+    """Sorted timestamps of the nodata markers of a datastream after 'start_ts'."""
+    tss = NoDataMarker.objects.filter(datastream__id=ds_pk, time__gt=start_ts).order_by("time")
+    return np.fromiter(tss.values_list("time", flat=True), dtype=np.int64)
+
 
-    ds_readings, unused_ds_readings = sort_unused_ds_readings(pairs_ts_value, ds, now)
-    ds_readings, invalid_ds_readings = validate_ds_readings(ds_readings, ds)
-    non_roc_ds_readings = []
+def create_ds_values(
+    pairs_ts_value: dict[int, float | int], ds: Datastream, now: int
+) -> tuple[DsValues, DsValues, DsValues, DsValues]:
+    """
+    Classifies the values of a datastream without creating model instances.
+    Returns (used, unused, invalid, non_roc) readings as 'DsValues', they are
+    turned into rows or instances only when saved.
+    """
+    num_values = len(pairs_ts_value)
+    tss = np.fromiter(pairs_ts_value.keys(), dtype=np.int64, count=num_values)
+    values = np.fromiter(pairs_ts_value.values(), dtype=np.float64, count=num_values)
+    if num_values > 1 and np.any(tss[1:] < tss[:-1]):
+        order = np.argsort(tss, kind="stable")
+        tss, values = tss[order], values[order]
+    if ds.is_value_interger:
+        values = np.round(values)  # the same as the 'value' setter does (the halves are rounded to even)
+
+    ds_values, unused_ds_values = sort_unused_ds_values(DsValues(tss, values), ds, now)
+    ds_values, invalid_ds_values = validate_ds_values(ds_values, ds)
+    non_roc_ds_values = ds_values.select(slice(0))
     if ds.data_type.agg_type == DataAggrTypes.AVG and ds.data_type.var_type == VariableTypes.CONTINUOUS:
-        ds_readings, non_roc_ds_readings = roc_filter_ds_readings(ds_readings, ds)
+        ds_values, non_roc_ds_values = roc_filter_ds_values(ds_values, ds)
 
-    if len(ds_readings) > 0:
-        logger.debug(f"Created {len(ds_readings)} ds_readings")
-    if len(unused_ds_readings) > 0:
-        logger.debug(f"Created {len(unused_ds_readings)} unused ds_readings")
-    if len(invalid_ds_readings) > 0:
-        logger.debug(f"Created {len(invalid_ds_readings)} invalid ds_readings")
-    if len(non_roc_ds_readings) > 0:
-        logger.debug(f"Created {len(non_roc_ds_readings)} non_roc ds_readings")
+    if len(ds_values) > 0:
+        logger.debug(f"Created {len(ds_values)} ds_readings")
+    if len(unused_ds_values) > 0:
+        logger.debug(f"Created {len(unused_ds_values)} unused ds_readings")
+    if len(invalid_ds_values) > 0:
+        logger.debug(f"Created {len(invalid_ds_values)} invalid ds_readings")
+    if len(non_roc_ds_values) > 0:
+        logger.debug(f"Created {len(non_roc_ds_values)} non_roc ds_readings")
 
-    return ds_readings, unused_ds_readings, invalid_ds_readings, non_roc_ds_readings
+    return ds_values, unused_ds_values, invalid_ds_values, non_roc_ds_values
 
 
 def create_nodata_markers(
@@ -60,75 +117,57 @@ def create_nodata_markers(
     return nd_markers, unused_nd_markers
 
 
-def sort_unused_ds_readings(
-    pairs_ts_value: dict[int, float | int], ds: Datastream, now: int
-) -> tuple[list[DsReading], list[UnusedDsReading]]:
-
-    from_ts = ds.ts_to_start_with
-
-    used_ds_readings = []
-    unused_ds_readings = []
-
-    for ts, val in pairs_ts_value.items():
-        if ts > from_ts and ts < now:
-            dsr = DsReading(time=ts, value=val, datastream=ds)
-            used_ds_readings.append(dsr)
-        else:
-            dsr = UnusedDsReading(time=ts, value=val, datastream=ds)
-            unused_ds_readings.append(dsr)
-
-    return used_ds_readings, unused_ds_readings
+def sort_unused_ds_values(ds_values: DsValues, ds: Datastream, now: int) -> tuple[DsValues, DsValues]:
+    is_used = (ds_values.tss > ds.ts_to_start_with) & (ds_values.tss < now)
+    return ds_values.select(is_used), ds_values.select(~is_used)
 
 
-def validate_ds_readings(
-    ds_readings: list[DsReading], ds: Datastream
-) -> tuple[list[DsReading], list[InvalidDsReading]]:
-
-    valid_ds_readings = []
-    invalid_ds_readings = []
-    for r in ds_readings:
-        if r.value <= ds.max_plausible_value and r.value >= ds.min_plausible_value:
-            valid_ds_readings.append(r)
-        else:
-            ir = InvalidDsReading(time=r.time, value=r.value, datastream=r.datastream)
-            invalid_ds_readings.append(ir)
+def validate_ds_values(ds_values: DsValues, ds: Datastream) -> tuple[DsValues, DsValues]:
+    values = ds_values.values
+    is_valid = (values <= ds.max_plausible_value) & (values >= ds.min_plausible_value)  # False for NaN
+    return ds_values.select(is_valid), ds_values.select(~is_valid)
 
-    return valid_ds_readings, invalid_ds_readings
 
+def roc_filter_ds_values(ds_values: DsValues, ds: Datastream) -> tuple[DsValues, DsValues]:
+    """The values that change faster than 'max_rate_of_change' are limited, the original ones are non-ROC."""
+    tss, values = ds_values.tss, ds_values.values
+    if len(tss) == 0:
+        return ds_values, ds_values
 
-def roc_filter_ds_readings(
-    ds_readings: list[DsReading], ds: Datastream
-) -> tuple[list[DsReading], list[NonRocDsReading]]:
-
-    sorted_ds_readings = sorted(ds_readings, key=lambda r: r.time)
-
-    proc_ds_readings = []
-    non_proc_ds_readings = []
-    if len(sorted_ds_readings) > 0:
+    first_ts = int(tss[0])
+    if ds.last_reading_value is not None and ds.last_reading_ts is not None and first_ts > ds.last_reading_ts:
+        # the last saved reading is the base point, no need to look for it in the db
+        prev_filt_val = ds.last_reading_value
+        prev_filt_ts = ds.last_reading_ts
+    else:
+        # out-of-order readings or the last reading is unknown
         base_point = (
-            DsReading.objects.filter(datastream__id=ds.pk, time__lt=sorted_ds_readings[0].time).order_by("time").last()
+            DsReading.objects.filter(datastream__id=ds.pk, time__lt=first_ts)
+            .order_by("-time")
+            .values_list("time", "db_value")
+            .first()
         )
-
         if base_point is None:
-            prev_filt_val = sorted_ds_readings[0].value
-            prev_filt_ts = sorted_ds_readings[0].time
+            prev_filt_ts, prev_filt_val = first_ts, float(values[0])
         else:
-            prev_filt_val = base_point.value
-            prev_filt_ts = base_point.time
-
-        for r in sorted_ds_readings:
-            sign = 1
-            if r.value - prev_filt_val < 0:
-                sign = -1
-            limit_value = prev_filt_val + sign * ds.max_rate_of_change * (r.time - prev_filt_ts) / 1000
-            if (sign > 0 and limit_value < r.value) or (sign < 0 and limit_value > r.value):
-                npr = NonRocDsReading(time=r.time, value=r.value, datastream=r.datastream)
-                non_proc_ds_readings.append(npr)
-                # then change the value in the initial ds reading
-                r.value = limit_value
-            proc_ds_readings.append(r)
-
-            prev_filt_val = r.value
-            prev_filt_ts = r.time
-
-    return proc_ds_readings, non_proc_ds_readings
+            prev_filt_ts, prev_filt_val = base_point
+
+    # the filter is sequential (every value depends on the previous filtered one),
+    # so it goes over plain lists, the expressions are the same as they always were to get the same floats
+    max_rate_of_change = ds.max_rate_of_change
+    filt_values = values.tolist()
+    non_roc_idxs = []
+    for idx, (ts, value) in enumerate(zip(tss.tolist(), filt_values)):
+        sign = 1
+        if value - prev_filt_val < 0:
+            sign = -1
+        limit_value = prev_filt_val + sign * max_rate_of_change * (ts - prev_filt_ts) / 1000
+        if (sign > 0 and limit_value < value) or (sign < 0 and limit_value > value):
+            non_roc_idxs.append(idx)
+            filt_values[idx] = value = limit_value
+        prev_filt_val = value
+        prev_filt_ts = ts
+
+    if len(non_roc_idxs) == 0:
+        return ds_values, ds_values.select(slice(0))
+    return DsValues(tss, np.array(filt_values)), ds_values.select(non_roc_idxs)
@@ -0,0 +1,44 @@
+from collections.abc import Iterable
+
+
+def get_int_tss(dev_payload: dict) -> list[int]:
+    tss = []
+    for k in dev_payload:
+        try:
+            tss.append(int(k))
+        except (TypeError, ValueError):
+            pass
+    return tss
+
+
+def get_ts_sort_key(ts_key: str) -> int:
+    # the keys that are not timestamps go first, they are rejected when the payload is processed anyway
+    try:
+        return int(ts_key)
+    except (TypeError, ValueError):
+        return 0
+
+
+def merge_dev_payloads(items: Iterable[tuple[str, dict]]) -> list[tuple[str, dict]]:
+    """
+    Merges the payloads of the same device into bigger payloads, so they can be processed
+    in one transaction. Payloads are merged only if all the timestamps of the next payload are greater
+    than the timestamps of the already merged ones. Otherwise, a new merged payload is started,
+    this guarantees that processing of the merged payloads gives the same results as processing
+    of the initial payloads one by one.
+    The order of payloads is kept within one device.
+    """
+    merged_map: dict[str, list[list]] = {}  # {dev_ui: [[payload, max_ts], ...]}
+    for dev_ui, dev_payload in items:
+        tss = get_int_tss(dev_payload)
+        max_ts = max(tss, default=None)
+        dev_batches = merged_map.setdefault(dev_ui, [])
+        if len(dev_batches) > 0 and len(tss) > 0:
+            last_batch = dev_batches[-1]
+            if last_batch[1] is not None and min(tss) > last_batch[1]:
+                last_batch[0].update(dev_payload)
+                last_batch[1] = max_ts
+                continue
+        dev_batches.append([dict(dev_payload), max_ts])
+
+    return [(dev_ui, batch[0]) for dev_ui, dev_batches in merged_map.items() for batch in dev_batches]
@@ -40,13 +40,22 @@ def floor_timestamp(ts: int, interval: int) -> int:
     return k * interval
 
 
-def create_grid(start_rts: int, end_rts: int, time_resample: int) -> List[int]:
+def count_grid_points(start_rts: int, end_rts: int, time_resample: int) -> int:
+    """
+    The number of points of the grid from 'start_rts' to 'end_rts' (both included), validates the parameters.
+    """
     if end_rts < start_rts:
         raise ValueError("Input parameters for grid are not valid, end_rts < start_rts")
 
     if (end_rts - start_rts) % time_resample != 0:
         raise ValueError("Input parameters for grid are not valid, (end_rts - start_rts) % time_resample != 0")
 
+    return (end_rts - start_rts) // time_resample + 1
+
+
+def create_grid(start_rts: int, end_rts: int, time_resample: int) -> List[int]:
+    count_grid_points(start_rts, end_rts, time_resample)
+
     grid = [start_rts]  # as minimum, if 'start_rts' == 'end_rts', this array with a single element will be returned
     ts = start_rts
     while ts < end_rts: